@@ -62,6 +62,7 @@ import tempfile
 
 # LEMON modules
 import customparser
+import database
 import diffphot
 import fitsimage
 import keywords
@@ -90,9 +91,12 @@ parser.add_option(
     help="overwrite output JSON file if it already exists",
 )
 
+parser.add_option(photometry.parser.get_option("--backend"))
+parser.add_option(photometry.parser.get_option("--numpy-centering"))
 parser.add_option(photometry.parser.get_option("--margin"))
 parser.add_option(photometry.parser.get_option("--gain"))
 parser.add_option(photometry.parser.get_option("--cores"))
+parser.add_option(photometry.parser.get_option("--header-index"))
 parser.add_option(photometry.parser.get_option("--verbose"))
 
 qphot_group = optparse.OptionGroup(
@@ -254,6 +258,7 @@ search_group.add_option(
 
 search_group.add_option(photometry.parser.get_option("--snr-percentile"))
 search_group.add_option(photometry.parser.get_option("--mean"))
+search_group.add_option(photometry.parser.get_option("--fwhm-cache"))
 parser.add_option_group(search_group)
 
 const_group = optparse.OptionGroup(
@@ -357,6 +362,9 @@ def main(arguments=None):
         input_paths = list(set(args[1:-1]))
         output_json_path = args[-1]
 
+    paths = [sources_img_path] + input_paths
+    fitsimage.use_header_index(options.header_index, paths, options.ncores)
+
     # The execution of this module, especially when doing long-term monitoring
     # of reasonably crowded fields, may easily take several *days*. The least
     # we can do, in order to spare the end-user from insufferable grief because
@@ -374,15 +382,10 @@ def main(arguments=None):
     print msg % (style.prefix, len(input_paths))
 
     files = fitsimage.InputFITSFiles()
-    for index, img_path in enumerate(input_paths):
-        img = fitsimage.FITSImage(img_path)
-        pfilter = img.pfilter(options.filterk)
-        files[pfilter].append(img)
-
-        percentage = (index + 1) / len(input_paths) * 100
-        util.show_progress(percentage)
+    img_pfilters = fitsimage.pfilters(input_paths, options.filterk)
+    for img_path in input_paths:
+        files[img_pfilters[img_path]].append(img_path)
 
-    print  # progress bar doesn't include newline
     print style.prefix
 
     # To begin with, we need to identify the most constant stars, something for
@@ -409,6 +412,8 @@ def main(arguments=None):
     basic_args = [sources_img_path] + input_paths + [phot_db_path, "--overwrite"]
 
     phot_args = [
+        "--backend",
+        options.backend,
         "--maximum",
         options.maximum,
         "--margin",
@@ -435,13 +440,16 @@ def main(arguments=None):
         options.fwhmk,
         "--airmk",
         options.airmassk,
+        "--fwhm-cache",
+        options.fwhm_cache,
     ]
 
-    # The --gain and --uik options default to None, so add them to the list of
-    # arguments only if they were given. Otherwise, (a) --gaink would be given
-    # a value of 'None', a string, that would result in an error when optparse
-    # attempted to convert it to float, and (b) --uik would understood 'None'
-    # as the name of the keyword storing the path to the uncalibrated image.
+    # The --gain, --uik and --header-index options default to None, so add
+    # them to the list of arguments only if they were given. Otherwise, (a)
+    # --gaink would be given a value of 'None', a string, that would result in
+    # an error when optparse attempted to convert it to float, (b) --uik would
+    # understood 'None' as the name of the keyword storing the path to the
+    # uncalibrated image and (c) 'None' would be used as the header index.
 
     if options.gain:
         phot_args += ["--gain", options.gain]
@@ -449,6 +457,12 @@ def main(arguments=None):
     if options.uncimgk:
         phot_args += ["--uncimgk", options.uncimgk]
 
+    if options.header_index:
+        phot_args += ["--header-index", options.header_index]
+
+    if options.numpy_centering:
+        phot_args.append("--numpy-centering")
+
     # Pass as many '-v' options as we have received here
     [phot_args.append("-v") for x in xrange(options.verbose)]
 
@@ -594,11 +608,10 @@ def main(arguments=None):
         msg = "%sCalculating the median FWHM for this filter..."
         print msg % style.prefix,
 
-        pfilter_fwhms = []
-        for img in files[pfilter]:
-            img_fwhm = photometry.get_fwhm(img, options)
-            logging.debug("%s: FWHM = %.3f" % (img.path, img_fwhm))
-            pfilter_fwhms.append(img_fwhm)
+        paths = files[pfilter]
+        pfilter_fwhms = photometry.get_fwhms(paths, options)
+        for path, img_fwhm in zip(paths, pfilter_fwhms):
+            logging.debug("%s: FWHM = %.3f" % (path, img_fwhm))
 
         fwhm = numpy.median(pfilter_fwhms)
         print " done."
@@ -648,37 +661,72 @@ def main(arguments=None):
         )
         print msg % args
 
-        # For each candidate aperture, and only with the images taken in
-        # this filter, do photometry on the constant stars and compute the
-        # median of the standard deviation of their light curves as a means
-        # of evaluating the suitability of this combination of parameters.
+        # Do photometry on the constant stars, and only with the images taken
+        # in this filter, with all the candidate apertures at once: the first
+        # one is given with --aperture-pix and the rest with --extra-aperture-pix,
+        # so photometry.main() stores the measurements of each aperture in the
+        # LEMONdB as a separate set of photometric parameters. This reads each
+        # image only once, instead of once for each one of the apertures.
+
+        print style.prefix
+
+        kwargs = dict(prefix="photometry_", suffix=".LEMONdB")
+        fd, filter_phot_db_path = tempfile.mkstemp(**kwargs)
+        atexit.register(util.clean_tmp_files, filter_phot_db_path)
+        os.close(fd)
+
+        paths = files[pfilter]
+        basic_args = [sources_img_path] + paths + [filter_phot_db_path, "--overwrite"]
+
+        extra_args = [
+            "--filter",
+            str(pfilter),
+            "--coordinates",
+            coords_path,
+            "--aperture-pix",
+            filter_apertures[0],
+            "--annulus-pix",
+            annulus,
+            "--dannulus-pix",
+            dannulus,
+        ]
+
+        for aperture in filter_apertures[1:]:
+            extra_args += ["--extra-aperture-pix", aperture]
+
+        args = basic_args + phot_args + extra_args
+        check_run(photometry.main, [str(a) for a in args])
+
+        # The PhotometricParameters for which photometry is stored in the
+        # LEMONdB. The apertures were given to photometry.main() as strings,
+        # so they are matched to the candidate apertures with a tolerance. No
+        # records are stored for an aperture for which qphot measured nothing,
+        # so there may be fewer sets of parameters than candidate apertures.
+        util.owner_writable(filter_phot_db_path, True)  # chmod u+w
+        with database.LEMONdB(filter_phot_db_path) as db:
+            filter_pparams = db.pparams
+
+        # For each candidate aperture, compute the light curves of the constant
+        # stars and the median of their standard deviation as a means of
+        # evaluating the suitability of this combination of parameters.
         for index, aperture in enumerate(filter_apertures):
 
             print style.prefix
 
-            kwargs = dict(prefix="photometry_", suffix=".LEMONdB")
-            fd, aper_phot_db_path = tempfile.mkstemp(**kwargs)
-            atexit.register(util.clean_tmp_files, aper_phot_db_path)
-            os.close(fd)
+            matches = [x for x in filter_pparams if numpy.isclose(x.aperture, aperture)]
+            if not matches:
+                msg = "%sNo photometry for aperture %.3f. Ignoring it..."
+                print msg % (style.prefix, aperture)
+                continue
+            pparams = matches[0]
 
-            paths = [img.path for img in files[pfilter]]
-            basic_args = [sources_img_path] + paths + [aper_phot_db_path, "--overwrite"]
-
-            extra_args = [
-                "--filter",
-                str(pfilter),
-                "--coordinates",
-                coords_path,
-                "--aperture-pix",
-                aperture,
-                "--annulus-pix",
-                annulus,
-                "--dannulus-pix",
-                dannulus,
-            ]
-
-            args = basic_args + phot_args + extra_args
-            check_run(photometry.main, [str(a) for a in args])
+            # The LEMONdB is our own temporary file, so there is no need to
+            # copy it, with the photometry of all the apertures, for each one
+            # of them: replace the photometry of the previous aperture with
+            # that done with this one. diffphot.main() works on a copy.
+            with database.LEMONdB(filter_phot_db_path) as db:
+                db.use_pparams(pparams)
+                db.commit()
 
             kwargs = dict(prefix="diffphot_", suffix=".LEMONdB")
             fd, aper_diff_db_path = tempfile.mkstemp(**kwargs)
@@ -688,7 +736,7 @@ def main(arguments=None):
             # Reuse the arguments used earlier for diffphot.main(). We only
             # need to change the first argument (path to the input LEMONdB)
             # and the third one (path to the output LEMONdB)
-            diff_args[0] = aper_phot_db_path
+            diff_args[0] = filter_phot_db_path
             diff_args[2] = aper_diff_db_path
             check_run(diffphot.main, [str(a) for a in diff_args])
 
@@ -722,7 +770,7 @@ def main(arguments=None):
 
             # 'cstars' contains two-element tuples: (ID, stdev)
             stdevs_median = numpy.median([x[1] for x in cstars])
-            params = (aperture, annulus, dannulus, stdevs_median)
+            params = pparams + (stdevs_median,)
             # NumPy floating-point data types are not JSON serializable
             args = (float(x) for x in params)
             candidate = json_parse.CandidateAnnuli(*args)
@@ -0,0 +1,266 @@
+#! /usr/bin/env python2
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+
+"""
+This module implements, in pure NumPy, the same aperture photometry that IRAF's
+qphot does: centroid centering, a sky value estimated from the mode of the
+pixels in a circular annulus and the sum of the counts within an aperture,
+where the pixels crossed by its edge contribute with the fraction of their
+area that is inside of it. Instead of measuring one astronomical object at a
+time, the cutouts around all of them are stacked and processed at once, so the
+pixels of the image are read only once and photometry on thousands of objects
+takes a handful of array operations.
+
+All the coordinates are IRAF's 'logical' coordinates: one-indexed, with the
+center of the first pixel of the image at (1, 1). 'data' is always the
+two-dimensional NumPy array of a FITS image, indexed as [y, x] by PyFITS.
+
+"""
+
+import math
+import numpy
+
+# The zero point of the magnitude scale, as in IRAF's qphot
+ZMAG = 25.0
+
+# Maximum number of astronomical objects whose cutouts are stacked together.
+# Without this limit, wide sky annuli on a crowded field could need a stack
+# of several gigabytes in order to measure all the objects at once.
+CHUNK_SIZE = 512
+
+
+def _cutouts(data, x, y, radius):
+    """Return the stacked square cutouts of 'data' centered at (x, y).
+
+    'x' and 'y' are arrays with the coordinates of the N objects. Each cutout
+    is a square of side 2 * radius + 1 pixels, centered on the pixel that
+    contains the coordinates of the object. Pixels that fall off the image, as
+    well as all those of objects with non-finite coordinates, are set to NaN.
+    Returns a three-element tuple: (1) the stack of cutouts, an array of shape
+    (N, side, side), and (2, 3) two arrays of shape (N, side) with the distance
+    in pixels from each object to the center of each column and row of its
+    cutout, respectively.
+
+    """
+
+    ny, nx = data.shape
+    finite = numpy.isfinite(x) & numpy.isfinite(y)
+
+    # Objects extremely far off the image would overflow the cast to integer.
+    # Clip their coordinates so that, anyway, their cutouts fall off the image.
+    limit = max(nx, ny) + radius + 1
+    xc = numpy.clip(numpy.where(finite, x, 0), -limit, 2 * limit)
+    yc = numpy.clip(numpy.where(finite, y, 0), -limit, 2 * limit)
+
+    # Zero-indexed columns and rows of each cutout
+    offsets = numpy.arange(-radius, radius + 1)
+    cols = numpy.rint(xc - 1).astype(int)[:, None] + offsets
+    rows = numpy.rint(yc - 1).astype(int)[:, None] + offsets
+
+    valid_cols = (cols >= 0) & (cols < nx) & finite[:, None]
+    valid_rows = (rows >= 0) & (rows < ny) & finite[:, None]
+    valid = valid_rows[:, :, None] & valid_cols[:, None, :]
+
+    rindexes = numpy.clip(rows, 0, ny - 1)[:, :, None]
+    cindexes = numpy.clip(cols, 0, nx - 1)[:, None, :]
+    stack = data[rindexes, cindexes].astype(numpy.float64)
+    stack[~valid] = numpy.nan
+
+    dx = (cols + 1) - xc[:, None]
+    dy = (rows + 1) - yc[:, None]
+    return stack, dx, dy
+
+
+def _marginal_shift(marginal, distances):
+    """Return the shift of the centroid of each marginal distribution.
+
+    Following IRAF's centroid algorithm, only the values of each marginal
+    distribution above its mean are used; the centroid is the mean of the
+    distances weighted by them. A shift of zero is returned for the marginal
+    distributions in which no value is above the mean, such as flat ones.
+
+    """
+
+    weights = marginal - marginal.mean(axis=1)[:, None]
+    weights = numpy.clip(weights, 0, None)
+    total = weights.sum(axis=1)
+    nonzero = total > 0
+    shift = (weights * distances).sum(axis=1) / numpy.where(nonzero, total, 1)
+    return numpy.where(nonzero, shift, 0)
+
+
+def centroid(data, x, y, cbox, maxiter=10):
+    """Recenter the objects using the centroid centering algorithm.
+
+    Compute the accurate centers of the astronomical objects as the centroids
+    of the marginal distributions of the pixels in a box of width 'cbox'
+    pixels around the input coordinates. If the center moves to a different
+    pixel, the box is moved with it and the centroid computed again, up to
+    'maxiter' times. Returns a two-element tuple with the arrays of x- and
+    y-coordinates of the centers. If 'cbox' is smaller than two pixels the
+    input coordinates are returned unmodified: the box would be a single pixel.
+
+    """
+
+    x = numpy.array(x, dtype=numpy.float64)
+    y = numpy.array(y, dtype=numpy.float64)
+
+    half = int(cbox // 2)
+    if half < 1:
+        return x, y
+
+    pending = numpy.isfinite(x) & numpy.isfinite(y)
+    for _ in xrange(maxiter):
+
+        indexes = numpy.flatnonzero(pending)
+        if not len(indexes):
+            break
+
+        stack, dx, dy = _cutouts(data, x[indexes], y[indexes], half)
+        stack = numpy.where(numpy.isnan(stack), 0, stack)
+
+        # Sum along the rows for the x marginal, along the columns for y
+        new_x = x[indexes] + _marginal_shift(stack.sum(axis=1), dx)
+        new_y = y[indexes] + _marginal_shift(stack.sum(axis=2), dy)
+
+        moved = numpy.rint(new_x) != numpy.rint(x[indexes])
+        moved |= numpy.rint(new_y) != numpy.rint(y[indexes])
+
+        x[indexes] = new_x
+        y[indexes] = new_y
+        pending[indexes] = moved
+
+    return x, y
+
+
+def measure(data, x, y, aperture, annulus, dannulus, exptime=1.0, zmag=ZMAG):
+    """Do aperture photometry on the objects at the given coordinates.
+
+    The sky value of each object is the mode of the pixels in the annulus of
+    inner radius 'annulus' and width 'dannulus', estimated as IRAF does: the
+    mean if it is smaller than the median and 3 * median - 2 * mean otherwise.
+    The counts within the aperture of radius 'aperture' are then summed, with
+    the pixels on its edge weighted by the fraction of them that falls inside.
+    Magnitudes are normalized to an exposure time of one time unit, dividing
+    the flux by 'exptime', and use 'zmag' as the zero point.
+
+    Returns a four-element tuple with arrays of (1) the magnitudes, (2) the
+    total number of counts in the aperture, including the sky, (3) the number
+    of counts excluding the sky and (4) the standard deviation of the pixels
+    in the sky annulus. Magnitudes are NaN (INDEF, in IRAF's parlance) if the
+    flux is not positive, if the sky cannot be measured or if the aperture
+    does not entirely fall within the image; standard deviations are NaN only
+    if there are no pixels in the sky annulus.
+
+    'aperture' may also be a sequence of radii, in which case the photometry
+    is done for all of them in the same pass, estimating the sky only once.
+    The first three arrays then have shape (len(aperture), N), one row for
+    each aperture, while that of standard deviations is still one-dimensional
+    as the sky annulus is the same for all the apertures.
+
+    """
+
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    size = len(x)
+
+    apertures = numpy.atleast_1d(numpy.asarray(aperture, dtype=numpy.float64))
+    mags = numpy.empty((len(apertures), size))
+    sums = numpy.empty((len(apertures), size))
+    fluxes = numpy.empty((len(apertures), size))
+    stdevs = numpy.empty(size)
+
+    outer = annulus + dannulus
+    radius = int(math.ceil(max(apertures.max(), outer))) + 1
+
+    for start in xrange(0, size, CHUNK_SIZE):
+        chunk = slice(start, start + CHUNK_SIZE)
+        stack, dx, dy = _cutouts(data, x[chunk], y[chunk], radius)
+        nobjects = len(stack)
+
+        distances = numpy.sqrt(dx[:, None, :] ** 2 + dy[:, :, None] ** 2)
+        off = numpy.isnan(stack)
+        pixels = numpy.where(off, 0, stack)
+
+        in_annulus = (distances >= annulus) & (distances <= outer) & ~off
+        sky_pixels = numpy.ma.array(stack, mask=~in_annulus)
+        sky_pixels = sky_pixels.reshape(nobjects, -1)
+        mean = sky_pixels.mean(axis=1).filled(numpy.nan)
+        median = numpy.ma.median(sky_pixels, axis=1).filled(numpy.nan)
+        with numpy.errstate(invalid="ignore"):  # NaN if no sky pixels
+            sky = numpy.where(mean < median, mean, 3 * median - 2 * mean)
+        stdevs[chunk] = sky_pixels.std(axis=1).filled(numpy.nan)
+
+        has_sky = numpy.isfinite(sky)
+        for index, current in enumerate(apertures):
+            weights = numpy.clip(current - distances + 0.5, 0, 1)
+            partial = ((weights > 0) & off).reshape(nobjects, -1).any(axis=1)
+            area = numpy.where(off, 0, weights).reshape(nobjects, -1).sum(axis=1)
+            counts = (weights * pixels).reshape(nobjects, -1).sum(axis=1)
+            flux = counts - area * numpy.where(has_sky, sky, 0)
+
+            valid = has_sky & ~partial & (flux > 0)
+            chunk_mags = numpy.empty(nobjects)
+            chunk_mags.fill(numpy.nan)
+            chunk_mags[valid] = zmag - 2.5 * numpy.log10(flux[valid] / exptime)
+
+            mags[index, chunk] = chunk_mags
+            sums[index, chunk] = counts
+            fluxes[index, chunk] = flux
+
+    if numpy.ndim(aperture) == 0:
+        mags, sums, fluxes = mags[0], sums[0], fluxes[0]
+    return mags, sums, fluxes, stdevs
+
+
+def max_pixels(data, x, y, aperture):
+    """Return the value of the brightest pixel in the aperture of each object.
+
+    Consider as part of the aperture of radius 'aperture' all the pixels that
+    contribute to the counts computed by measure(), even those of which only a
+    fraction falls inside it. Returns an array with the maximum value of these
+    pixels for each astronomical object: comparing it with the saturation
+    level tells us whether the object is saturated. The value is NaN for the
+    objects whose aperture falls entirely off the image.
+
+    """
+
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    size = len(x)
+
+    peaks = numpy.empty(size)
+    radius = int(math.ceil(aperture)) + 1
+
+    for start in xrange(0, size, CHUNK_SIZE):
+        chunk = slice(start, start + CHUNK_SIZE)
+        stack, dx, dy = _cutouts(data, x[chunk], y[chunk], radius)
+        nobjects = len(stack)
+
+        distances = numpy.sqrt(dx[:, None, :] ** 2 + dy[:, :, None] ** 2)
+        inside = (distances < aperture + 0.5) & ~numpy.isnan(stack)
+        pixels = numpy.where(inside, stack, -numpy.inf).reshape(nobjects, -1)
+        chunk_peaks = pixels.max(axis=1)
+        chunk_peaks[~inside.reshape(nobjects, -1).any(axis=1)] = numpy.nan
+        peaks[chunk] = chunk_peaks
+
+    return peaks
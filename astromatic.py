@@ -25,6 +25,7 @@ import astropy.units
 import collections
 import functools
 import hashlib
+import numpy
 import os
 import os.path
 import re
@@ -120,6 +121,29 @@ class Coordinates(collections.namedtuple("Coordinates", "ra dec pm_ra pm_dec")):
         return self.__class__(ra, dec, None, None)
 
 
+def angular_distance(ra1, dec1, ra2, dec2):
+    """Return the angular distance, in degrees, between two celestial points.
+
+    Use the same Vincenty formula as astropy's SkyCoord.separation(), which is
+    accurate at all distances, but on NumPy arrays: the coordinates, in decimal
+    degrees, may be arrays of any shape that can be broadcast together, and
+    no SkyCoord objects are created. For two scalars, this is equivalent to
+    Coordinates(ra1, dec1).distance(Coordinates(ra2, dec2)), but much faster.
+
+    """
+
+    lon1, lat1, lon2, lat2 = (numpy.radians(x) for x in (ra1, dec1, ra2, dec2))
+    sin_dlon = numpy.sin(lon2 - lon1)
+    cos_dlon = numpy.cos(lon2 - lon1)
+    sin_lat1, cos_lat1 = numpy.sin(lat1), numpy.cos(lat1)
+    sin_lat2, cos_lat2 = numpy.sin(lat2), numpy.cos(lat2)
+
+    num1 = cos_lat2 * sin_dlon
+    num2 = cos_lat1 * sin_lat2 - sin_lat1 * cos_lat2 * cos_dlon
+    denominator = sin_lat1 * sin_lat2 + cos_lat1 * cos_lat2 * cos_dlon
+    return numpy.degrees(numpy.arctan2(numpy.hypot(num1, num2), denominator))
+
+
 class Star(
     collections.namedtuple(
         "_Star",
@@ -28,16 +28,16 @@ the information that may be needed for the data analysis.
 """
 
 import collections
-import copy
+import contextlib
 import itertools
 import math
 import numpy
 import numbers
-import operator
 import os
 import random
 import string
 import sqlite3
+import sys
 import tempfile
 
 # LEMON modules
@@ -139,12 +139,8 @@ class DBStar(object):
         be raised if self if not a subset of other -- so you should check for
         that before trimming anything"""
 
-        phot_info = numpy.empty((3, len(other)), dtype=self.dtype)
-        for oindex, unix_time in enumerate(other._unix_times):
-            sindex = self._time_index(unix_time)
-            phot_info[0][oindex] = self.time(sindex)
-            phot_info[1][oindex] = self.mag(sindex)
-            phot_info[2][oindex] = self.snr(sindex)
+        indexes = [self._time_index(x) for x in other._unix_times]
+        phot_info = self._phot_info[:, indexes]
         return DBStar(
             self.id, self.pfilter, phot_info, other._time_indexes, dtype=self.dtype
         )
@@ -164,6 +160,48 @@ class DBStar(object):
                 complete_stars.append(star._trim_to(self))
         return complete_stars
 
+    def complete_for_matrix(self, matrix):
+        """Return the trimmed DBStars of a PhotometryMatrix.
+
+        Vectorized version of complete_for(), for all the stars of 'matrix', as
+        returned by LEMONdB.get_photometry_matrix(), at once. The images in
+        which each star was measured are packed as bits in 'matrix.presence',
+        so a star is a superset of 'self' if AND-ing its bits with those of
+        the images of 'self' leaves them unchanged, which is tested for all
+        the rows with a single array operation. The magnitudes and SNRs of the
+        stars found are then taken from the matrix with fancy indexing. The
+        star with the same ID as 'self', if any, is not included.
+
+        """
+
+        unix_times = matrix.unix_times
+        columns = numpy.searchsorted(unix_times, self._unix_times)
+        # No star can be complete if 'self' was observed at other Unix times
+        if not (columns < len(unix_times)).all():
+            return []
+        if not numpy.array_equal(unix_times[columns], self._unix_times):
+            return []
+
+        observed = numpy.zeros(len(unix_times), dtype=bool)
+        observed[columns] = True
+        bits = numpy.packbits(observed)
+        complete = ((matrix.presence & bits) == bits).all(axis=1)
+        complete &= matrix.star_ids != self.id
+        rows = numpy.flatnonzero(complete)
+
+        magnitudes = matrix.magnitudes[rows[:, None], columns]
+        snrs = matrix.snrs[rows[:, None], columns]
+        complete_stars = []
+        for index, row in enumerate(rows):
+            phot_info = numpy.empty((3, len(columns)), dtype=self.dtype)
+            phot_info[0] = self._unix_times
+            phot_info[1] = magnitudes[index]
+            phot_info[2] = snrs[index]
+            id_ = int(matrix.star_ids[row])
+            args = id_, self.pfilter, phot_info, self._time_indexes
+            complete_stars.append(DBStar(*args, dtype=self.dtype))
+        return complete_stars
+
     @staticmethod
     def make_star(id_, pfilter, rows, dtype=numpy.longdouble):
         """Construct a DBstar instance for some photometric data.
@@ -196,6 +234,26 @@ class DBStar(object):
             times_indexes[unix_time] = index
         return DBStar(id_, pfilter, phot_info, times_indexes, dtype=dtype)
 
+    @staticmethod
+    def from_matrix(matrix, index, pfilter, dtype=numpy.longdouble):
+        """Construct a DBStar from a row of a PhotometryMatrix.
+
+        Return a DBStar with the photometric records of the index-th star of
+        'matrix', as returned by LEMONdB.get_photometry_matrix(): one for each
+        image in which the star was measured, sorted by their Unix time.
+
+        """
+
+        present = matrix.mask[index]
+        unix_times = matrix.unix_times[present]
+        phot_info = numpy.empty((3, len(unix_times)), dtype=dtype)
+        phot_info[0] = unix_times
+        phot_info[1] = matrix.magnitudes[index][present]
+        phot_info[2] = matrix.snrs[index][present]
+        times_indexes = dict((t, i) for i, t in enumerate(unix_times.tolist()))
+        id_ = int(matrix.star_ids[index])
+        return DBStar(id_, pfilter, phot_info, times_indexes, dtype=dtype)
+
 
 # The parameters used for aperture photometry
 typename = "PhotometricParameters"
@@ -207,14 +265,29 @@ typename = "Image"
 field_names = "path pfilter unix_time object airmass gain ra dec"
 Image = collections.namedtuple(typename, field_names)
 
+# The photometry of all the stars in a filter, as returned by
+# LEMONdB.get_photometry_matrix(): 'magnitudes' and 'snrs' are two-dimensional
+# float64 arrays, with a row for each star and a column for each image, and
+# 'mask' is True where the star was measured in the image. 'star_ids' and
+# 'unix_times' are the one-dimensional arrays with the ID of the stars and the
+# Unix time of the images, in the same order as the rows and columns.
+# 'presence' is 'mask' with each row packed into bits (numpy.packbits), eight
+# images per byte.
+typename = "PhotometryMatrix"
+field_names = "magnitudes snrs mask star_ids unix_times presence"
+PhotometryMatrix = collections.namedtuple(typename, field_names)
+
 
 class LightCurve(object):
     """The data points of a graph of light intensity of a celestial object.
 
     Encapsulates a series of Unix times linked to a differential magnitude with
-    a signal-to-noise ratio. Internally stored as a list of three-element
-    tuples, but we are implementing the add method so that we can interact with
-    it as if it were a set, moving us up one level in the abstraction ladder.
+    a signal-to-noise ratio. Internally stored as a two-dimensional NumPy array
+    with three rows (Unix times, magnitudes and SNRs), plus a cached copy of it
+    sorted chronologically, but we are implementing the add method so that we
+    can interact with it as if it were a set, moving us up one level in the
+    abstraction ladder. The standard deviation and amplitude are computed only
+    once, the first time they are needed, until more points are added.
 
     """
 
@@ -239,34 +312,127 @@ class LightCurve(object):
             msg = "at least one comparison star is needed"
             raise ValueError(msg)
 
-        self._data = []
         self.pfilter = pfilter
         self.cstars = cstars
         self.cweights = cweights
         self.cstdevs = cstdevs
         self.dtype = dtype
 
+        # Points are appended to a list, which is much faster than growing an
+        # array one column at a time, and moved to the array when needed. The
+        # SNRs may be None (see diffphot.StarSet.light_curve()): they are then
+        # stored as NaN, and turned back into None when the points are read.
+        self._points = numpy.empty((3, 0), dtype=dtype)
+        self._pending = []
+        self._no_snrs = False
+
+        # The values computed from the points, forgotten when a point is added
+        self._cache = {}
+
+    @classmethod
+    def from_sorted_points(
+        cls, pfilter, cstars, cweights, cstdevs, points, dtype=numpy.longdouble
+    ):
+        """Return a new LightCurve with points already sorted chronologically.
+
+        The first four arguments are those of LightCurve.__init__(), while
+        'points' is a sequence of (unix_time, magnitude, snr) tuples sorted by
+        their Unix time, such as the rows of a query with ORDER BY. They are
+        moved to the array at once, which is also used as its sorted copy, so
+        they do not have to be sorted again. As with add(), SNRs may be None.
+
+        """
+
+        curve = cls(pfilter, cstars, cweights, cstdevs, dtype=dtype)
+        points = list(points)
+        if any(snr is None for _, _, snr in points):
+            curve._no_snrs = True
+            points = [(t, m, numpy.nan if s is None else s) for t, m, s in points]
+        points = numpy.array(points, dtype=numpy.float64).reshape(-1, 3)
+        curve._points = points.T.astype(dtype)
+        curve._cache["sorted"] = curve._points
+        return curve
+
+    @property
+    def _data(self):
+        """ Return the array of points, in the order in which they were added """
+        if self._pending:
+            points = numpy.array(self._pending, dtype=self.dtype).T
+            self._points = numpy.hstack((self._points, points))
+            self._pending = []
+        return self._points
+
+    @property
+    def _chronological(self):
+        """ Return the array of points, sorted by their Unix time """
+        if "sorted" not in self._cache:
+            data = self._data
+            # A stable sort, as that of Python, for points with the same time
+            self._cache["sorted"] = data[:, numpy.argsort(data[0], kind="mergesort")]
+        return self._cache["sorted"]
+
+    def _points_tuples(self, points):
+        """ Return the columns of the array as (unix_time, magnitude, snr) """
+        if not self._no_snrs:
+            return itertools.izip(*points)
+        snrs = [None if numpy.isnan(x) else x for x in points[2]]
+        return itertools.izip(points[0], points[1], snrs)
+
     def add(self, unix_time, magnitude, snr):
         """ Add a data point to the light curve """
-        self._data.append((unix_time, magnitude, snr))
+        if snr is None:
+            self._no_snrs = True
+            snr = numpy.nan
+        self._pending.append((unix_time, magnitude, snr))
+        if self._cache:
+            self._cache = {}
+
+    def add_many(self, unix_times, magnitudes, snrs):
+        """Add many data points to the light curve at once.
+
+        The Unix times, magnitudes and SNRs of the points are given in three
+        sequences or NumPy arrays of the same length, much faster than adding
+        the points one by one. 'snrs' may be None, which is equivalent to
+        using None as the signal-to-noise ratio of each point.
+
+        """
+
+        points = numpy.empty((3, len(unix_times)), dtype=self.dtype)
+        points[0] = unix_times
+        points[1] = magnitudes
+        if snrs is None:
+            self._no_snrs = True
+            points[2] = numpy.nan
+        else:
+            points[2] = snrs
+        self._points = numpy.hstack((self._data, points))
+        self._cache = {}
 
     def __len__(self):
-        return len(self._data)
+        return self._points.shape[1] + len(self._pending)
 
     def __getitem__(self, index):
-        return self._data[index]
+        """Return the index-th (unix_time, magnitude, snr) tuple, in the order
+        in which they were added, or a list of them if 'index' is a slice"""
+        data = self._data
+        if isinstance(index, slice):
+            return list(self._points_tuples(data[:, index]))
+        if not -data.shape[1] <= index < data.shape[1]:
+            raise IndexError("light curve index out of range")
+        return self._points_tuples(data[:, index : index + 1 or None]).next()
 
     def __iter__(self):
-        """Return a copy of the (unix_time, magnitude, snr) tuples,
+        """Return an iterator over the (unix_time, magnitude, snr) tuples,
         chronologically sorted"""
-        return iter(sorted(self._data, key=operator.itemgetter(0)))
+        return self._points_tuples(self._chronological)
 
     @property
     def stdev(self):
         if not self:
             raise ValueError("light curve is empty")
-        magnitudes = [mag for unix_time, mag, snr in self._data]
-        return numpy.std(numpy.array(magnitudes, dtype=self.dtype))
+        if "stdev" not in self._cache:
+            self._cache["stdev"] = numpy.std(self._data[1])
+        return self._cache["stdev"]
 
     def weights(self):
         """Return a generator over the comparison stars and their weights.
@@ -302,22 +468,36 @@ class LightCurve(object):
         if not self:
             raise ValueError("light curve is empty")
 
-        magnitudes = sorted(mag for unix_time, mag, snr in self._data)
-        func = numpy.median if median else numpy.mean
-        return func(magnitudes[-npoints:]) - func(magnitudes[:npoints])
+        key = ("amplitude", npoints, bool(median))
+        if key not in self._cache:
+            magnitudes = numpy.sort(self._data[1])
+            func = numpy.median if median else numpy.mean
+            amplitude = func(magnitudes[-npoints:]) - func(magnitudes[:npoints])
+            self._cache[key] = amplitude
+        return self._cache[key]
 
     def ignore_noisy(self, snr):
         """Return a copy of the LightCurve without noisy points.
 
-        The method returns a deep copy of the instance from which those
-        differential magnitudes whose signal-to-noise ratio is below 'snr'
-        have been removed.
+        The method returns a new instance from which those differential
+        magnitudes whose signal-to-noise ratio is below 'snr' have been
+        removed. Its points are never modified in place, so the new instance
+        shares the comparison stars and weights with this one, as well as the
+        array of points (and the values computed from them) if none of them is
+        noisy.
 
         """
 
-        curve = copy.deepcopy(self)
-        # _data stores three-element tuples: (Unix time, magnitude, snr)
-        curve._data = [x for x in curve._data if x[-1] >= snr]
+        args = self.pfilter, self.cstars, self.cweights, self.cstdevs
+        curve = LightCurve(*args, dtype=self.dtype)
+        curve._no_snrs = self._no_snrs
+        data = self._data
+        keep = data[2] >= snr
+        if keep.all():
+            curve._points = data
+            curve._cache = dict(self._cache)
+        else:
+            curve._points = data[:, keep]
         return curve
 
 
@@ -375,6 +555,60 @@ StarInfo = collections.namedtuple(
 class LEMONdB(object):
     """ Interface to the SQLite database used to store our results """
 
+    # Stored as the user version of the database (PRAGMA user_version), so
+    # that the databases created by previous versions of LEMON are detected,
+    # and migrated, when opened. Version 1: PHOTOMETRY and LIGHT_CURVES are
+    # WITHOUT ROWID tables, keyed by (star_id, image_id). Version 2: so is
+    # PPARAMS_PHOTOMETRY, keyed by (pparams_id, star_id, image_id).
+    SCHEMA_VERSION = 2
+
+    # The pragmas set by LEMONdB.bulk_load(), and the secondary indexes that it
+    # drops until the end of the bulk load, as they are on the tables to which
+    # most of the rows are inserted. Note that the indexes used with INDEXED BY
+    # while data is inserted, such as img_by_filter_time, cannot be dropped.
+    BULK_PRAGMAS = collections.OrderedDict(
+        [
+            ("journal_mode", "WAL"),
+            ("synchronous", "OFF"),
+            ("cache_size", -256 * 1024),  # in KiB (i.e., 256 MiB)
+            ("temp_store", "MEMORY"),
+        ]
+    )
+    BULK_DROPPED_INDEXES = ("phot_by_image", "cstars_by_star_filter")
+
+    # The radius, in degrees, in which the stars closest to some celestial
+    # coordinates are first searched for (see stars_closest_to_world_coords)
+    SEARCH_RADIUS = 1 / 60
+
+    # The number of rows read at a time with fetchmany() by the methods that
+    # load more records than we would like to keep in memory as a Python list
+    # (see get_photometry_matrix)
+    FETCH_SIZE = 100000
+
+    # The tables whose schema changed in each version, mapped to the indexes
+    # that they used to have and to the columns to copy to the new tables.
+    MIGRATIONS = {
+        1: [
+            (
+                "photometry",
+                ("phot_by_star_image", "phot_by_image"),
+                "star_id, image_id, magnitude, snr",
+            ),
+            (
+                "light_curves",
+                ("curve_by_star_image",),
+                "star_id, image_id, magnitude, snr",
+            ),
+        ],
+        2: [
+            (
+                "pparams_photometry",
+                (),
+                "star_id, image_id, pparams_id, magnitude, snr",
+            )
+        ],
+    }
+
     def __init__(self, path, dtype=numpy.longdouble):
 
         self.path = path
@@ -382,6 +616,11 @@ class LEMONdB(object):
         self.connection = sqlite3.connect(self.path, isolation_level=None)
         self._cursor = self.connection.cursor()
 
+        # The IDs of the stars and images are read from the database the first
+        # time they are needed and then kept in memory, updating them as stars
+        # and images are added, instead of running a query for each lookup.
+        self._clear_caches()
+
         # Enable foreign key support (SQLite >= 3.6.19)
         self._execute("PRAGMA foreign_keys = ON")
         self._execute("PRAGMA foreign_keys")
@@ -406,6 +645,10 @@ class LEMONdB(object):
         """ Execute SQL query; returns nothing """
         self._cursor.execute(query, t)
 
+    def _executemany(self, query, seq):
+        """ Execute SQL query against all the sequences; returns nothing """
+        self._cursor.executemany(query, seq)
+
     @property
     def _rows(self):
         """ Return an iterator over the rows returned by the last query """
@@ -437,6 +680,15 @@ class LEMONdB(object):
     def _rollback_to(self, name):
         """ Revert the state of the database to a savepoint """
         self._execute("ROLLBACK TO %s" % name)
+        # We do not know which insertions were undone
+        self._clear_caches()
+
+    def _clear_caches(self):
+        """ Forget the IDs of the stars and images loaded into memory """
+        self._star_ids_set = None
+        self._sorted_star_ids = None
+        self._no_pm_ids_set = None
+        self._image_ids = None
 
     def _release(self, name):
         """Remove from the transaction stack all savepoints back to and
@@ -460,9 +712,137 @@ class LEMONdB(object):
         self._execute("ANALYZE")
         self.commit()
 
+    def _set_pragmas(self, pragmas):
+        """Set the pragmas and return a dictionary with their old values.
+        Must be called outside of a transaction, or the journal mode of the
+        database would not change"""
+
+        old_values = {}
+        for name, value in pragmas.iteritems():
+            self._execute("PRAGMA %s" % name)
+            old_values[name] = self._rows.fetchone()[0]
+            self._execute("PRAGMA %s = %s" % (name, value))
+            self._rows.fetchall()  # journal_mode returns the new mode
+        return old_values
+
+    @contextlib.contextmanager
+    def bulk_load(self):
+        """Context manager to insert large amounts of data into the LEMONdB.
+
+        By default, the LEMONdB uses the safe settings of SQLite, as it may
+        be opened interactively. Within the body of the with statement, the
+        database trades durability for speed: the changes are written to a
+        write-ahead log, SQLite does not wait for them to reach the disk (so
+        they may be lost, and the database corrupted, if the operating system
+        crashes or the computer loses power), the page cache is much larger
+        and temporary tables and indexes are kept in memory. The secondary
+        indexes of the tables to which photometry and light curves are added
+        are dropped, and built again at the end, so that they are not updated
+        on every insertion. The statistics of the query optimizer are then
+        updated with LEMONdB.analyze().
+
+        The pending changes are committed before entering the body of the
+        with statement, and also on exit from it -- unless an exception is
+        raised, in which case they are rolled back, as LEMONdB never commits
+        automatically otherwise.
+
+        """
+
+        self._end()
+        old_pragmas = self._set_pragmas(self.BULK_PRAGMAS)
+        self._start()
+
+        names = self.BULK_DROPPED_INDEXES
+        self._execute(
+            "SELECT name, sql FROM sqlite_master "
+            "WHERE type = 'index' AND name IN (%s)" % ", ".join("?" * len(names)),
+            names,
+        )
+        indexes = list(self._rows)
+        for name, _ in indexes:
+            self._execute("DROP INDEX %s" % name)
+
+        try:
+            yield self
+        except:
+            # SQLite may have already rolled back the transaction (e.g., on
+            # SQLITE_FULL), in which case ROLLBACK fails. That error must not
+            # hide the exception being propagated -- which, in Python 2, a bare
+            # 'raise' would no longer re-raise after catching another one.
+            type, value, traceback = sys.exc_info()
+            try:
+                self._execute("ROLLBACK")
+            except sqlite3.OperationalError:
+                pass
+            self._clear_caches()
+            raise type, value, traceback
+        else:
+            self._end()
+        finally:
+            self._set_pragmas(old_pragmas)
+            self._start()
+
+            # After a rollback, the dropped indexes may have been restored
+            self._execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+            existing = set(row[0] for row in self._rows)
+            for name, sql in indexes:
+                if name not in existing:
+                    self._execute(sql)
+            self.commit()
+
+        self.analyze()
+
+    @property
+    def _schema_version(self):
+        self._execute("PRAGMA user_version")
+        return self._rows.fetchone()[0]
+
+    def _rename_outdated_tables(self):
+        """Rename the tables created with a previous version of the schema.
+
+        Loop over the schema versions after that of the database, renaming
+        the tables whose definition changed (and dropping their indexes), so
+        that _create_tables() creates them again. Returns a list of two-element
+        tuples: (1) the name of each table and (2) the columns that have to be
+        copied from the renamed table. Tables that do not exist (e.g., the
+        database has just been created, or it predates the table) are skipped:
+        _create_tables() will create them with the current definition.
+
+        """
+
+        self._execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        tables = set(row[0] for row in self._rows)
+
+        outdated = []
+        for version in xrange(self._schema_version + 1, self.SCHEMA_VERSION + 1):
+            for table, indexes, columns in self.MIGRATIONS[version]:
+                if table not in tables:
+                    continue
+                for index in indexes:
+                    self._execute("DROP INDEX IF EXISTS %s" % index)
+                self._execute("ALTER TABLE %s RENAME TO old_%s" % (table, table))
+                outdated.append((table, columns))
+        return outdated
+
+    def _is_writable(self):
+        """ Return False if the database file cannot be written to """
+
+        if self.path == ":memory:" or not os.path.exists(self.path):
+            return True
+        return os.access(self.path, os.W_OK)
+
     def _create_tables(self):
         """ Create, if needed, the tables used by the database """
 
+        # Nothing can be written to a read-only LEMONdB (e.g., diffphot makes
+        # its output file read-only), so its schema is left untouched: it was
+        # created when the file was written, and it can still be read.
+        if not self._is_writable():
+            return
+
+        # Databases created with a previous schema are migrated
+        outdated = self._rename_outdated_tables()
+
         # This table will contain non-relational information about the LEMONdB
         # itself: we need to store records (key-value pairs, such as ('AUTHOR',
         # 'John Doe') or ('DATE', 1401993454.89).
@@ -494,6 +874,13 @@ class LEMONdB(object):
         """
         )
 
+        # Only the stars in a narrow band of declinations need to be read in
+        # order to find those closest to some celestial coordinates. Include
+        # the right ascension, so that the table itself need not be read. Not
+        # forced with INDEXED BY, as read-only LEMONdBs created by previous
+        # versions lack it (and it cannot be added to them).
+        self._execute("CREATE INDEX IF NOT EXISTS stars_by_dec ON stars(dec, ra)")
+
         self._execute(
             """
         CREATE TABLE IF NOT EXISTS photometric_filters (
@@ -569,20 +956,24 @@ class LEMONdB(object):
             "ON images(filter_id, unix_time)"
         )
 
-        # Enforce a maximum of one sources image (SOURCES == 1)
-        for index, when in enumerate(("INSERT", "UPDATE OF sources")):
-            stmt = """CREATE TRIGGER IF NOT EXISTS single_sources_%d
-                      AFTER %s ON images
-                      BEGIN
-                          SELECT RAISE(ABORT, 'only one SOURCES column may be = 1')
-                          WHERE (SELECT COUNT(*)
-                                 FROM images
-                                 WHERE sources = 1) > 1;
-                      END; """ % (
-                index,
-                when,
-            )
-            self._execute(stmt)
+        # Enforce a maximum of one sources image (SOURCES == 1) with a partial
+        # unique index (SQLite >= 3.8.0): each insertion only has to look up an
+        # index with, at most, one entry. We used to do this with triggers that
+        # counted the sources images after every INSERT and UPDATE, scanning
+        # the entire table, so storing N images took O(N^2) time. Replace them
+        # with the index in the databases created by previous versions.
+        self._execute(
+            "SELECT name FROM sqlite_master "
+            "WHERE type = 'trigger' "
+            "AND name IN ('single_sources_0', 'single_sources_1')"
+        )
+        for (trigger,) in self._rows.fetchall():
+            self._execute("DROP TRIGGER %s" % trigger)
+
+        self._execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS single_sources "
+            "ON images(sources) WHERE sources = 1"
+        )
 
         # Although FILTER_ID, UNIX_TIME, AIRMASS and GAIN may be NULL, we only
         # allow this for the sources image (that for which SOURCES == 1). The
@@ -658,47 +1049,67 @@ class LEMONdB(object):
         """
         )
 
+        # PHOTOMETRY and LIGHT_CURVES are WITHOUT ROWID tables (SQLite >=
+        # 3.8.2): the rows are stored in a B-tree keyed by star and image, so
+        # we do not need an additional index to look them up, which would have
+        # to be updated on every insertion and would double the size on disk.
+
         self._execute(
             """
         CREATE TABLE IF NOT EXISTS photometry (
-            id         INTEGER PRIMARY KEY,
             star_id    INTEGER NOT NULL,
             image_id   INTEGER NOT NULL,
             magnitude  REAL NOT NULL,
             snr        REAL NOT NULL,
             FOREIGN KEY (star_id)  REFERENCES stars(id),
             FOREIGN KEY (image_id) REFERENCES images(id),
-            UNIQUE (star_id, image_id))
+            PRIMARY KEY (star_id, image_id))
+            WITHOUT ROWID
         """
         )
 
         self._execute(
-            "CREATE INDEX IF NOT EXISTS phot_by_star_image "
-            "ON photometry(star_id, image_id)"
+            "CREATE INDEX IF NOT EXISTS phot_by_image " "ON photometry(image_id)"
         )
+
+        # Photometry done with multiple sets of photometric parameters (e.g.,
+        # different apertures, all measured at once) may be optionally stored
+        # in this table, so that any of them can be later copied to PHOTOMETRY
+        # with LEMONdB.use_pparams(), without having to do photometry again.
+        # It has a row for each star, image and aperture, so it is also a
+        # WITHOUT ROWID table, keyed by the columns by which use_pparams()
+        # looks up the records.
+
         self._execute(
-            "CREATE INDEX IF NOT EXISTS phot_by_image " "ON photometry(image_id)"
+            """
+        CREATE TABLE IF NOT EXISTS pparams_photometry (
+            star_id    INTEGER NOT NULL,
+            image_id   INTEGER NOT NULL,
+            pparams_id INTEGER NOT NULL,
+            magnitude  REAL NOT NULL,
+            snr        REAL NOT NULL,
+            FOREIGN KEY (star_id)    REFERENCES stars(id),
+            FOREIGN KEY (image_id)   REFERENCES images(id),
+            FOREIGN KEY (pparams_id) REFERENCES photometric_parameters(id),
+            PRIMARY KEY (pparams_id, star_id, image_id))
+            WITHOUT ROWID
+        """
         )
 
         self._execute(
             """
         CREATE TABLE IF NOT EXISTS light_curves (
-            id         INTEGER PRIMARY KEY,
             star_id    INTEGER NOT NULL,
             image_id   INTEGER NOT NULL,
             magnitude  REAL NOT NULL,
             snr        REAL,
             FOREIGN KEY (star_id)  REFERENCES stars(id),
             FOREIGN KEY (image_id) REFERENCES images(id),
-            UNIQUE (star_id, image_id))
+            PRIMARY KEY (star_id, image_id))
+            WITHOUT ROWID
         """
         )
 
-        self._execute(
-            "CREATE INDEX IF NOT EXISTS curve_by_star_image "
-            "ON light_curves(star_id, image_id)"
-        )
-
         self._execute(
             """
         CREATE TABLE IF NOT EXISTS cmp_stars (
@@ -719,6 +1130,15 @@ class LEMONdB(object):
             "ON cmp_stars(star_id, filter_id)"
         )
 
+        for table, columns in outdated:
+            args = table, columns, table
+            self._execute("INSERT INTO %s SELECT %s FROM old_%s" % args)
+            self._execute("DROP TABLE old_%s" % table)
+
+        # Only when the database has just been created or migrated
+        if self._schema_version != self.SCHEMA_VERSION:
+            self._execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+
     def _table_count(self, table):
         """ Return the number of rows in 'table' """
         self._execute("SELECT COUNT(*) FROM %s" % table)
@@ -992,8 +1412,12 @@ class LEMONdB(object):
             self._execute(
                 "INSERT INTO images " "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", t
             )
+            image_id = self._cursor.lastrowid
             self._release(mark)
 
+            if self._image_ids is not None and None not in t[2:4]:
+                self._image_ids[(float(image.unix_time), t[2])] = image_id
+
         except Exception as e:
             self._rollback_to(mark)
 
@@ -1030,26 +1454,23 @@ class LEMONdB(object):
         """Return the ID of the Image with this Unix time and filter.
         Raises KeyError if there is no image for this date and filter"""
 
-        # Note the cast to Python's built-in float. Otherwise, if the method
-        # gets a NumPy float, SQLite raises "sqlite3.InterfaceError: Error
-        # binding parameter - probably unsupported type"
-        t = (float(unix_time), hash(pfilter))
-        self._execute(
-            "SELECT id "
-            "FROM images INDEXED BY img_by_filter_time "
-            "WHERE unix_time = ? "
-            "  AND filter_id = ?",
-            t,
-        )
-        rows = list(self._rows)
-        if not rows:
+        # Map each (Unix time, filter ID) to the ID of the image. The sources
+        # image may have neither of them, but then it cannot be looked up.
+        if self._image_ids is None:
+            self._execute(
+                "SELECT unix_time, filter_id, id "
+                "FROM images "
+                "WHERE unix_time IS NOT NULL "
+                "  AND filter_id IS NOT NULL"
+            )
+            self._image_ids = dict(((t, f), id_) for t, f, id_ in self._rows)
+
+        try:
+            return self._image_ids[(float(unix_time), hash(pfilter))]
+        except KeyError:
             msg = "%.4f (%s) and filter %s"
             args = unix_time, util.utctime(unix_time), pfilter
             raise KeyError(msg % args)
-        else:
-            assert len(rows) == 1
-            assert len(rows[0]) == 1
-            return rows[0][0]
 
     def get_image(self, unix_time, pfilter):
         """Return the Image observed at a Unix time and photometric filter.
@@ -1099,6 +1520,12 @@ class LEMONdB(object):
             msg = "star with ID = %d already in database" % star_id
             raise DuplicateStarError(msg)
 
+        if self._star_ids_set is not None:
+            self._star_ids_set.add(star_id)
+            self._sorted_star_ids = None
+        if self._no_pm_ids_set is not None and None in (pm_ra, pm_dec):
+            self._no_pm_ids_set.add(star_id)
+
     def get_star(self, star_id):
         """Returns a StarInfo namedtuple with information about the star.
 
@@ -1121,11 +1548,28 @@ class LEMONdB(object):
         """ Return the number of stars in the database """
         return self._table_count("STARS")
 
+    @property
+    def _star_ids(self):
+        """ Return the set of the IDs of the stars in the database """
+        if self._star_ids_set is None:
+            self._execute("SELECT id FROM stars")
+            self._star_ids_set = set(x[0] for x in self._rows)
+        return self._star_ids_set
+
+    @property
+    def _no_pm_star_ids(self):
+        """ Return the set of the IDs of the stars without proper motions """
+        if self._no_pm_ids_set is None:
+            self._execute("SELECT id FROM stars WHERE pm_ra IS NULL OR pm_dec IS NULL")
+            self._no_pm_ids_set = set(x[0] for x in self._rows)
+        return self._no_pm_ids_set
+
     @property
     def star_ids(self):
         """ Return a list with the ID of the stars, in ascending order """
-        self._execute("SELECT id FROM stars ORDER BY id ASC")
-        return list(x[0] for x in self._rows)
+        if self._sorted_star_ids is None:
+            self._sorted_star_ids = sorted(self._star_ids)
+        return list(self._sorted_star_ids)
 
     def add_pm_correction(self, star_id, unix_time, pfilter, pm_x, pm_y):
         """Store the proper-motion corrected pixel coordinates of a star.
@@ -1197,12 +1641,55 @@ class LEMONdB(object):
             rows = tuple(self._rows)
             return rows[0]
         except IndexError:
-            if star_id not in self.star_ids:
+            if star_id not in self._star_ids:
                 msg = "star with ID = %d not in database" % star_id
                 raise KeyError(msg)
             else:
                 return None, None
 
+    def _batch_image_id(self, image):
+        """Return the ID of an Image, for the batch insertion methods.
+        Raises UnknownImageError if the image is not in the database"""
+
+        try:
+            return self._get_image_id(image.unix_time, image.pfilter)
+        except KeyError, e:
+            raise UnknownImageError(str(e))
+
+    def _insert_batch(self, stmt, rows, image, what, star_index=1):
+        """Insert all the rows with executemany(), all or nothing.
+
+        Run the INSERT statement 'stmt' for each tuple in 'rows', whose element
+        at 'star_index' must be the ID of a star, within a savepoint, so that
+        no rows are stored if any of them cannot be inserted. In that case, the
+        failed constraint is translated into UnknownStarError if one or more of
+        the stars are not in the database or, otherwise,
+        DuplicatePhotometryError, with 'what' describing the records that were
+        already stored for the Image 'image'.
+
+        """
+
+        mark = self._savepoint()
+        try:
+            self._executemany(stmt, rows)
+        except sqlite3.IntegrityError:
+            self._rollback_to(mark)
+            self._release(mark)
+
+            star_ids = self._star_ids
+            for row in rows:
+                if row[star_index] not in star_ids:
+                    msg = "star with ID = %d not in database" % row[star_index]
+                    raise UnknownStarError(msg)
+
+            msg = "%s for one or more stars, Unix time = %.4f (%s) and filter %s"
+            msg += " already in database"
+            unix_time = image.unix_time
+            args = (what, unix_time, util.utctime(unix_time), image.pfilter)
+            raise DuplicatePhotometryError(msg % args)
+
+        self._release(mark)
+
     def add_photometry(self, star_id, unix_time, pfilter, magnitude, snr):
         """Store the photometric record of a star at a given time and filter.
 
@@ -1223,14 +1710,14 @@ class LEMONdB(object):
             # Note the casts to Python's built-in float. Otherwise, if the
             # method gets a NumPy float, SQLite raises "sqlite3.InterfaceError:
             # Error binding parameter - probably unsupported type"
-            t = (None, star_id, image_id, float(magnitude), float(snr))
-            self._execute("INSERT INTO photometry VALUES (?, ?, ?, ?, ?)", t)
+            t = (star_id, image_id, float(magnitude), float(snr))
+            self._execute("INSERT INTO photometry VALUES (?, ?, ?, ?)", t)
 
         except KeyError, e:
             raise UnknownImageError(str(e))
 
         except sqlite3.IntegrityError:
-            if not star_id in self.star_ids:
+            if star_id not in self._star_ids:
                 msg = "star with ID = %d not in database" % star_id
                 raise UnknownStarError(msg)
 
@@ -1241,6 +1728,173 @@ class LEMONdB(object):
             args = (star_id, unix_time, util.utctime(unix_time), pfilter)
             raise DuplicatePhotometryError(msg % args)
 
+    def add_photometry_batch(self, image, rows):
+        """Store the photometric records of many stars in the same image.
+
+        Equivalent to calling add_photometry() for each (star_id, magnitude,
+        snr) three-element tuple in 'rows', all of them for 'image', an Image
+        object previously added to the database. The ID of the image is looked
+        up only once, and the records are inserted with a single executemany()
+        statement. Raises the same exceptions as add_photometry(), in which
+        case none of the records are stored.
+
+        """
+
+        image_id = self._batch_image_id(image)
+
+        # Note the casts to Python's built-in types: SQLite does not support
+        # NumPy integers and floats, which is what we will usually get here.
+        rows = [
+            (int(star_id), image_id, float(magnitude), float(snr))
+            for star_id, magnitude, snr in rows
+        ]
+        stmt = "INSERT INTO photometry VALUES (?, ?, ?, ?)"
+        self._insert_batch(stmt, rows, image, "photometry", star_index=0)
+
+    def add_pm_correction_batch(self, image, rows):
+        """Store the proper-motion corrections of many stars in the same image.
+
+        Equivalent to calling add_pm_correction() for each (star_id, pm_x, pm_y)
+        three-element tuple in 'rows', all of them for 'image', an Image object
+        previously added to the database, but looking up the image and the
+        stars only once. Raises the same exceptions as add_pm_correction(),
+        except that a second correction for the same star and image raises
+        DuplicatePhotometryError, in which case none of the rows are stored.
+
+        """
+
+        image_id = self._batch_image_id(image)
+        rows = [
+            (None, int(star_id), image_id, float(pm_x), float(pm_y))
+            for star_id, pm_x, pm_y in rows
+        ]
+
+        no_pm_ids = self._no_pm_star_ids
+        for row in rows:
+            if row[1] in no_pm_ids:
+                msg = (
+                    "astronomical object with ID = %d does not have proper "
+                    "motions, so we cannot store proper-motion corrections "
+                    "for it. Where do these values come from?" % row[1]
+                )
+                raise ValueError(msg)
+
+        stmt = "INSERT INTO pm_corrections VALUES (?, ?, ?, ?, ?)"
+        self._insert_batch(stmt, rows, image, "proper-motion correction")
+
+    def add_pparams_photometry(
+        self, star_id, unix_time, pfilter, pparams, magnitude, snr
+    ):
+        """Store the photometric record of a star for a set of parameters.
+
+        Equivalent to add_photometry(), but the record is stored along with the
+        PhotometricParameters 'pparams' with which photometry was done, in a
+        separate table, so that records for different sets of parameters can
+        coexist for the same star and image. These records are not returned
+        by get_photometry() until use_pparams() is called. Raises the same
+        exceptions as add_photometry(): DuplicatePhotometryError, in this
+        case, if a second record is added for the same star, image and set of
+        photometric parameters.
+
+        """
+
+        try:
+            # Raises KeyError if no image has this Unix time and filter
+            image_id = self._get_image_id(unix_time, pfilter)
+            pparams_id = self._add_pparams(pparams)
+
+            args = float(magnitude), float(snr)
+            t = (star_id, image_id, pparams_id) + args
+            self._execute("INSERT INTO pparams_photometry VALUES (?, ?, ?, ?, ?)", t)
+
+        except KeyError, e:
+            raise UnknownImageError(str(e))
+
+        except sqlite3.IntegrityError:
+            if star_id not in self._star_ids:
+                msg = "star with ID = %d not in database" % star_id
+                raise UnknownStarError(msg)
+
+            msg = (
+                "photometry for star ID = %d, Unix time = %4.f (%s), "
+                "filter %s and %s already in database"
+            )
+            args = (star_id, unix_time, util.utctime(unix_time), pfilter, pparams)
+            raise DuplicatePhotometryError(msg % args)
+
+    def add_pparams_photometry_batch(self, image, pparams, rows):
+        """Store the photometric records of many stars for a set of parameters.
+
+        The counterpart of add_photometry_batch() for add_pparams_photometry():
+        store, for the PhotometricParameters 'pparams', each (star_id,
+        magnitude, snr) three-element tuple in 'rows', all of them for the
+        Image 'image'. Raises the same exceptions as add_pparams_photometry(),
+        in which case none of the records are stored.
+
+        """
+
+        image_id = self._batch_image_id(image)
+        pparams_id = self._add_pparams(pparams)
+        rows = [
+            (int(star_id), image_id, pparams_id, float(magnitude), float(snr))
+            for star_id, magnitude, snr in rows
+        ]
+        stmt = "INSERT INTO pparams_photometry VALUES (?, ?, ?, ?, ?)"
+        what = "photometry for %s" % (pparams,)
+        self._insert_batch(stmt, rows, image, what, star_index=0)
+
+    @property
+    def pparams(self):
+        """Return the sets of photometric parameters with stored photometry.
+
+        Return a list of the PhotometricParameters for which records have been
+        stored with add_pparams_photometry(), sorted by their aperture, annulus
+        and dannulus. Any of them can be passed to use_pparams().
+
+        """
+
+        self._execute(
+            "SELECT aperture, annulus, dannulus "
+            "FROM photometric_parameters "
+            "WHERE id IN (SELECT DISTINCT pparams_id FROM pparams_photometry) "
+            "ORDER BY aperture, annulus, dannulus"
+        )
+        return [PhotometricParameters(*args) for args in self._rows]
+
+    def use_pparams(self, pparams):
+        """Make get_photometry() return the photometry of these parameters.
+
+        Replace all the records in the PHOTOMETRY table with those stored with
+        add_pparams_photometry() for the PhotometricParameters 'pparams'. This
+        allows us to do photometry once, with multiple apertures, and then run
+        diffphot on each of them. The previous records in PHOTOMETRY are lost,
+        so they must also have been stored with add_pparams_photometry() if we
+        want to be able to go back to them. Raises KeyError if there are no
+        records for 'pparams' in the database.
+
+        """
+
+        if pparams not in self.pparams:
+            raise KeyError("no photometry for %s in database" % (pparams,))
+
+        mark = self._savepoint()
+        try:
+            pparams_id = self._add_pparams(pparams)
+            self._execute("DELETE FROM photometry")
+            self._execute(
+                "INSERT INTO photometry "
+                "SELECT star_id, image_id, magnitude, snr "
+                "FROM pparams_photometry "
+                "WHERE pparams_id = ?",
+                (pparams_id,),
+            )
+        except:
+            self._rollback_to(mark)
+            self._release(mark)
+            raise
+
+        self._release(mark)
+
     def get_photometry(self, star_id, pfilter):
         """Return the photometric information of the star.
 
@@ -1251,7 +1905,7 @@ class LEMONdB(object):
 
         """
 
-        if star_id not in self.star_ids:
+        if star_id not in self._star_ids:
             msg = "star with ID = %d not in database" % star_id
             raise KeyError(msg)
 
@@ -1261,7 +1915,7 @@ class LEMONdB(object):
         t = (int(star_id), hash(pfilter))
         self._execute(
             "SELECT img.unix_time, phot.magnitude, phot.snr "
-            "FROM photometry AS phot INDEXED BY phot_by_star_image, "
+            "FROM photometry AS phot, "
             "     images AS img INDEXED BY img_by_filter_time "
             "ON phot.image_id = img.id "
             "WHERE phot.star_id = ? "
@@ -1273,6 +1927,74 @@ class LEMONdB(object):
         args = star_id, pfilter, list(self._rows)
         return DBStar.make_star(*args, dtype=self.dtype)
 
+    def get_photometry_matrix(self, pfilter):
+        """Return the photometric information of all the stars in a filter.
+
+        Load with a single query the photometry of all the stars in the images
+        taken in the photometric filter 'pfilter', much faster than calling
+        get_photometry() for each star. Returns a PhotometryMatrix namedtuple
+        with a row for each star, sorted by their ID, and a column for each
+        image in the filter, sorted by their Unix time. Entries for which there
+        is no photometry are NaN in both 'magnitudes' and 'snrs', and False in
+        'mask'. DBStar.from_matrix() returns the DBStar of any of the rows.
+
+        """
+
+        self._execute(
+            "SELECT id, unix_time "
+            "FROM images INDEXED BY img_by_filter_time "
+            "WHERE filter_id = ? "
+            "ORDER BY unix_time ASC",
+            (hash(pfilter),),
+        )
+        images = numpy.array(self._rows.fetchall(), dtype=numpy.float64)
+        images = images.reshape(-1, 2)
+        image_ids = images[:, 0].astype(numpy.int64)
+        unix_times = images[:, 1]
+        star_ids = numpy.array(self.star_ids, dtype=numpy.int64)
+
+        # SQLite stores REAL values as 64-bit floats, so nothing is gained by
+        # keeping the matrix in self.dtype, which would take twice as much
+        # memory if it is numpy.longdouble: the magnitudes and SNRs are cast
+        # to self.dtype when the DBStars are built (see DBStar.from_matrix).
+        shape = len(star_ids), len(image_ids)
+        magnitudes = numpy.empty(shape, dtype=numpy.float64)
+        magnitudes.fill(numpy.nan)
+        snrs = magnitudes.copy()
+        mask = numpy.zeros(shape, dtype=bool)
+
+        # The order of the records does not matter, so SQLite is free to scan
+        # PHOTOMETRY once without sorting anything, even within bulk_load(),
+        # which drops the index on the image ID. Map the star and image IDs to
+        # the indexes of their row and column with a binary search on the IDs.
+        # The records are read in chunks, instead of with fetchall(), so that
+        # they are never all in memory at once as a list of Python tuples.
+        self._execute(
+            "SELECT phot.star_id, phot.image_id, phot.magnitude, phot.snr "
+            "FROM photometry AS phot "
+            "INNER JOIN images AS img "
+            "ON phot.image_id = img.id "
+            "WHERE img.filter_id = ?",
+            (hash(pfilter),),
+        )
+
+        order = numpy.argsort(image_ids)
+        while True:
+            chunk = self._rows.fetchmany(self.FETCH_SIZE)
+            if not chunk:
+                break
+            records = numpy.array(chunk, dtype=numpy.float64)
+            rows = numpy.searchsorted(star_ids, records[:, 0].astype(numpy.int64))
+            columns = records[:, 1].astype(numpy.int64)
+            columns = order[numpy.searchsorted(image_ids, columns, sorter=order)]
+            magnitudes[rows, columns] = records[:, 2]
+            snrs[rows, columns] = records[:, 3]
+            mask[rows, columns] = True
+
+        presence = numpy.packbits(mask, axis=1)
+        args = magnitudes, snrs, mask, star_ids, unix_times, presence
+        return PhotometryMatrix(*args)
+
     def _star_pfilters(self, star_id):
         """Return the photometric filters for which the star has data.
 
@@ -1283,7 +2005,7 @@ class LEMONdB(object):
 
         """
 
-        if star_id not in self.star_ids:
+        if star_id not in self._star_ids:
             msg = "star with ID = %d not in database" % star_id
             raise KeyError(msg)
 
@@ -1291,7 +2013,7 @@ class LEMONdB(object):
         self._execute(
             """SELECT DISTINCT f.name
                          FROM (SELECT DISTINCT image_id
-                               FROM photometry INDEXED BY phot_by_star_image
+                               FROM photometry
                                WHERE star_id = ?) AS phot
                          INNER JOIN images AS img
                          ON phot.image_id = img.id
@@ -1347,14 +2069,14 @@ class LEMONdB(object):
             # Note the casts to Python's built-in float. Otherwise, if the
             # method gets a NumPy float, SQLite raises "sqlite3.InterfaceError:
             # Error binding parameter - probably unsupported type"
-            t = (None, star_id, image_id, float(magnitude), float(snr))
-            self._execute("INSERT INTO light_curves " "VALUES (?, ?, ?, ?, ?)", t)
+            t = (star_id, image_id, float(magnitude), float(snr))
+            self._execute("INSERT INTO light_curves " "VALUES (?, ?, ?, ?)", t)
 
         except KeyError, e:
             raise UnknownImageError(str(e))
 
         except sqlite3.IntegrityError:
-            if not star_id in self.star_ids:
+            if star_id not in self._star_ids:
                 msg = "star with ID = %d not in database" % star_id
                 raise UnknownStarError(msg)
 
@@ -1365,53 +2087,12 @@ class LEMONdB(object):
             args = (star_id, unix_time, util.utctime(unix_time), pfilter)
             raise DuplicateLightCurvePointError(msg % args)
 
-    def _add_cmp_star(self, star_id, pfilter, cstar_id, cweight, cstdev):
-        """Add a comparison star to the light curve of a star.
-
-        The method stores 'cstar_id' as the ID of one of the comparison stars
-        (with a light curve standard deviation 'cstdev' and the corresponding
-        weight 'cweight') that were used to compute the light curve of the star
-        with ID 'star_id' in the 'pfilter' photometric filter.
-
-        Raises UnknownStarError if either 'star_id' or 'cstar_id' do not match
-        the ID of any of the stars in the database. Since a star cannot use
-        itself as a comparison star, ValueError is thrown in case the value of
-        'star_id' is equal to 'cstar_id'.
-
-        """
-
-        if star_id == cstar_id:
-            msg = "star with ID = %d cannot use itself as comparison" % star_id
-            raise ValueError(msg)
-
-        mark = self._savepoint()
-        try:
-            self._add_pfilter(pfilter)
-            # Note the casts to Python's built-in float. Otherwise, if the
-            # method gets a NumPy float, SQLite raises "sqlite3.InterfaceError:
-            # Error binding parameter - probably unsupported type"
-            cweight = float(cweight)
-            cstdev = float(cstdev)
-            t = (None, star_id, hash(pfilter), cstar_id, cstdev, cweight)
-            self._execute("INSERT INTO cmp_stars " "VALUES (?, ?, ?, ?, ?, ?)", t)
-            self._release(mark)
-
-        except sqlite3.IntegrityError:
-            self._rollback_to(mark)
-            if star_id not in self.star_ids:
-                msg = "star with ID = %d not in database" % star_id
-                raise UnknownStarError(msg)
-            else:
-                msg = "comparison star with ID = %d not in database" % cstar_id
-                raise UnknownStarError(msg)
-
     def add_light_curve(self, star_id, light_curve):
         """Store the light curve of a star.
 
         The database is modified atomically, so in case an error is encountered
-        it is left untouched. There are four different exceptions, propagated
-        from the LEMONdB._add_curve_point and LEMONdB._add_cmp_star methods,
-        that may be raised:
+        it is left untouched. There are four different exceptions that may be
+        raised:
 
         (1) UnknownStarError if either the star or any of its comparison stars
         are not stored in the database. Thus, LEMONdB.add_star must have been
@@ -1433,18 +2114,90 @@ class LEMONdB(object):
 
         """
 
+        self.add_light_curves([(star_id, light_curve)])
+
+    def add_light_curves(self, curves):
+        """Store the light curves of many stars at once.
+
+        Equivalent to calling add_light_curve() for each (star_id, light_curve)
+        two-element tuple in 'curves', but much faster: the points and the
+        comparison stars of all the light curves are inserted with two calls to
+        executemany(), within a single savepoint, and the integrity checks are
+        done only once. The database is modified atomically, so none of the
+        light curves are stored if any of them cannot be. Raises the same four
+        exceptions as add_light_curve().
+
+        """
+
+        curves = list(curves)
         mark = self._savepoint()
         try:
-            for unix_time, magnitude, snr in light_curve:
-                args = star_id, unix_time, light_curve.pfilter, magnitude, snr
-                self._add_curve_point(*args)
-            for weight in light_curve.weights():
-                self._add_cmp_star(star_id, light_curve.pfilter, *weight)
-            self._release(mark)
+            points = []
+            cstars = []
+            # Map each filter ID to a dictionary with the image ID of each Unix
+            # time: the light curves usually have points for the same images.
+            image_ids = {}
+            for star_id, light_curve in curves:
+                pfilter = light_curve.pfilter
+                filter_id = hash(pfilter)
+                if filter_id not in image_ids:
+                    self._add_pfilter(pfilter)
+                    image_ids[filter_id] = {}
+                filter_image_ids = image_ids[filter_id]
+
+                for unix_time, magnitude, snr in light_curve:
+                    image_id = filter_image_ids.get(unix_time)
+                    if image_id is None:
+                        try:
+                            # Raises KeyError if no image has this date and filter
+                            image_id = self._get_image_id(unix_time, pfilter)
+                        except KeyError, e:
+                            raise UnknownImageError(str(e))
+                        filter_image_ids[unix_time] = image_id
+
+                    # Note the casts to Python's built-in float. Otherwise, if
+                    # we get NumPy floats, SQLite raises "InterfaceError: Error
+                    # binding parameter - probably unsupported type"
+                    t = (star_id, image_id, float(magnitude), float(snr))
+                    points.append(t)
+
+                for cstar_id, cweight, cstdev in light_curve.weights():
+                    if star_id == cstar_id:
+                        msg = "star with ID = %d cannot use itself as comparison"
+                        raise ValueError(msg % star_id)
+                    cweight, cstdev = float(cweight), float(cstdev)
+                    t = (None, star_id, filter_id, cstar_id, cstdev, cweight)
+                    cstars.append(t)
+
+            try:
+                stmt = "INSERT INTO light_curves VALUES (?, ?, ?, ?)"
+                self._executemany(stmt, points)
+                stmt = "INSERT INTO cmp_stars VALUES (?, ?, ?, ?, ?, ?)"
+                self._executemany(stmt, cstars)
+            except sqlite3.IntegrityError:
+                star_ids = self._star_ids
+                for star_id, light_curve in curves:
+                    if star_id not in star_ids:
+                        msg = "star with ID = %d not in database" % star_id
+                        raise UnknownStarError(msg)
+                    for cstar_id in light_curve.cstars:
+                        if cstar_id not in star_ids:
+                            msg = "comparison star with ID = %d not in database"
+                            raise UnknownStarError(msg % cstar_id)
+
+                msg = (
+                    "light curve points for one or more stars already in "
+                    "database, or more than one for the same image"
+                )
+                raise DuplicateLightCurvePointError(msg)
+
         except:
             self._rollback_to(mark)
+            self._release(mark)
             raise
 
+        self._release(mark)
+
     def get_light_curve(self, star_id, pfilter):
         """Return the light curve of a star.
 
@@ -1469,7 +2222,7 @@ class LEMONdB(object):
         t = (star_id, hash(pfilter))
         self._execute(
             "SELECT img.unix_time, curve.magnitude, curve.snr "
-            "FROM light_curves AS curve INDEXED BY curve_by_star_image, "
+            "FROM light_curves AS curve, "
             "     images AS img INDEXED BY img_by_filter_time "
             "ON curve.image_id = img.id "
             "WHERE curve.star_id = ? "
@@ -1499,17 +2252,16 @@ class LEMONdB(object):
                 cstars, cweights, cstdevs = zip(*rows)
 
         else:
-            if star_id not in self.star_ids:
+            if star_id not in self._star_ids:
                 msg = err_msg + "not in database"
                 raise KeyError(msg)
 
             # No curve in the database for this star and filter
             return None
 
-        curve = LightCurve(pfilter, cstars, cweights, cstdevs, dtype=self.dtype)
-        for point in curve_points:
-            curve.add(*point)
-        return curve
+        # SQLite gives us the points already sorted chronologically
+        args = pfilter, cstars, cweights, cstdevs, curve_points
+        return LightCurve.from_sorted_points(*args, dtype=self.dtype)
 
     def get_instrumental_magnitudes(self, star_id, pfilter):
         """Return the instrumental magnitudes of an astronomical object.
@@ -1771,6 +2523,70 @@ class LEMONdB(object):
         os.close(fd)
         return path
 
+    def stars_within_radius(self, ra, dec, radius):
+        """Find the stars within an angular distance of some coordinates.
+
+        Return a list of two-element tuples with the ID of each star in the
+        LEMONdB whose angular distance to the right ascension and declination
+        (ra, dec) is at most 'radius' degrees, and the said distance, sorted by
+        the latter. Only the stars in the band of declinations from dec -
+        radius to dec + radius are read from the database, using the index on
+        the DEC column, so the smaller the radius the faster the search.
+
+        """
+
+        query = "SELECT id, ra, dec FROM stars WHERE dec BETWEEN ? AND ?"
+        t = (dec - radius, dec + radius)
+
+        # Unless the circle includes one of the poles, the right ascensions in
+        # it are also bounded, which saves us from reading most of the band.
+        # [http://janmatuschek.de/LatitudeLongitudeBoundingCoordinates]
+        if abs(dec) + radius < 90:
+            x = math.sin(math.radians(radius)) / math.cos(math.radians(dec))
+            delta = math.degrees(math.asin(x))
+            min_ra, max_ra = (ra - delta) % 360, (ra + delta) % 360
+            # The right ascension wraps around if the circle crosses RA = 0
+            operator = "AND" if min_ra <= max_ra else "OR"
+            query += " AND (ra >= ? %s ra <= ?)" % operator
+            t += (min_ra, max_ra)
+
+        self._execute(query, t)
+
+        rows = self._rows.fetchall()
+        if not rows:
+            return []
+
+        star_ids, ras, decs = zip(*rows)
+        distances = astromatic.angular_distance(ra, dec, ras, decs)
+        star_ids = numpy.array(star_ids)
+        inside = distances <= radius
+        star_ids = star_ids[inside]
+        distances = distances[inside]
+        # Sort by distance and, for equidistant stars, by their ID
+        order = numpy.lexsort((star_ids, distances))
+        return zip(star_ids[order].tolist(), distances[order])
+
+    def stars_closest_to_world_coords(self, ra, dec, how_many):
+        """Find the 'how_many' stars closest to a right ascension and declination.
+
+        Return a list of two-element tuples with the ID of each one of the
+        'how_many' stars in the LEMONdB closest to the coordinates (ra, dec)
+        and its angular distance to them, in degrees, sorted by the latter.
+        There may be fewer than 'how_many' tuples if there are not enough stars
+        in the LEMONdB. The stars are searched for with stars_within_radius(),
+        in a radius that starts at SEARCH_RADIUS and is multiplied by four
+        until it includes enough stars: any star that could be closer than
+        them would have also been found, as it would be within the radius.
+
+        """
+
+        radius = self.SEARCH_RADIUS
+        while True:
+            stars = self.stars_within_radius(ra, dec, radius)
+            if len(stars) >= how_many or radius >= 180:
+                return stars[:how_many]
+            radius *= 4
+
     def star_closest_to_world_coords(self, ra, dec):
         """Find the star closest to a right ascension and declination.
 
@@ -1782,22 +2598,10 @@ class LEMONdB(object):
 
         """
 
-        if not len(self):
+        stars = self.stars_closest_to_world_coords(ra, dec, 1)
+        if not stars:
             raise ValueError("database is empty")
-
-        self._execute("SELECT id, ra, dec FROM stars")
-
-        closest_id = None
-        closest_distance = float("inf")
-        coordinates = astromatic.Coordinates(ra, dec)
-        for star_id, star_ra, star_dec in self._rows:
-            star_coords = astromatic.Coordinates(star_ra, star_dec)
-            star_distance = coordinates.distance(star_coords)
-            if star_distance < closest_distance:
-                closest_id = star_id
-                closest_distance = star_distance
-
-        return closest_id, closest_distance
+        return stars[0]
 
 
 def _add_metadata_property(name):
@@ -21,6 +21,7 @@
 """ Definition of the default options used by the different modules """
 
 import multiprocessing
+import os.path
 
 # LEMON modules
 import setup
@@ -73,6 +74,28 @@ desc["mean"] = (
     "instead of the median. So you say you prefer a non-robust statistic?"
 )
 
+fwhm_cache = os.path.expanduser("~/.lemon_fwhm_cache")
+desc["fwhm_cache"] = (
+    "the SQLite database where the FWHM of the FITS images that do not have "
+    "it in their header is cached, so that it does not have to be computed "
+    "again the next time that these images are used. Each FWHM is stored "
+    "along with the checksum of the pixels of its image and the parameters "
+    "with which it was computed, so the same cache can be safely shared by "
+    "different observing campaigns. Use an empty string in order to disable "
+    "the cache [default: %default]"
+)
+
+header_index = None
+desc["header_index"] = (
+    "the SQLite database, such as a file in the directory of the observing "
+    "campaign, where the headers of the FITS images, and some of the values "
+    "parsed from them (such as the date of observation or the photometric "
+    "filter), are indexed, so that they do not have to be read from disk and "
+    "parsed again the next time that these images are used. An image is "
+    "indexed again if its modification time or size change. By default, no "
+    "index is used"
+)
+
 desc["filter"] = (
     "The supported systems are Johnson, Cousins, Gunn, SDSS, 2MASS, Stromgren "
     "and H-alpha, but letters, designating a particular section of the "
@@ -43,6 +43,7 @@ that the former is brighter than the latter.
 """
 
 import copy
+import hashlib
 import logging
 import optparse
 import os
@@ -63,6 +64,18 @@ import defaults
 import snr
 import style
 
+# How many light curves are stored in the LEMONdB at once
+CURVES_BATCH_SIZE = 1000
+
+
+def store_light_curves(db, curves):
+    """ Store the (star ID, light curve) two-element tuples in the LEMONdB """
+
+    logging.debug("Storing %d light curves in database" % len(curves))
+    db.add_light_curves(curves)
+    star_ids = ", ".join(str(star_id) for star_id, _ in curves)
+    logging.debug("Light curves for stars %s successfully stored" % star_ids)
+
 
 def percentage_change(old, new):
     """Return the relative change between the old value and the new one.
@@ -361,21 +374,14 @@ class StarSet(object):
         """
 
         # Bi-dimensional matrix (as many rows as stars, as many columns as
-        # images) in which the normalized magnitude of the stars are stored
-        norm_mags = numpy.empty((len(self), self.nimages), dtype=self.dtype)
-
-        # For each image (third dimension of self._phot_info), normalize the
-        # magnitudes (second dimension, x = 0) of each star (first dimension).
-        # That is: the magnitudes for all the stars in the image are divided
-        # by the maximum magnitude.
-        for image_index in xrange(self.nimages):
-            image_mags = self._phot_info[:, 0, image_index]
-            norm_mags[:, image_index] = image_mags / image_mags.max()
+        # images) with the magnitudes of the stars. For each image (column),
+        # normalize the magnitudes: that is, the magnitudes of all the stars
+        # in the image are divided by the maximum magnitude.
+        mags = self._phot_info[:, 0, :]
+        norm_mags = mags / mags.max(axis=0)
 
         # Now, for each star, calculate the median of the normalized magnitudes
-        mag_medians = numpy.empty(len(self), dtype=self.dtype)
-        for star_index in xrange(len(self)):
-            mag_medians[star_index] = numpy.median(norm_mags[star_index])
+        mag_medians = numpy.median(norm_mags, axis=1)
 
         pogsonr = 100 ** 0.2  # fifth root of 100 (Pogson's Ratio)
         return Weights.inversely_proportional(pogsonr ** mag_medians)
@@ -402,17 +408,13 @@ class StarSet(object):
         returned by the DBStar.complete_for method, which identifies precisely
         the DBStars that can be used as the artificial comparison star.
 
-        The calculation of the signal-to-noise ratio of each differential
-        magnitude is, being currently written in pure Python, considerably
-        slow. It is barely noticeable when a few conversions from SNR to error
-        in magnitudes (or vice versa) are done, but when invoked thousands of
-        times it causes an unbearable performance hit. Until the 'snr' module
-        is rewritten in C, the 'no_snr' keyword argument, if set to True, will
-        make the method skip the calculation of the differential SNRs, using
-        None instead. This is probably only needed by StarSet.broeg_weights,
-        which does not care about the signal-to-noise ratios, but only the
-        standard deviation of the light curves, and can therefore avoid
-        computing them.
+        The differential magnitudes and their signal-to-noise ratios are
+        computed for all the images at once, as NumPy array operations. The
+        'no_snr' keyword argument, if set to True, makes the method skip the
+        calculation of the differential SNRs, using None instead. This is
+        probably only needed by StarSet.broeg_weights, which does not care
+        about the signal-to-noise ratios, but only the standard deviation of
+        the light curves, and can therefore avoid computing them.
 
         If specified, the '_exclude_index' argument determines the index of the
         star in the set that will not be used as comparison star, regardless of
@@ -455,22 +457,41 @@ class StarSet(object):
         args = self.pfilter, self.star_ids, rweights, cstdevs
         curve = database.LightCurve(*args, dtype=self.dtype)
 
-        for index, unix_time in enumerate(self._unix_times):
-            # The magnitude and SNR of the comparison star
-            cmags = self._phot_info[:, 0, index]
-            csnrs = self._phot_info[:, 1, index]
-            cmag = numpy.average(cmags, weights=rweights)
-            csnr = None if no_snr else snr.mean_snr(csnrs, weights=rweights)
+        # The magnitudes and SNRs of the comparison star, for all the images at
+        # once: the weighted average of the rows of the comparison stars.
+        cweights = numpy.asarray(rweights, dtype=self.dtype)
+        cmags = numpy.dot(cweights, self._phot_info[:, 0, :]) / cweights.sum()
+        dmags = star._phot_info[1] - cmags
 
-            smag = star.mag(index)
-            ssnr = star.snr(index)
-
-            dmag = smag - cmag
-            dsnr = None if no_snr else snr.difference_snr(ssnr, csnr)
-            curve.add(unix_time, dmag, dsnr)
+        if no_snr:
+            dsnrs = None
+        else:
+            csnrs = snr.mean_snrs(self._phot_info[:, 1, :], cweights)
+            dsnrs = snr.difference_snrs(star._phot_info[2], csnrs)
 
+        curve.add_many(self._unix_times, dmags, dsnrs)
         return curve
 
+    def _leave_one_out_stdevs(self, weights):
+        """Return the standard deviation of the light curve of each star.
+
+        Compute, for each star in the set, the standard deviation of its light
+        curve when all the other stars are used as comparison, with the weights
+        rescaled to exclude it. This is what StarSet.light_curve would return
+        using _exclude_index, but for all the stars in a single step: the
+        comparison star of the i-th star is the weighted sum of all the stars
+        minus the contribution of the i-th one, divided by the sum of the
+        remaining weights. Returns a NumPy array with a value for each star.
+
+        """
+
+        weights = numpy.asarray(weights, dtype=self.dtype)
+        mags = self._phot_info[:, 0, :]
+        totals = numpy.dot(weights, mags)
+        cmags = totals - weights[:, None] * mags
+        cmags /= (weights.sum() - weights)[:, None]
+        return numpy.std(mags - cmags, axis=1)
+
     def broeg_weights(self, pct=0.01, max_iters=None, minimum=None):
         """Determine the weights that give the optimum comparison star.
 
@@ -552,19 +573,13 @@ class StarSet(object):
         # weights. The standard deviation of the light curve that results from
         # using these (rescaled) weights is used in order to compute the new
         # weights for each star. We stop when the absolute percent change
-        # between the old weights and the new one is below the threshold
+        # between the old weights and the new one is below the threshold. The
+        # light curves are not actually built: StarSet._leave_one_out_stdevs
+        # computes their standard deviations for all the stars at once.
 
         weights = [self.flux_proportional_weights()]
-        curves_stdevs = numpy.empty(len(self), dtype=self.dtype)
         for iteration in xrange(max_iters or sys.getrecursionlimit()):
-            for star_index in xrange(len(self)):
-                star_curve = self.light_curve(
-                    weights[-1],
-                    self[star_index],
-                    _exclude_index=star_index,
-                    no_snr=True,
-                )
-                curves_stdevs[star_index] = star_curve.stdev
+            curves_stdevs = self._leave_one_out_stdevs(weights[-1])
 
             # Avoid the division by zero if, somehow, a star ends up having a
             # standard deviation of zero, as Weights.inversely_proportional
@@ -728,11 +743,70 @@ class StarSet(object):
         return set_
 
 
+class ComparisonCache(object):
+    """A cache of the values computed for each set of comparison stars.
+
+    In a typical campaign most stars are observed in exactly the same images,
+    so the best comparison stars of many of them end up being the same, and
+    their Broeg weights are computed again and again on identical data. Values
+    are stored under a key that identifies the photometric information from
+    which they were computed: the Unix times of the star whose light curve is
+    generated and the IDs of the comparison stars. A value is thus only reused
+    when computing it again would give exactly the same result. The hits and
+    misses are counted, so that the hit rate can be logged.
+
+    """
+
+    def __init__(self):
+        self._values = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(unix_times, star_ids):
+        """ Return the key for some stars trimmed to these Unix times """
+
+        sha1 = hashlib.sha1()
+        sha1.update(numpy.asarray(unix_times, dtype=numpy.float64).tostring())
+        sha1.update(numpy.asarray(star_ids, dtype=numpy.int64).tostring())
+        return sha1.hexdigest()
+
+    def get(self, key):
+        """ Return the value stored under 'key', or None if there is none """
+
+        value = self._values.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+
+    @property
+    def hit_rate(self):
+        """ The fraction of the lookups that found a value in the cache """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
 # The Queue is global -- this works, but note that we could have
 # passed its reference to the function managed by pool.map_async.
 # See http://stackoverflow.com/a/3217427/184363
 queue = util.Queue()
 
+# The photometry of the filter whose light curves are being generated, as
+# returned by LEMONdB.get_photometry_matrix(). main() loads it before creating
+# the pool of workers, which inherit it when forked: in this manner, they only
+# receive the index of each star, instead of a copy of the photometry of all
+# the stars being pickled for each task.
+photometry_matrix = None
+
+# The Broeg weights of the comparison stars of each light curve. Each process
+# of the pool has its own copy, shared by all the curves that it computes.
+broeg_weights_cache = ComparisonCache()
+
 
 @util.print_exception_traceback
 def parallel_light_curves(args):
@@ -741,11 +815,15 @@ def parallel_light_curves(args):
     Functions defined in classes don't pickle, so we have moved this code here
     in order to be able to use it with multiprocessing's map_async. As it
     receives a single argument, values are passed in a tuple which is then
-    unpacked.
+    unpacked: the index of the star in the module-level photometry_matrix, its
+    photometric filter, the data type of the LEMONdB and the command-line
+    options.
 
     """
 
-    star, all_stars, options = args
+    index, pfilter, dtype, options = args
+    matrix = photometry_matrix
+    star = database.DBStar.from_matrix(matrix, index, pfilter, dtype)
     logging.debug(
         "Star %d: photometry on %d images, enforced minimum of %d"
         % (star.id, len(star), options.min_images)
@@ -759,7 +837,7 @@ def parallel_light_curves(args):
         queue.put((star.id, None))
         return
 
-    complete_for = star.complete_for(all_stars)
+    complete_for = star.complete_for_matrix(matrix)
     logging.debug(
         "Star %d: %d complete stars, enforced minimum = %d"
         % (star.id, len(complete_for), options.min_cstars)
@@ -810,8 +888,22 @@ def parallel_light_curves(args):
         "Star %d: best stars IDs: %s" % (star.id, [x.id for x in comparison_stars])
     )
 
-    cweights = comparison_stars.broeg_weights(
-        pct=options.pct, minimum=options.wminimum, max_iters=options.max_iters
+    key = ComparisonCache.key(star._unix_times, comparison_stars.star_ids)
+    cweights = broeg_weights_cache.get(key)
+    if cweights is None:
+        cweights = comparison_stars.broeg_weights(
+            pct=options.pct, minimum=options.wminimum, max_iters=options.max_iters
+        )
+        broeg_weights_cache[key] = cweights
+
+    logging.debug(
+        "Star %d: Broeg weights cache hit rate = %.2f%% (%d hits, %d misses)"
+        % (
+            star.id,
+            broeg_weights_cache.hit_rate * 100,
+            broeg_weights_cache.hits,
+            broeg_weights_cache.misses,
+        )
     )
 
     logging.debug("Star %d: Broeg weights: %s" % (star.id, str(cweights)))
@@ -1031,7 +1123,15 @@ def main(arguments=None):
         nstars = len(db)
         print "%sThere are %d stars in the database" % (style.prefix, nstars)
 
-        for pfilter in sorted(db.pfilters):
+        def filter_light_curves(pfilter):
+            """Generate and store the light curves of a photometric filter.
+
+            Compute in parallel the light curves of all the stars observed in
+            the 'pfilter' photometric filter, and store them in the LEMONdB.
+
+            """
+
+            global photometry_matrix
 
             print style.prefix
             print "%sLight curves for the %s filter will now be generated." % (
@@ -1040,19 +1140,24 @@ def main(arguments=None):
             )
             print "%sLoading photometric information..." % style.prefix,
             sys.stdout.flush()
-            all_stars = [db.get_photometry(star_id, pfilter) for star_id in db.star_ids]
+            photometry_matrix = db.get_photometry_matrix(pfilter)
+            nstars = len(photometry_matrix.star_ids)
             print "done."
 
             # The generation of each light curve is a task independent from the
             # others, so we can use a pool of workers and do it in parallel.
+            # The workers are forked now, after photometry_matrix was loaded,
+            # so they share it and only the index of each star is pickled.
             pool = multiprocessing.Pool(options.ncores)
-            map_async_args = ((star, all_stars, options) for star in all_stars)
+            map_async_args = (
+                (index, pfilter, db.dtype, options) for index in xrange(nstars)
+            )
             result = pool.map_async(parallel_light_curves, map_async_args)
 
             util.show_progress(0.0)
             while not result.ready():
                 time.sleep(1)
-                util.show_progress(queue.qsize() / len(all_stars) * 100)
+                util.show_progress(queue.qsize() / nstars * 100)
                 # Do not update the progress bar when debugging; instead, print it
                 # on a new line each time. This prevents the next logging message,
                 # if any, from being printed on the same line that the bar.
@@ -1068,6 +1173,7 @@ def main(arguments=None):
             print "%sStoring the light curves in the database..." % style.prefix
             util.show_progress(0)
             light_curves = (queue.get() for x in xrange(queue.qsize()))
+            batch = []
             for index, (star_id, curve) in enumerate(light_curves):
 
                 # NoneType is returned by parallel_light_curves when the light
@@ -1080,15 +1186,19 @@ def main(arguments=None):
                     )
                     continue
 
-                logging.debug("Storing light curve for star %d in database" % star_id)
-                db.add_light_curve(star_id, curve)
-                logging.debug("Light curve for star %d successfully stored" % star_id)
+                # Store the light curves in batches, much faster than one
+                # by one, with LEMONdB.add_light_curve()
+                batch.append((star_id, curve))
+                if len(batch) == CURVES_BATCH_SIZE:
+                    store_light_curves(db, batch)
+                    batch = []
 
-                util.show_progress(100 * (index + 1) / len(all_stars))
+                util.show_progress(100 * (index + 1) / nstars)
                 if logging_level < logging.WARNING:
                     print
 
             else:
+                store_light_curves(db, batch)
                 logging.info("Light curves for %s generated" % pfilter)
                 logging.debug("Committing database transaction")
                 db.commit()
@@ -1097,9 +1207,24 @@ def main(arguments=None):
                 util.show_progress(100.0)
                 print
 
-        print "%sUpdating statistics about tables and indexes..." % style.prefix,
-        sys.stdout.flush()
-        db.analyze()
+            # The queue has been emptied, so the workers, which cannot exit
+            # until all the data that they put into it has been read, can be
+            # joined now. Their copy of the photometry is not kept alive while
+            # the light curves of the next filter are generated.
+            pool.close()
+            pool.join()
+
+        # Store the light curves in bulk-load mode: the indexes that it drops
+        # are built again on exit from the with statement, and then the
+        # statistics used by the query optimizer are updated with ANALYZE.
+        # LEMONdB.pfilters needs one of these indexes, so read it before.
+        pfilters = sorted(db.pfilters)
+        with db.bulk_load():
+            for pfilter in pfilters:
+                filter_light_curves(pfilter)
+
+            print "%sUpdating statistics about tables and indexes..." % style.prefix,
+            sys.stdout.flush()
         print "done."
 
         # Update LEMONdB metadata
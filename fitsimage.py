@@ -32,17 +32,21 @@ import astropy.io
 import astropy.wcs
 import calendar
 import collections
+import cPickle as pickle
 import datetime
 import fnmatch
+import functools
 import hashlib
 import itertools
 import logging
+import multiprocessing
 import numpy
 import numbers
 import os
 import os.path
 import pyfits
 import re
+import sqlite3
 import warnings
 
 # LEMON modules
@@ -70,6 +74,44 @@ class NoWCSInformationError(ValueError):
     pass
 
 
+# The HeaderIndex that FITSImage consults, if any: see use_header_index()
+header_index = None
+
+
+def indexed(method):
+    """Cache in the header index the values returned by a FITSImage method.
+
+    Decorator for the methods of FITSImage that parse values from the header
+    of the image, such as its date or photometric filter. If header_index is
+    not None, the value that the method returns, for these arguments, is
+    stored in it, so that it does not have to be computed again as long as
+    the FITS file is not modified. Exceptions are never cached.
+
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if header_index is None:
+            return method(self, *args, **kwargs)
+
+        name = _indexed_name(method, args, kwargs)
+        try:
+            return header_index.get(self.path, name)
+        except KeyError:
+            value = method(self, *args, **kwargs)
+            header_index.set(self.path, name, value)
+            return value
+
+    # For HeaderIndex.parsed_values(), which stores the values itself
+    wrapper.unindexed = method
+    return wrapper
+
+
+def _indexed_name(method, args, kwargs):
+    """ Return the name under which the header index stores a parsed value """
+    return "%s%r" % (method.__name__, (args, sorted(kwargs.iteritems())))
+
+
 class FITSImage(object):
     """ Encapsulates a FITS image located in the filesystem. """
 
@@ -77,9 +119,11 @@ class FITSImage(object):
         """Instantiation method for the FITSImage class.
 
         A copy of the header of the FITS file is kept in memory for fast access
-        to its keywords. IOError is raised if 'path' does not exist or is not
-        readable, and NonStardardFITS in case that it does not conform to the
-        FITS standard or it simply is not a FITS file at all.
+        to its keywords. The pixels are never read here: the size of the image
+        is taken from the NAXISn keywords, and the data is only loaded if the
+        FITSImage.data property is accessed. IOError is raised if 'path' does
+        not exist or is not readable, and NonStardardFITS in case that it does
+        not conform to the FITS standard or it simply is not a FITS file at all.
 
         FITS Standard Document:
         http://fits.gsfc.nasa.gov/fits_standard.html
@@ -106,6 +150,13 @@ class FITSImage(object):
 
         self.path = path
 
+        if header_index is not None:
+            try:
+                self._set_header(header_index.header(self.path))
+                return
+            except KeyError:
+                pass
+
         try:
             # The file must be opened to make sure it is a standard FITS.
             # We would rather use the with statement, but in that case we
@@ -144,10 +195,13 @@ class FITSImage(object):
                 # thousands of images ("too many open files" and such). This
                 # approach gives us fast read-only access to the image header;
                 # if modified, we will have to take care of 'reloading' (call
-                # it synchronize, if you wish) the header.
+                # it synchronize, if you wish) the header. Accessing the data of
+                # the HDU would read all the pixels from disk, so we do not even
+                # do that to learn the size of the image: that is what the NAXIS
+                # keywords are for. Scanning the headers of thousands of images
+                # is this way orders of magnitude faster.
 
-                self.size = handler[0].data.shape[::-1]
-                self._header = handler[0].header
+                self._set_header(handler[0].header)
             finally:
                 handler.close(output_verify="ignore")
 
@@ -167,6 +221,22 @@ class FITSImage(object):
                 msg = "%s (%s)" % (self.path, str(e))
                 raise NonStandardFITS(msg)
 
+        if header_index is not None:
+            header_index.add(self.path, self._header)
+
+    def _set_header(self, header):
+        """ Keep the header in memory and take the size from NAXISn """
+
+        naxis = header["NAXIS"]
+        self.size = tuple(header["NAXIS%d" % n] for n in xrange(1, naxis + 1))
+        self._header = header
+
+    def _discard_index(self):
+        """ Remove the image from the header index, after modifying it """
+
+        if header_index is not None:
+            header_index.discard(self.path)
+
     def __repr__(self):
         """ The unambiguous string representation of a FITSImage object """
         return "%s(%r)" % (self.__class__.__name__, self.path)
@@ -283,6 +353,7 @@ class FITSImage(object):
             handler.close(output_verify="ignore")
             msg = "%s: file closed" % self.path
             logging.debug(msg)
+            self._discard_index()
 
     def delete_keyword(self, keyword):
         """Delete a keyword from the header of the FITS image.
@@ -315,6 +386,7 @@ class FITSImage(object):
                 pass
         finally:
             handler.close(output_verify="ignore")
+            self._discard_index()
 
     def add_history(self, history):
         """Add another record to the history of the FITS image.
@@ -334,7 +406,9 @@ class FITSImage(object):
             header.add_history(history)
         finally:
             handler.close(output_verify="ignore")
+            self._discard_index()
 
+    @indexed
     def date(
         self, date_keyword="DATE-OBS", time_keyword="TIME-OBS", exp_keyword="EXPTIME"
     ):
@@ -504,6 +578,7 @@ class FITSImage(object):
         fraction = year_elapsed / year_duration
         return year + fraction
 
+    @indexed
     def pfilter(self, keyword):
         """Return the photometric filter of the image as a Passband instance.
 
@@ -647,6 +722,19 @@ class FITSImage(object):
                 str_char += character
         return str_char
 
+    @property
+    def data(self):
+        """Return the pixel data of the FITS image, as a NumPy array.
+
+        The data is not loaded when the FITSImage is instantiated, but read
+        from disk every time that this property is accessed. The file is
+        memory-mapped, so only the pages of the array that are actually used
+        are read. As PyFITS does, the array is indexed as [y, x].
+
+        """
+
+        return pyfits.getdata(self.path, memmap=True)
+
     @property
     def x_size(self):
         """ Return the number of pixels of the image in the x-axis."""
@@ -714,6 +802,7 @@ class FITSImage(object):
 
         return ra, dec
 
+    @indexed
     def center_wcs(self):
         """Return the world coordinates of the central pixel of the image.
 
@@ -807,6 +896,27 @@ class FITSImage(object):
                 sha1.update(line)
             return sha1.hexdigest()
 
+    @property
+    def data_sha1sum(self):
+        """Return the hexadecimal SHA-1 checksum of the FITS image data.
+
+        Unlike FITSImage.sha1sum, the header of the primary HDU is ignored, so
+        the checksum is not affected by the keywords that we write to it, such
+        as the path to the SExtractor catalog of the image: only the bytes that
+        follow the header (the pixels, and extensions if any) are read.
+
+        """
+
+        with pyfits.open(self.path, mode="readonly") as handler:
+            offset = handler.fileinfo(0)["datLoc"]
+
+        sha1 = hashlib.sha1()
+        with open(self.path, "rb") as fd:
+            fd.seek(offset)
+            for chunk in iter(lambda: fd.read(2 ** 20), ""):
+                sha1.update(chunk)
+            return sha1.hexdigest()
+
 
 class InputFITSFiles(collections.defaultdict):
     """Map each photometric filter to a list of FITS files.
@@ -852,6 +962,303 @@ class InputFITSFiles(collections.defaultdict):
         return discarded
 
 
+class HeaderIndex(object):
+    """A persistent index of the headers of FITS images.
+
+    Opening a FITS file to read its header takes only a few milliseconds, but
+    most LEMON commands do so for every input image, and then parse the same
+    values (date of observation, photometric filter...) from each header.
+    With tens of thousands of images, that adds up to minutes each time that
+    a command is run. This class stores in a SQLite database the header of
+    each FITS image, as well as the values parsed from it by the FITSImage
+    methods decorated with indexed(), so that they are read only once.
+
+    Images are identified by their absolute path, and their entries in the
+    index are valid only as long as the modification time and size of the
+    file do not change: when the image is modified, it is read again. Several
+    processes may use the same index at once.
+
+    """
+
+    # Seconds to wait for another process to release the database lock
+    TIMEOUT = 60
+
+    def __init__(self, path):
+        self.path = path
+        self._pid = None
+        with self._connection:  # commit automatically
+            self._connection.execute(
+                """
+            CREATE TABLE IF NOT EXISTS headers (
+                path   TEXT PRIMARY KEY,
+                mtime  REAL NOT NULL,
+                size   INTEGER NOT NULL,
+                header BLOB NOT NULL)
+            """
+            )
+
+            self._connection.execute(
+                """
+            CREATE TABLE IF NOT EXISTS parsed_values (
+                path  TEXT NOT NULL REFERENCES headers(path),
+                name  TEXT NOT NULL,
+                value BLOB NOT NULL,
+                PRIMARY KEY (path, name))
+            """
+            )
+
+    @property
+    def _connection(self):
+        """Return the connection to the database of this process.
+
+        A single connection is used for all the lookups, but SQLite connections
+        cannot be carried over a fork(), and the index is also used by the
+        workers of multiprocessing pools. Each process, therefore, opens its
+        own connection the first time that it needs it.
+
+        """
+
+        if self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.TIMEOUT)
+            # This is a cache: if it is corrupted by a crash, delete it
+            connection.execute("PRAGMA synchronous = OFF")
+            self._connection_ = connection
+            self._pid = os.getpid()
+        return self._connection_
+
+    @staticmethod
+    def _stat(path):
+        """ Return the absolute path, modification time and size of a file """
+
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime, stat.st_size
+
+    def header(self, path):
+        """Return the header of a FITS image, as a pyfits.Header.
+
+        Raises KeyError if the image is not in the index, or if it was
+        modified after it was indexed.
+
+        """
+
+        cursor = self._connection.execute(
+            """
+            SELECT header
+            FROM headers
+            WHERE path = ? AND mtime = ? AND size = ?
+            """,
+            self._stat(path),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError(path)
+        return pyfits.Header.fromstring(str(row[0]))
+
+    def add(self, path, header):
+        """ Index the header of a FITS image, discarding its parsed values """
+
+        row = self._stat(path) + (sqlite3.Binary(header.tostring()),)
+        with self._connection as connection:
+            t = row[:1]  # the absolute path
+            connection.execute("DELETE FROM parsed_values WHERE path = ?", t)
+            query = "INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)"
+            connection.execute(query, row)
+
+    def discard(self, path):
+        """ Remove a FITS image, if present, from the index """
+
+        t = (os.path.abspath(path),)
+        with self._connection as connection:
+            connection.execute("DELETE FROM parsed_values WHERE path = ?", t)
+            connection.execute("DELETE FROM headers WHERE path = ?", t)
+
+    def outdated(self, paths):
+        """Return the paths that are not indexed, or were modified since.
+
+        Paths that are not regular files are ignored: FITSImage will raise
+        the appropriate exception when the caller attempts to open them.
+
+        """
+
+        cursor = self._connection.execute("SELECT path, mtime, size FROM headers")
+        indexed = set(cursor)
+
+        outdated = []
+        for path in paths:
+            if os.path.isfile(path) and self._stat(path) not in indexed:
+                outdated.append(path)
+        return outdated
+
+    def get(self, path, name):
+        """Return a value parsed from the header of a FITS image.
+
+        Raises KeyError if the value is not in the index, or if the image
+        was modified after it was stored.
+
+        """
+
+        cursor = self._connection.execute(
+            """
+            SELECT v.value
+            FROM parsed_values AS v
+            INNER JOIN headers AS h
+            ON v.path = h.path
+            WHERE h.path = ? AND h.mtime = ? AND h.size = ?
+              AND v.name = ?
+            """,
+            self._stat(path) + (name,),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError(name)
+        return pickle.loads(str(row[0]))
+
+    def set(self, path, name, value):
+        """Store a value parsed from the header of a FITS image.
+
+        The value is silently ignored if the header of the image is not in
+        the index, or if the image was modified after it was indexed, as in
+        that case we cannot be sure that it was parsed from the same header.
+
+        """
+
+        self._set_many(name, [(path, value)])
+
+    def _set_many(self, name, items):
+        """ Store, in a single transaction, many (path, value) parsed values """
+
+        rows = []
+        for path, value in items:
+            value = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            rows.append((name, value) + self._stat(path))
+
+        with self._connection as connection:
+            connection.executemany(
+                """
+                INSERT OR REPLACE INTO parsed_values
+                SELECT path, ?, ?
+                FROM headers
+                WHERE path = ? AND mtime = ? AND size = ?
+                """,
+                rows,
+            )
+
+    def parsed_values(self, paths, method, *args, **kwargs):
+        """Return the values that a FITSImage method parses from many images.
+
+        Return a dictionary mapping each path in 'paths' to the value that
+        'method', a method of FITSImage decorated with indexed(), returns
+        for these arguments. All the values stored in the index are read with
+        a single query, while those that are missing, or outdated, are parsed
+        from the FITS images and then stored in a single transaction.
+
+        """
+
+        function = method.unindexed
+        name = _indexed_name(function, args, kwargs)
+        cursor = self._connection.execute(
+            """
+            SELECT h.path, h.mtime, h.size, v.value
+            FROM parsed_values AS v
+            INNER JOIN headers AS h
+            ON v.path = h.path
+            WHERE v.name = ?
+            """,
+            (name,),
+        )
+        stored = dict((row[:3], row[3]) for row in cursor)
+
+        values = {}
+        missing = []
+        for path in paths:
+            try:
+                values[path] = pickle.loads(str(stored[self._stat(path)]))
+            except KeyError:
+                values[path] = function(FITSImage(path), *args, **kwargs)
+                missing.append((path, values[path]))
+
+        if missing:
+            self._set_many(name, missing)
+        return values
+
+    def pfilters(self, paths, keyword):
+        """ Map each path to the FITSImage.pfilter() of the image """
+        return self.parsed_values(paths, FITSImage.pfilter, keyword)
+
+    def dates(self, paths, **kwargs):
+        """ Map each path to the FITSImage.date() of the image """
+        return self.parsed_values(paths, FITSImage.date, **kwargs)
+
+
+def _index_image(path):
+    """ Function argument of Pool.map(), to index the header of an image """
+
+    try:
+        FITSImage(path)
+    except IOError:  # includes NonStandardFITS
+        pass
+
+
+def pfilters(paths, keyword):
+    """Return a dictionary mapping each path to the photometric filter.
+
+    The FITSImage.pfilter() of each image, read with a single query from the
+    header index, if it is enabled (see use_header_index), instead of opening
+    each FITS file and parsing its header. NonStandardFITS is raised if any of
+    the paths is not a FITS image.
+
+    """
+
+    if header_index is not None:
+        return header_index.pfilters(paths, keyword)
+    return dict((path, FITSImage(path).pfilter(keyword)) for path in paths)
+
+
+def dates(paths, **kwargs):
+    """Return a dictionary mapping each path to the date of observation.
+
+    The FITSImage.date() of each image, given the keyword arguments 'kwargs',
+    read from the header index if enabled. See pfilters() for the details.
+
+    """
+
+    if header_index is not None:
+        return header_index.dates(paths, **kwargs)
+    return dict((path, FITSImage(path).date(**kwargs)) for path in paths)
+
+
+def use_header_index(path, paths=(), ncores=None):
+    """Make FITSImage consult the HeaderIndex stored at 'path'.
+
+    Set the module-level header_index, so that FITSImage reads the headers
+    from the index, and not from the FITS files, whenever possible. Those of
+    'paths' that are not indexed yet, or that were modified since they were
+    indexed, are (re)indexed beforehand, in parallel, using a pool of 'ncores'
+    workers. If 'path' is an empty string, or None, the index is disabled.
+    Returns the HeaderIndex object, or None.
+
+    """
+
+    global header_index
+
+    if not path:
+        header_index = None
+        return header_index
+
+    header_index = HeaderIndex(path)
+    outdated = header_index.outdated(paths)
+    if outdated:
+        msg = "%s: indexing the headers of %d FITS files"
+        logging.info(msg % (path, len(outdated)))
+        pool = multiprocessing.Pool(ncores)
+        try:
+            pool.map(_index_image, outdated)
+        finally:
+            pool.close()
+            pool.join()
+    return header_index
+
+
 def find_files(paths, followlinks=True, pattern=None):
     """Find all the regular files that can be found in the given paths.
 
@@ -52,13 +52,13 @@ import numpy
 import operator
 import optparse
 import os.path
-import pyfits
 import re
 import shutil
 import sys
 
 # LEMON modules
 import customparser
+import defaults
 import keywords
 import fitsimage
 import style
@@ -159,6 +159,15 @@ parser.add_option(
     "the FITS images is identical.",
 )
 
+parser.add_option(
+    "--header-index",
+    action="store",
+    type="str",
+    dest="header_index",
+    default=defaults.header_index,
+    help=defaults.desc["header_index"],
+)
+
 key_group = optparse.OptionGroup(parser, "FITS Keywords", keywords.group_description)
 
 key_group.add_option(
@@ -278,6 +287,10 @@ def main(arguments=None):
     )
     print "done."
 
+    # Read the headers of the images from the index, if given. Only the FITS
+    # images are indexed, as they are detected: not the other regular files.
+    fitsimage.use_header_index(options.header_index)
+
     print "%sDetecting FITS images among the %d indexed regular files..." % (
         style.prefix,
         len(files_paths),
@@ -377,8 +390,7 @@ def main(arguments=None):
                     # number of ADUs is irrelevant we can avoid having to
                     # unnecessarily compute it.
                     if options.max_counts:
-                        with pyfits.open(img.path, readonly=True) as hdu:
-                            median_counts = numpy.median(hdu[0].data)
+                        median_counts = numpy.median(img.data)
                         if median_counts > options.max_counts:
                             print "%s%s excluded (matched, but saturated " "with %d ADUs)" % (
                                 style.prefix,
@@ -131,6 +131,15 @@ parser.add_option(
     "detected [default: %default]",
 )
 
+parser.add_option(
+    "--header-index",
+    action="store",
+    type="str",
+    dest="header_index",
+    default=defaults.header_index,
+    help=defaults.desc["header_index"],
+)
+
 key_group = optparse.OptionGroup(parser, "FITS Keywords", keywords.group_description)
 
 key_group.add_option(
@@ -183,6 +192,8 @@ def main(arguments=None):
         input_paths = set(args[:-1])
         output_path = args[-1]
 
+    fitsimage.use_header_index(options.header_index, input_paths, options.ncores)
+
     # Refuse to overwrite the output FITS file unless explicitly instructed to
     # do so. Note that, if the --overwritten option is given, we do not need to
     # delete the existing file: it will be silently overwritten when the output
@@ -217,25 +228,13 @@ def main(arguments=None):
     msg = "%sMaking sure the %d input paths are FITS images..."
     print msg % (style.prefix, len(input_paths))
 
+    images = []
     util.show_progress(0.0)
     for index, path in enumerate(input_paths):
         # fitsimage.FITSImage.__init__() raises fitsimage.NonStandardFITS if
         # one of the paths is not a standard-conforming FITS file.
         try:
-            img = fitsimage.FITSImage(path)
-
-            # If we do not need to know the photometric filter (because the
-            # --filter was not given) do not read it from the FITS header.
-            # Instead, use None. This means that 'files', a dictionary, will
-            # only have a key, None, mapping to all the input FITS images.
-
-            if options.filter:
-                pfilter = img.pfilter(options.filterk)
-            else:
-                pfilter = None
-
-            files[pfilter].append(img)
-
+            images.append(fitsimage.FITSImage(path))
         except fitsimage.NonStandardFITS:
             print
             msg = "'%s' is not a standard FITS file"
@@ -245,6 +244,20 @@ def main(arguments=None):
         util.show_progress(percentage)
     print  # progress bar doesn't include newline
 
+    # If we do not need to know the photometric filter (because the --filter
+    # was not given) do not read it from the FITS headers. Instead, use None.
+    # This means that 'files', a dictionary, will only have a key, None,
+    # mapping to all the input FITS images. Otherwise, the filters are read
+    # from the header index, if enabled, with a single query.
+
+    if options.filter:
+        img_pfilters = fitsimage.pfilters(input_paths, options.filterk)
+    else:
+        img_pfilters = dict.fromkeys(input_paths)
+
+    for img in images:
+        files[img_pfilters[img.path]].append(img)
+
     # The --filter option allows the user to specify which FITS files, among
     # all those received as input, must be combined: only those images taken
     # in the options.filter photometric filter.
@@ -57,6 +57,7 @@ import shutil
 import socket
 import sys
 import tempfile
+import threading
 import time
 import warnings
 
@@ -79,10 +80,11 @@ DANNULUS_TOO_THIN_MSG = (
     "Whoops! Sky annulus too thin, setting it to the minimum of %.2f pixels"
 )
 
-# The Queue is global -- this works, but note that we could have
-# passed its reference to the function managed by pool.map_async.
-# See http://stackoverflow.com/a/3217427/184363
-queue = util.Queue()
+# How many images, per CPU core, may be in flight at the same time: submitted
+# to the pool of workers but with their photometry not yet stored in the LEMONdB.
+# This bounds the memory used by the QPhot objects sent back by the workers in
+# case the database falls behind, while still keeping all the cores busy.
+PENDING_IMAGES_PER_CORE = 4
 
 
 def get_fwhm(img, options):
@@ -96,6 +98,11 @@ def get_fwhm(img, options):
     fitsimage.FITSImage object, while 'options' must be the optparse.Values
     object returned by optparse.OptionParser.parse_args().
 
+    Unless options.fwhm_cache is an empty string, the computed FWHMs are
+    stored in the seeing.FWHMCache at that path, and looked up there before
+    computing them: they will be the same as long as neither the pixels of
+    the image nor the options with which the FWHM is computed change.
+
     """
 
     try:
@@ -116,6 +123,21 @@ def get_fwhm(img, options):
         args = img.path, options.fwhmk
         logging.debug(msg % args)
 
+        mode = "mean" if options.mean else "median"
+
+        if options.fwhm_cache:
+            cache = seeing.FWHMCache(options.fwhm_cache)
+            args = img, options.maximum, options.margin, options.coaddk
+            key = cache.key(*args, per=options.per, mode=mode)
+            try:
+                fwhm = cache[key]
+                msg = "%s: FWHM = %.3f (cached in %s)"
+                logging.debug(msg % (img.path, fwhm, cache.path))
+                return fwhm
+            except KeyError:
+                msg = "%s: FWHM not cached in %s"
+                logging.debug(msg % (img.path, cache.path))
+
         if not isinstance(img, seeing.FITSeeingImage):
 
             msg = "%s: type of argument 'img' is not FITSeeingImage ('%s')"
@@ -132,35 +154,74 @@ def get_fwhm(img, options):
         msg = "%s: calling FITSeeingImage.fwhm() to compute FWHM"
         logging.debug(msg % img.path)
 
-        mode = "mean" if options.mean else "median"
         kwargs = dict(per=options.per, mode=mode)
         fwhm = img.fwhm(**kwargs)
 
         msg = "%s: FITSeeingImage.fwhm() returned %.3f"
         args = img.path, fwhm
         logging.debug(msg % args)
+
+        if options.fwhm_cache:
+            cache[key] = fwhm
         return fwhm
 
 
+@util.print_exception_traceback
+def parallel_fwhm(args):
+    """Function argument of Pool.map() to compute FWHMs in parallel.
+
+    'args' must be a two-element tuple with (1) the path to a FITS image and
+    (2) 'options', the optparse.Values object returned by parse_args(). Return
+    the FWHM of the image, as returned by get_fwhm().
+
+    """
+
+    path, options = args
+    return get_fwhm(fitsimage.FITSImage(path), options)
+
+
+def get_fwhms(paths, options):
+    """Return the FWHM of each FITS image, computing them in parallel.
+
+    Call get_fwhm() for each path in 'paths', using a pool of options.ncores
+    workers, and return a list with the FWHMs, in the same order. Reading the
+    FWHM from the header is immediate, but otherwise SExtractor may have to be
+    run on each image, which is why we do not want to do this serially.
+
+    """
+
+    pool = multiprocessing.Pool(options.ncores)
+    try:
+        return pool.map(parallel_fwhm, [(path, options) for path in paths])
+    finally:
+        pool.close()
+        pool.join()
+
+
 @util.print_exception_traceback
 def parallel_photometry(args):
-    """Function argument of map_async() to do photometry in parallel.
+    """Function argument of imap_unordered() to do photometry in parallel.
 
-    This will be the first argument passed to multiprocessing.Pool.map_async(),
-    which chops the iterable into a number of chunks that are submitted to the
-    process pool as separate tasks. 'args' must be a three-element tuple with
+    This will be the first argument passed to Pool.imap_unordered(), which
+    submits each element of the iterable to the process pool as a separate
+    task and yields the results as soon as they are ready, in whatever order
+    the workers finish them. 'args' must be a three-element tuple with
     (1) a fitsimage.FITSImage object, (2) a database.PhotometricParameters
     object and (3) 'options', the optparse.Values object returned by
     optparse.OptionParser.parse_args().
 
     This function does photometry (qphot.run()) on the astronomical objects of
     the FITS image listed in options.coordinates, using the aperture, annulus
-    and dannulus defined by the PhotometricParameters object. The result is
-    another three-element tuple, which is put into the module-level 'queue'
-    object, a process shared queue. This tuple contains (1) a database.Image
-    object, (2) a database.PhotometricParameters object and (3) a qphot.QPhot
-    object -- therefore mapping each FITS file and the parameters used for
-    photometry to the measurements returned by qphot.
+    and dannulus defined by the PhotometricParameters object. Returns a
+    four-element tuple, which is sent back to the parent process so that it can
+    be stored in the LEMONdB. This tuple contains (1) a database.Image object,
+    (2) a database.PhotometricParameters object and (3) a qphot.QPhot object --
+    therefore mapping each FITS file and the parameters used for photometry to
+    the measurements returned by qphot. The fourth element is a list of
+    two-element tuples, (PhotometricParameters, QPhot), with the photometry
+    done with each aperture if options.extra_apertures is not empty (that given
+    by the PhotometricParameters object included). Otherwise, it is an empty
+    list.
 
     """
 
@@ -179,12 +240,19 @@ def parallel_photometry(args):
     args = (image.path, maximum)
     logging.debug(msg % args)
 
+    # All the apertures are measured at once, reading the image only once
+    apertures = [pparams.aperture] + (options.extra_apertures or [])
+    if len(apertures) > 1:
+        msg = "%s: extra apertures: %s"
+        extra = ", ".join("%.3f" % x for x in apertures[1:])
+        logging.debug(msg % (image.path, extra))
+
     logging.info("Running qphot on %s" % image.path)
     args = (
         image,
         options.coordinates,
         options.epoch,
-        pparams.aperture,
+        apertures,
         pparams.annulus,
         pparams.dannulus,
         maximum,
@@ -193,8 +261,23 @@ def parallel_photometry(args):
         options.exptimek,
         options.uncimgk,
     )
-    img_qphot = qphot.run(*args, cbox=options.cbox)
-    logging.info("Finished running qphot on %s" % image.path)
+    kwargs = dict(
+        cbox=options.cbox,
+        backend=options.backend,
+        numpy_centering=options.numpy_centering,
+    )
+    start_time = time.time()
+    img_qphots = qphot.run(*args, **kwargs)
+    img_qphot = img_qphots[0]
+    elapsed = time.time() - start_time
+    msg = "Finished running qphot on %s (%.3f seconds, process %d)"
+    logging.info(msg % (image.path, elapsed, os.getpid()))
+
+    pparams_qphots = []
+    if options.extra_apertures:
+        for aperture, aperture_qphot in zip(apertures, img_qphots):
+            aperture_pparams = pparams._replace(aperture=aperture)
+            pparams_qphots.append((aperture_pparams, aperture_qphot))
 
     msg = "%s: qphot.run() returned %d records"
     args = (image.path, len(img_qphot))
@@ -234,9 +317,7 @@ def parallel_photometry(args):
 
     args = (image.path, pfilter, unix_time, object_, airmass, gain, ra, dec)
     db_image = database.Image(*args)
-    queue.put((db_image, pparams, img_qphot))
-    msg = "%s: photometry result put into global queue"
-    logging.debug(msg % image.path)
+    return db_image, pparams, img_qphot, pparams_qphots
 
 
 parser = customparser.get_parser(description)
@@ -293,6 +374,33 @@ parser.add_option(
     "may set this option to zero [default: %default]",
 )
 
+parser.add_option(
+    "--backend",
+    action="store",
+    type="choice",
+    choices=qphot.BACKENDS,
+    dest="backend",
+    default="iraf",
+    help="the implementation of aperture photometry to use: "
+    "'iraf', which runs IRAF's qphot, or 'numpy', which does the "
+    "same measurements in-process, without spawning any IRAF "
+    "task or writing temporary files, and is therefore much "
+    "faster on large data sets. IRAF's qphot remains the "
+    "reference implementation [default: %default]",
+)
+
+parser.add_option(
+    "--numpy-centering",
+    action="store_true",
+    dest="numpy_centering",
+    help="with the 'iraf' backend, compute the accurate centers "
+    "of the astronomical objects (--cbox option) with NumPy, "
+    "recentering all of them at once, and then give IRAF's "
+    "qphot their pixel coordinates. Otherwise, qphot converts "
+    "the celestial coordinates and centers each object itself. "
+    "The 'numpy' backend always centers objects in this manner",
+)
+
 parser.add_option(
     "--maximum",
     action="store",
@@ -350,6 +458,15 @@ parser.add_option(
     help=defaults.desc["ncores"],
 )
 
+parser.add_option(
+    "--header-index",
+    action="store",
+    type="str",
+    dest="header_index",
+    default=defaults.header_index,
+    help=defaults.desc["header_index"],
+)
+
 parser.add_option(
     "-v",
     "--verbose",
@@ -516,6 +633,22 @@ qphot_fixed.add_option(
     default=None,
     help="the width of the sky annulus, in pixels",
 )
+
+qphot_fixed.add_option(
+    "--extra-aperture-pix",
+    action="append",
+    type="float",
+    dest="extra_apertures",
+    default=None,
+    help="an additional aperture radius, in pixels, with which "
+    "to also do photometry, using the same sky annulus. All the "
+    "apertures are measured at once, without reading the images "
+    "more than once, and the photometry done with each of them "
+    "(including --aperture-pix) is stored in the LEMONdB as a "
+    "different set of photometric parameters, any of which can "
+    "be later selected with LEMONdB.use_pparams(). This option "
+    "may be used multiple times, and needs the above three.",
+)
 parser.add_option_group(qphot_fixed)
 
 fwhm_group = optparse.OptionGroup(
@@ -543,6 +676,15 @@ fwhm_group.add_option(
 fwhm_group.add_option(
     "--mean", action="store_true", dest="mean", help=defaults.desc["mean"]
 )
+
+fwhm_group.add_option(
+    "--fwhm-cache",
+    action="store",
+    type="str",
+    dest="fwhm_cache",
+    default=defaults.fwhm_cache,
+    help=defaults.desc["fwhm_cache"],
+)
 parser.add_option_group(fwhm_group)
 
 key_group = optparse.OptionGroup(parser, "FITS Keywords", keywords.group_description)
@@ -691,6 +833,10 @@ def main(arguments=None):
 
     assert input_paths
 
+    # Read the headers of the images from the index, updating it if needed
+    paths = [sources_img_path] + list(input_paths)
+    fitsimage.use_header_index(options.header_index, paths, options.ncores)
+
     # If the user gives an empty string as the FITS keyword which stores the
     # path to the original image, it is understood as meaning that we want
     # saturation to be checked for in the same images on which photometry is
@@ -774,6 +920,16 @@ def main(arguments=None):
         print style.error_exit_message
         return 1
 
+    # The extra apertures share the sky annulus given in pixels, so without
+    # it we would not know what annulus to use with them.
+    if options.extra_apertures and not fixed_annuli:
+        print (
+            "%sError. The --extra-aperture-pix option needs --aperture-pix, "
+            "--annulus-pix and --dannulus-pix." % style.prefix
+        )
+        print style.error_exit_message
+        return 1
+
     if options.individual_fwhm:
 
         # If the photometric parameters are set to a fixed value, they cannot
@@ -795,8 +951,12 @@ def main(arguments=None):
     # numbers. By definition, also, the inner radius of the sky annulus must be
     # greater than or equal to the aperture radius. Obviously!
 
+    # The same applies to the --extra-aperture-pix options, if any
+    pixel_apertures = [options.aperture_pix] + (options.extra_apertures or [])
+
     fwhm_options = (options.aperture, options.annulus, options.dannulus)
-    pixel_options = (options.aperture_pix, options.annulus_pix, options.dannulus_pix)
+    pixel_options = (options.annulus_pix, options.dannulus_pix)
+    pixel_options += tuple(pixel_apertures)
 
     if (not fixed_annuli and min(fwhm_options) <= 0) or (
         fixed_annuli and min(pixel_options) <= 0
@@ -806,11 +966,11 @@ def main(arguments=None):
         return 1
 
     if (not fixed_annuli and options.aperture > options.annulus) or (
-        fixed_annuli and options.aperture_pix > options.annulus_pix
+        fixed_annuli and max(pixel_apertures) > options.annulus_pix
     ):
         print "%sError. The aperture radius (%.2f) must be smaller than or equal\n" "%sto the inner radius of the sky annulus (%.2f)" % (
             style.prefix,
-            options.aperture_pix if fixed_annuli else options.aperture,
+            max(pixel_apertures) if fixed_annuli else options.aperture,
             style.prefix,
             options.annulus_pix if fixed_annuli else options.annulus,
         )
@@ -861,30 +1021,19 @@ def main(arguments=None):
     msg = "%sExamining the headers of the %s FITS files given as input..."
     print msg % (style.prefix, len(input_paths))
 
-    def get_date(img):
-        """ Return the date() of a FITSImage object """
-        return img.date(
-            date_keyword=options.datek,
-            time_keyword=options.timek,
-            exp_keyword=options.exptimek,
-        )
+    # With the header index enabled, the filter and date of all the images
+    # are read with a single query each, without opening any FITS file.
+    img_pfilters = fitsimage.pfilters(input_paths, options.filterk)
+    img_dates = fitsimage.dates(
+        input_paths,
+        date_keyword=options.datek,
+        time_keyword=options.timek,
+        exp_keyword=options.exptimek,
+    )
 
     files = fitsimage.InputFITSFiles()
-    img_dates = {}
-
-    util.show_progress(0.0)
-    for index, img_path in enumerate(input_paths):
-        img = fitsimage.FITSImage(img_path)
-        pfilter = img.pfilter(options.filterk)
-        files[pfilter].append(img_path)
-
-        date = get_date(img)
-        img_dates[img_path] = date
-
-        percentage = (index + 1) / len(input_paths) * 100
-        util.show_progress(percentage)
-
-    print  # progress bar doesn't include newline
+    for img_path in input_paths:
+        files[img_pfilters[img_path]].append(img_path)
 
     msg = "%s%d different photometric filters were detected:"
     print msg % (style.prefix, len(files.keys()))
@@ -1207,7 +1356,10 @@ def main(arguments=None):
         print msg % (style.prefix, sources_dannulus)
 
     print style.prefix
-    msg = "%sRunning IRAF's qphot..."
+    if options.backend == "iraf":
+        msg = "%sRunning IRAF's qphot..."
+    else:
+        msg = "%sDoing photometry with NumPy..."
     print msg % style.prefix,
     sys.stdout.flush()
 
@@ -1242,6 +1394,11 @@ def main(arguments=None):
         options.exptimek,
         None,
     ]
+    qphot_kwargs = dict(
+        cbox=options.cbox,
+        backend=options.backend,
+        numpy_centering=options.numpy_centering,
+    )
 
     # The options.exptimek FITS keyword is allowed to be missing from the
     # header of the sources image (for example, a legitimate scenario: we
@@ -1255,7 +1412,7 @@ def main(arguments=None):
     with warnings.catch_warnings():
         kwargs = dict(category=qphot.MissingFITSKeyword)
         warnings.filterwarnings("ignore", **kwargs)
-        sources_phot = qphot.run(*qphot_args, cbox=options.cbox)
+        sources_phot = qphot.run(*qphot_args, **qphot_kwargs)
 
     print "done."
 
@@ -1276,25 +1433,17 @@ def main(arguments=None):
     print msg % style.prefix,
     sys.stdout.flush()
 
-    ignored_counter = 0
-    non_ignored_counter = 0
     original_size = len(sources_phot)
+    indef = numpy.isnan(sources_phot.data["mag"])
+    ignored_counter = int(indef.sum())
+    non_ignored_counter = original_size - ignored_counter
 
     assert len(options.coordinates) == len(sources_phot)
-    it = itertools.izip(options.coordinates, sources_phot)
-
-    options.coordinates = []
-    for coord, object_phot in it:
-        if object_phot.mag is not None:
-            options.coordinates.append(coord)
-            non_ignored_counter += 1
-        else:
-            ignored_counter += 1
+    it = itertools.izip(options.coordinates, indef)
+    options.coordinates = [coord for coord, is_indef in it if not is_indef]
 
     # Delete INDEF photometric measurements, in-place
-    for index in xrange(len(sources_phot) - 1, -1, -1):
-        if sources_phot[index].mag is None:
-            sources_phot.pop(index)
+    sources_phot.data = sources_phot.data[~indef]
 
     assert non_ignored_counter == len(sources_phot)
     assert ignored_counter + non_ignored_counter == original_size
@@ -1328,7 +1477,7 @@ def main(arguments=None):
         with warnings.catch_warnings():
             kwargs = dict(category=qphot.MissingFITSKeyword)
             warnings.filterwarnings("ignore", **kwargs)
-            non_INDEF_phot = qphot.run(*qphot_args, cbox=options.cbox)
+            non_INDEF_phot = qphot.run(*qphot_args, **qphot_kwargs)
 
         assert sources_phot == non_INDEF_phot
         print "done."
@@ -1358,6 +1507,15 @@ def main(arguments=None):
             output_db.add_star(*args)
 
         output_db.commit()
+
+        # Whether each star has a known proper motion, so that we do not have
+        # to query the LEMONdB for every measurement in order to know for which
+        # ones the proper-motion corrected pixel coordinates must be stored.
+        has_pm = numpy.array(
+            [bool(coord.pm_ra or coord.pm_dec) for coord in options.coordinates],
+            dtype=bool,
+        )
+
         print "done."
 
         # Store some relevant information about the sources image in the LEMONdB.
@@ -1451,7 +1609,16 @@ def main(arguments=None):
         output_db.simage = simage
         output_db.commit()
 
-        for pfilter, images in sorted(files.iteritems()):
+        def filter_photometry(pfilter, images):
+            """Do photometry on the images taken in a photometric filter.
+
+            Determine the aperture and sky annuli with which photometry has to
+            be done on the FITS files in 'images', taken in the 'pfilter'
+            photometric filter, do it in parallel and store the measurements
+            in the output LEMONdB as each image is finished.
+
+            """
+
             print style.prefix
             msg = "%sLet's do photometry on the %d images taken in the %s filter."
             args = (style.prefix, len(images), pfilter)
@@ -1499,17 +1666,22 @@ def main(arguments=None):
                 msg = "%sSky annulus, width = %.2f x FWHM pixels"
                 print msg % (style.prefix, options.dannulus)
 
+                # Compute all the FWHMs in parallel before doing photometry,
+                # instead of one by one as photometry_args() needs them.
+                msg = "%sCalculating the FWHM of each image..."
+                print msg % style.prefix,
+                sys.stdout.flush()
+                individual_fwhms = dict(zip(images, get_fwhms(images, options)))
+                print "done."
+
             elif not fixed_annuli:
                 msg = "%sCalculating the median FWHM for this filter..."
                 print msg % style.prefix,
                 sys.stdout.flush()
 
-                pfilter_fwhms = []
-                for path in images:
-                    img = fitsimage.FITSImage(path)
-                    img_fwhm = get_fwhm(img, options)
-                    logging.debug("%s: FWHM = %.3f" % (img.path, img_fwhm))
-                    pfilter_fwhms.append(img_fwhm)
+                pfilter_fwhms = get_fwhms(images, options)
+                for path, img_fwhm in zip(images, pfilter_fwhms):
+                    logging.debug("%s: FWHM = %.3f" % (path, img_fwhm))
 
                 fwhm = numpy.median(pfilter_fwhms)
                 print "done."
@@ -1546,7 +1718,12 @@ def main(arguments=None):
 
             # The task of doing photometry on a series of images is inherently
             # parallelizable; use a pool of workers to which to assign the images.
-            pool = multiprocessing.Pool(options.ncores)
+            # With IRAF, each worker starts its own PyRAF session only once, and
+            # keeps it for all the images it processes: see qphot.init_worker().
+            kwargs = {}
+            if options.backend == "iraf":
+                kwargs["initializer"] = qphot.init_worker
+            pool = multiprocessing.Pool(options.ncores, **kwargs)
 
             def fwhm_derived_params(img):
                 """Return the FWHM-derived aperture and sky annuli parameters.
@@ -1560,7 +1737,7 @@ def main(arguments=None):
 
                 """
 
-                fwhm = get_fwhm(img, options)
+                fwhm = individual_fwhms[img.path]
                 aperture = fwhm * options.aperture
                 annulus = fwhm * options.annulus
                 dannulus = fwhm * options.dannulus
@@ -1582,7 +1759,7 @@ def main(arguments=None):
             # are to be used for all the images in this photometric filter) or, if
             # the --individual-fwhm option was used, derives them from the FWHM of
             # each of the FITS images. This allows us to, in both cases, make the
-            # map_async_args() generator loop over the images on which photometry
+            # photometry_args() generator loop over the images on which photometry
             # is to be done and, for each one of them, call qphot_params() to get
             # the parameters that have to be used.
 
@@ -1593,8 +1770,15 @@ def main(arguments=None):
             else:
                 qphot_params = fwhm_derived_params
 
-            def map_async_args():
+            # The generator runs in the thread of the pool that submits the tasks
+            # to the workers, which blocks on this semaphore until the parent
+            # process has stored the photometry of one of the pending images.
+            max_pending = PENDING_IMAGES_PER_CORE * options.ncores
+            pending = threading.Semaphore(max_pending)
+
+            def photometry_args():
                 for path in images:
+                    pending.acquire()
                     img = fitsimage.FITSImage(path)
                     yield (img, qphot_params(img), options)
 
@@ -1605,159 +1789,131 @@ def main(arguments=None):
             # not contain this keyword, as it was needed in order to make sure that
             # there are no duplicate observation dates. There is no need to turn
             # the MissingFITSKeyword warning into an exception.
+            #
+            # The photometry of each image is stored in the LEMONdB as soon as a
+            # worker finishes it, in whatever order that happens, so writing to
+            # the database overlaps with the photometry of the remaining images.
 
-            result = pool.map_async(parallel_photometry, map_async_args())
-            util.show_progress(0.0)
-            while not result.ready():
-                time.sleep(1)
-                util.show_progress(queue.qsize() / len(images) * 100)
-                # Do not update the progress bar when debugging; instead, print it
-                # on a new line each time. This prevents the next logging message,
-                # if any, from being printed on the same line that the bar.
-                if logging_level < logging.WARNING:
-                    print
-
-            result.get()  # reraise exceptions of the remote call, if any
-            util.show_progress(100)  # in case the queue was ready too soon
-            print
-
-            msg = "%sStoring photometric measurements in the database..."
+            msg = "%sDoing photometry and storing the measurements in the LEMONdB..."
             print msg % style.prefix
             sys.stdout.flush()
 
-            util.show_progress(0)
-            qphot_results = (queue.get() for x in xrange(queue.qsize()))
-            for index, args in enumerate(qphot_results):
-
-                db_image, pparams, img_qphot = args
-                logging.debug("Storing image %s in database" % db_image.path)
-                output_db.add_image(db_image)
-                logging.debug("Image %s successfully stored" % db_image.path)
-
-                # Now store each photometric measurement
-                for object_id, object_phot in enumerate(img_qphot):
-                    # INDEF photometric measurements have a magnitude of None, and
-                    # those with at least one saturated pixel in the aperture have
-                    # a magnitude of infinity. In both cases the measurement is
-                    # useless for our photometric purposes and can be ignored.
-                    if object_phot.mag is None:
-                        msg = "%s: object %d is INDEF (None)"
-                        args = db_image.path, object_id
-                        logging.debug(msg % args)
-                        continue
-
-                    elif object_phot.mag == float("infinity"):
-                        msg = "%s: object %d is saturated (infinity)"
-                        args = db_image.path, object_id
-                        logging.debug(msg % args)
-                        continue
-
-                    else:
-                        msg = "%s: object %d magnitude = %f"
-                        args = db_image.path, object_id, object_phot.mag
-                        logging.debug(msg % args)
-
-                    # Photometric measurements with a signal-to-noise ratio less
-                    # than or equal to one are ignored -- not only because these
-                    # measurements are anything but reliable, but also because such
-                    # values are outside of the domain of the function that
-                    # converts SNRs to errors in magnitudes.
-                    object_snr = object_phot.snr(db_image.gain)
-                    if object_snr <= 1:
-                        msg = "%s: object %d ignored (SNR = %f <= 1)"
-                        args = db_image.path, object_id, object_snr
-                        logging.debug(msg % args)
-                        continue
-
-                    else:
-                        msg = "%s: object %d SNR = %f"
-                        args = db_image.path, object_id, object_snr
-                        logging.debug(msg % args)
-
-                        msg = "%s: storing measurement for object %d in database"
-                        args = db_image.path, object_id
-                        logging.debug(msg % args)
-
-                        args = (
-                            object_id,
-                            db_image.unix_time,
-                            db_image.pfilter,
-                            object_phot.mag,
-                            object_snr,
-                        )
-
-                        output_db.add_photometry(*args)
-
-                        msg = "%s: measurement for object %d successfully stored"
-                        args = db_image.path, object_id
-                        logging.debug(msg % args)
-
-                        # Store the pixel (x and y) coordinates where photometry
-                        # has been done. Useful mostly, if not exclusively, for
-                        # debugging purposes, in case we need or want to make sure
-                        # the measurement was taken at the proper-motion corrected
-                        # coordinates.
-
-                        pm_ra, pm_dec = output_db.get_star(object_id)[5:7]
-
-                        if not pm_ra and not pm_dec:
-
-                            msg = "%s: object %d does not have proper motion"
-                            args = db_image.path, object_id
-                            logging.debug(msg % args)
-
-                        else:
-
-                            assert pm_ra is not None
-                            assert pm_dec is not None
-
-                            msg = "%s: object %d pm_ra = %f (x = %f)"
-                            args = db_image.path, object_id, pm_ra, object_phot.x
-                            logging.debug(msg % args)
-
-                            msg = "%s: object %d pm_dec = %f (y = %f)"
-                            args = db_image.path, object_id, pm_dec, object_phot.y
-                            logging.debug(msg % args)
-
-                            msg = "%s: storing proper-motion corrections for object %d"
-                            args = db_image.path, object_id
-                            logging.debug(msg % args)
-
-                            args = (
-                                object_id,
-                                db_image.unix_time,
-                                db_image.pfilter,
-                                object_phot.x,
-                                object_phot.y,
-                            )
-
-                            output_db.add_pm_correction(*args)
-
-                            msg = "%s: proper-motion correction for object %d sucessfully stored"
-                            args = db_image.path, object_id
-                            logging.debug(msg % args)
-
-                util.show_progress(100 * (index + 1) / len(images))
-                if logging_level < logging.WARNING:
+            util.show_progress(0.0)
+            qphot_results = pool.imap_unordered(parallel_photometry, photometry_args())
+            try:
+                for index, args in enumerate(qphot_results):
+
+                    db_image, pparams, img_qphot, pparams_qphots = args
+                    logging.debug("Storing image %s in database" % db_image.path)
+                    output_db.add_image(db_image)
+                    logging.debug("Image %s successfully stored" % db_image.path)
+
+                    # INDEF photometric measurements have a magnitude of NaN (None
+                    # in the QPhotResult objects), and those with at least one
+                    # saturated pixel in the aperture have a magnitude of infinity.
+                    # In both cases the measurement is useless for our photometric
+                    # purposes and can be ignored. Measurements with a signal-to-
+                    # noise ratio less than or equal to one are ignored too -- not
+                    # only because these measurements are anything but reliable,
+                    # but also because such values are outside of the domain of the
+                    # function that converts SNRs to errors in magnitudes. All the
+                    # objects are filtered at once, and the measurements that are
+                    # kept stored in the database with a single statement.
+
+                    mags = img_qphot.data["mag"]
+                    snrs = img_qphot.snr(db_image.gain)
+                    indef = numpy.isnan(mags)
+                    saturated = numpy.isinf(mags)
+                    low_snr = ~indef & ~saturated & (snrs <= 1)
+                    keep = ~(indef | saturated | low_snr)
+
+                    msg = "%s: %d objects INDEF, %d saturated, %d with SNR <= 1"
+                    args = db_image.path, indef.sum(), saturated.sum(), low_snr.sum()
+                    logging.debug(msg % args)
+
+                    # Now store all the photometric measurements at once
+                    kept_ids = numpy.flatnonzero(keep)
+                    rows = itertools.izip(kept_ids, mags[kept_ids], snrs[kept_ids])
+                    output_db.add_photometry_batch(db_image, rows)
+
+                    # Store the pixel (x and y) coordinates where photometry has
+                    # been done for the objects with known proper motions. Useful
+                    # mostly, if not exclusively, for debugging purposes, in case
+                    # we need or want to make sure the measurement was taken at
+                    # the proper-motion corrected coordinates.
+
+                    pm_ids = numpy.flatnonzero(keep & has_pm)
+                    if len(pm_ids):
+                        x = img_qphot.data["x"][pm_ids]
+                        y = img_qphot.data["y"][pm_ids]
+                        rows = itertools.izip(pm_ids, x, y)
+                        output_db.add_pm_correction_batch(db_image, rows)
+
+                    msg = "%s: stored %d measurements (%d proper-motion corrections)"
+                    logging.debug(msg % (db_image.path, len(kept_ids), len(pm_ids)))
+
+                    # If --extra-aperture-pix was used, also store the photometry
+                    # done with each aperture as a separate set of parameters. The
+                    # same measurements as above (INDEF, saturated or SNR <= 1) are
+                    # ignored, but this time without logging how many of them.
+                    for aperture_pparams, aperture_qphot in pparams_qphots:
+                        msg = "%s: storing photometry for %s"
+                        logging.debug(msg % (db_image.path, aperture_pparams))
+
+                        mags = aperture_qphot.data["mag"]
+                        snrs = aperture_qphot.snr(db_image.gain)
+                        keep = numpy.isfinite(mags) & (snrs > 1)
+
+                        kept_ids = numpy.flatnonzero(keep)
+                        rows = itertools.izip(kept_ids, mags[kept_ids], snrs[kept_ids])
+                        args = db_image, aperture_pparams, rows
+                        output_db.add_pparams_photometry_batch(*args)
+
+                    pending.release()
+                    util.show_progress(100 * (index + 1) / len(images))
+                    # Do not update the progress bar when debugging; instead, print
+                    # it on a new line each time. This prevents the next logging
+                    # message, if any, from being printed on the same line that
+                    # the bar.
+                    if logging_level < logging.WARNING:
+                        print
+
+                else:
+                    logging.info("Photometry for %s completed" % pfilter)
+                    logging.debug("Committing database transaction")
+                    output_db.commit()
+                    logging.info("Database transaction commited")
+
+                    util.show_progress(100.0)
                     print
 
-            else:
-                logging.info("Photometry for %s completed" % pfilter)
-                logging.debug("Committing database transaction")
-                output_db.commit()
-                logging.info("Database transaction commited")
-
-                util.show_progress(100.0)
-                print
-
-        # Collect information that can be used by the query optimizer to help make
-        # better query planning choices. In the absence of ANALYZE information,
-        # SQLite assumes that each table contains one million records when deciding
-        # between doing a full table scan and constructing an automatic index.
-
-        print "%sGathering statistics about tables and indexes..." % style.prefix,
-        sys.stdout.flush()
-        output_db.analyze()
+            except:
+                # Wake up the thread that submits the tasks, in case it is
+                # waiting on the semaphore, so that the pool can be terminated.
+                for _ in images:
+                    pending.release()
+                pool.terminate()
+                raise
+
+            pool.close()
+            pool.join()
+
+        # Photometry is stored in bulk-load mode: faster, but unsafe if the
+        # system crashes. This is not a problem, as the output LEMONdB is not
+        # usable until this command finishes, anyway. On exit from the with
+        # statement, the indexes that were dropped are built again, and the
+        # statistics used by the query optimizer are gathered with ANALYZE. In
+        # the absence of ANALYZE information, SQLite assumes that each table
+        # contains one million records when deciding between doing a full table
+        # scan and constructing an automatic index.
+
+        with output_db.bulk_load():
+            for pfilter, images in sorted(files.iteritems()):
+                filter_photometry(pfilter, images)
+
+            msg = "%sBuilding indexes and gathering statistics about tables..."
+            print msg % style.prefix,
+            sys.stdout.flush()
         print "done."
 
         # Store into the METADATA table of the LEMONdB the current time (in seconds
@@ -32,18 +32,23 @@ from the user's perspective.
 """
 
 import collections
+import copy
 import functools
-import itertools
 import logging
 import math
+import multiprocessing.util
+import numpy
 import os
 import os.path
+import pyfits
 import re
 import sys
 import tempfile
+import time
 import warnings
 
 # LEMON modules
+import aperphot
 import fitsimage
 import util
 
@@ -114,6 +119,51 @@ pyraf.subproc.Subprocess.__del__ = log_uncaught_exceptions(
     pyraf.subproc.Subprocess.__del__
 )
 
+# The IRAF tasks run by QPhot.run(). Looking a task up by its name, through
+# the package to which it belongs, is not free, so the task objects (which
+# also hold their parameter sets) are stored here the first time they are
+# needed and reused from then on, for as long as the process lives.
+IRAF_TASKS = ("qphot", "txdump")
+_iraf_tasks = {}
+
+
+def get_iraf_task(name):
+    """ Return the PyRAF task object of an IRAF task, loading it only once. """
+
+    try:
+        return _iraf_tasks[name]
+    except KeyError:
+        task = _iraf_tasks[name] = pyraf.iraf.getTask(name)
+        return task
+
+
+def init_worker():
+    """Start a persistent PyRAF session in a worker process.
+
+    This function is intended to be used as the 'initializer' argument of
+    multiprocessing.Pool, so that each worker process does all the IRAF setup
+    only once, instead of every time it does photometry on an image: the tasks
+    in IRAF_TASKS are loaded and process caching is enabled, locking them in
+    the cache. In this manner, the IRAF executable of each task is started the
+    first time it is run and reused for all the images that the worker later
+    processes. Process caching is turned off at import time because processes
+    running in parallel must not share the same IRAF executable, but that is
+    not a concern here: the cache is enabled after the worker process has been
+    forked, so the executables in it belong to this process alone. They are
+    flushed when the worker exits.
+
+    """
+
+    for name in IRAF_TASKS:
+        get_iraf_task(name)
+
+    pyraf.iraf.prcacheOn()
+    pyraf.iraf.prcache(*IRAF_TASKS)
+    multiprocessing.util.Finalize(None, pyraf.iraf.flpr, exitpriority=10)
+
+    msg = "PyRAF session started in process %d (tasks: %s)"
+    logging.debug(msg % (os.getpid(), ", ".join(IRAF_TASKS)))
+
 
 class MissingFITSKeyword(RuntimeWarning):
     """ Warning about keywords that cannot be read from a header (non-fatal) """
@@ -121,6 +171,12 @@ class MissingFITSKeyword(RuntimeWarning):
     pass
 
 
+# The implementations of aperture photometry among which QPhot.run() can
+# choose: IRAF's qphot, the reference one, or our own NumPy-based version
+# (the aperphot module), which does all the work without leaving Python.
+BACKENDS = ("iraf", "numpy")
+
+
 typename = "QPhotResult"
 field_names = "x, y, mag, sum, flux, stdev"
 
@@ -192,16 +248,39 @@ class QPhotResult(collections.namedtuple(typename, field_names)):
             return (self.flux * gain) / math.sqrt(self.sum * gain)
 
 
-class QPhot(list):
+# The structured NumPy array in which QPhot stores the photometry of the
+# astronomical objects: one record per object, with the same fields as a
+# QPhotResult. INDEF magnitudes and standard deviations (None in QPhotResult)
+# are stored as NaN, so that they can be filtered out with array masks.
+QPHOT_DTYPE = numpy.dtype([(name, numpy.float64) for name in QPhotResult._fields])
+
+
+def _to_record(object_phot):
+    """ Return the QPhotResult as a tuple, with None replaced by NaN. """
+    return tuple(numpy.nan if value is None else value for value in object_phot)
+
+
+def _to_result(record):
+    """ Return the record of a QPHOT_DTYPE array as a QPhotResult object. """
+    return QPhotResult(*[None if value != value else value for value in record])
+
+
+class QPhot(object):
     """The photometry of an image, as returned by IRAF's qphot.
 
     This class stores the result of the photometry done by IRAF's qphot (quick
-    aperture photometer) on an image. A QPhotResult object is created for each
-    object listed in the text file: after calling QPhot.run(), this subclass of
-    the built-in list contains the photometric measurement of each astronomical
-    object. The order of these QPhotResult objects is guaranteed to respect
-    that in which coordinates are listed in the text file. In other words: the
-    i-th QPhotResult object corresponds to the i-th astronomical object.
+    aperture photometer) on an image. After calling QPhot.run(), the 'data'
+    attribute is a structured NumPy array (see QPHOT_DTYPE) with a record for
+    each object listed in the text file, but the object still behaves as a
+    sequence of QPhotResult objects: indexing or iterating over it returns the
+    photometric measurement of each astronomical object. The order of these
+    QPhotResult objects is guaranteed to respect that in which coordinates are
+    listed in the text file. In other words: the i-th QPhotResult object
+    corresponds to the i-th astronomical object.
+
+    Keeping the measurements in a single array makes QPhot objects compact to
+    pickle, and allows us to work with all the objects at once: for example,
+    with QPhot.snr(), which returns the signal-to-noise ratio of each one.
 
     """
 
@@ -220,11 +299,12 @@ class QPhot(list):
 
         """
 
-        super(list, self).__init__()
         self.image = fitsimage.FITSImage(img_path)
+        self.data = numpy.empty(0, dtype=QPHOT_DTYPE)
         self.coords_path = coords_path
 
-        for ra, dec, pm_ra, pm_dec in util.load_coordinates(self.coords_path):
+        coordinates = list(util.load_coordinates(self.coords_path))
+        for ra, dec, pm_ra, pm_dec in coordinates:
             if ra == 0 and dec == 0:
                 msg = (
                     "the right ascension and declination of one or more "
@@ -249,16 +329,76 @@ class QPhot(list):
                 )
                 raise ValueError(msg)
 
+        # Keep the right ascension and declination of the objects, so that the
+        # text file does not have to be parsed again to transform them to pixel
+        # coordinates (see _pixel_coordinates()).
+        radec = numpy.array([c[:2] for c in coordinates], dtype=numpy.float64)
+        self._radec = radec.reshape(-1, 2)
+
     @property
     def path(self):
         """ Return the path to the FITS image. """
         return self.image.path
 
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        """ Return a QPhotResult object, or a list of them for a slice. """
+
+        if isinstance(index, slice):
+            return [_to_result(record) for record in self.data[index].tolist()]
+        return _to_result(self.data[index].tolist())
+
+    def __setitem__(self, index, object_phot):
+        self.data[index] = _to_record(object_phot)
+
+    def __iter__(self):
+        for record in self.data.tolist():
+            yield _to_result(record)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
     def clear(self):
         """ Remove all the photometric measurements. """
-        del self[:]
+        self.data = numpy.empty(0, dtype=QPHOT_DTYPE)
+
+    def snr(self, gain):
+        """Return the signal-to-noise ratio of all the measurements at once.
+
+        The vectorized counterpart of QPhotResult.snr(): return a NumPy array
+        with the signal-to-noise ratio of each astronomical object, computed
+        exactly as that method does -- zero if 'sum' is zero and negative if it
+        is less than zero. Raises ValueError if 'gain' is not a positive value.
+
+        """
+
+        if gain <= 0:
+            raise ValueError("CCD gain must be a positive value")
 
-    def run(self, annulus, dannulus, aperture, exptimek, cbox=0):
+        sums = self.data["sum"] * gain
+        fluxes = self.data["flux"] * gain
+        nonzero = sums != 0
+
+        snrs = numpy.zeros(len(self))
+        signal = numpy.where(sums > 0, fluxes, -numpy.abs(fluxes))[nonzero]
+        snrs[nonzero] = signal / numpy.sqrt(numpy.abs(sums[nonzero]))
+        return snrs
+
+    def run(
+        self,
+        annulus,
+        dannulus,
+        aperture,
+        exptimek,
+        cbox=0,
+        backend="iraf",
+        numpy_centering=False,
+    ):
         """Run IRAF's qphot on the FITS image.
 
         This method is a wrapper, equivalent to (1) running 'qphot' on a FITS
@@ -311,6 +451,9 @@ class QPhot(list):
         Bug report that we have submitted to the IRAF development team:
         [URL] http://iraf.net/forum/viewtopic.php?showtopic=1468373
 
+        In order to do photometry with several apertures and the same sky
+        annulus, use run_apertures() instead: the image is measured only once.
+
         Arguments:
         annulus - the inner radius of the sky annulus, in pixels.
         dannulus - the width of the sky annulus, in pixels.
@@ -329,12 +472,155 @@ class QPhot(list):
                specified coordinates, but instead where IRAF has determined
                that the actual, accurate center of each object is. This is
                usually a good thing, and helps improve the photometry.
+        backend - the implementation of aperture photometry to use, one of
+                  the values in BACKENDS. With 'iraf' (the default value), the
+                  steps described above are followed. With 'numpy', instead,
+                  photometry is done in-process by _numpy_run(), without any
+                  temporary files or IRAF tasks involved.
+        numpy_centering - with the 'iraf' backend, compute the accurate
+                          centers of the objects with centers() instead of
+                          letting qphot do it. All the objects are recentered
+                          at once, and qphot is then given their pixel
+                          coordinates, with a centering box of zero, so the
+                          x- and y-coordinates of the QPhotResult objects are
+                          exactly those computed by NumPy. The 'numpy' backend
+                          always does this, so there it has no effect.
 
         """
 
+        kwargs = dict(cbox=cbox, backend=backend, numpy_centering=numpy_centering)
+        self.run_apertures(annulus, dannulus, [aperture], exptimek, **kwargs)
+        return len(self)
+
+    def run_apertures(
+        self,
+        annulus,
+        dannulus,
+        apertures,
+        exptimek,
+        cbox=0,
+        backend="iraf",
+        numpy_centering=False,
+    ):
+        """Do photometry on the FITS image with multiple apertures at once.
+
+        Equivalent to calling run() once for each aperture radius in the
+        'apertures' sequence, but the image is measured only once: IRAF's qphot
+        accepts a list of apertures, while the NumPy backend estimates the sky
+        of each object a single time and then sums the counts in each aperture.
+        As the sky annulus is the same, the x- and y-coordinates of the objects
+        and the standard deviations of the sky are identical for all apertures.
+
+        Returns a list with a QPhot object for each aperture, in the same order
+        as in 'apertures'. The first one is this same instance, which after the
+        call stores the photometry done with the first aperture; the rest are
+        copies of it, with the same FITS image and coordinates file. The other
+        arguments are the same as those of run().
+
+        """
+
+        if backend not in BACKENDS:
+            msg = "unknown photometry backend '%s' (must be one of %s)"
+            raise ValueError(msg % (backend, ", ".join(BACKENDS)))
+
+        if not len(apertures):
+            raise ValueError("at least one aperture is needed")
+
         self.clear()  # empty object
 
+        args = annulus, dannulus, apertures, exptimek
+        if backend == "numpy":
+            results = self._numpy_run(*args, cbox=cbox)
+        elif numpy_centering:
+            results = self._iraf_run(*args, centers=self.centers(cbox))
+        else:
+            results = self._iraf_run(*args, cbox=cbox)
+
+        self.data = results[0]
+        qphots = [self]
+        for aperture_data in results[1:]:
+            aperture_qphot = copy.copy(self)
+            aperture_qphot.data = aperture_data
+            qphots.append(aperture_qphot)
+        return qphots
+
+    def _pixel_coordinates(self):
+        """Return the pixel coordinates of the objects in the text file.
+
+        The celestial coordinates of all the objects are transformed to IRAF's
+        logical coordinates with a single call to WCS.all_world2pix(). Returns
+        a two-element tuple with the arrays of x- and y-coordinates, which are
+        empty if the text file does not list any object.
+
+        """
+
+        if not len(self._radec):
+            return numpy.empty(0), numpy.empty(0)
+
+        pixels = self.image._get_wcs().all_world2pix(self._radec, 1)
+        return pixels[:, 0], pixels[:, 1]
+
+    def centers(self, cbox):
+        """Return the accurate centers of the objects, computed with NumPy.
+
+        Transform the celestial coordinates of the objects to pixel coordinates
+        and, unless 'cbox' is zero, recenter all of them at once with the
+        centroid centering algorithm, using a centering box of 'cbox' pixels
+        (see aperphot.centroid()). The pixels of the image are memory-mapped,
+        so only those around each object are read. Returns a two-element tuple
+        with the arrays of x- and y-coordinates, which are NaN for the objects
+        whose celestial coordinates cannot be transformed to pixels.
+
+        """
+
+        x, y = self._pixel_coordinates()
+        if cbox and len(x):
+            with pyfits.open(self.path, mode="readonly", memmap=True) as hdulist:
+                x, y = aperphot.centroid(hdulist[0].data, x, y, cbox)
+        return x, y
+
+    def _iraf_run(self, annulus, dannulus, apertures, exptimek, cbox=0, centers=None):
+        """Do photometry on the FITS image with IRAF's qphot.
+
+        The IRAF-based implementation of run_apertures(), which must be used
+        instead of calling this method directly. Returns a list with, for each
+        aperture, a QPHOT_DTYPE array with the photometry of the astronomical
+        objects. qphot accepts a comma-separated list of apertures, and txdump then
+        outputs one 'mag', 'sum' and 'flux' field for each one of them.
+
+        If 'centers' is given, it must be a two-element tuple with the arrays of
+        x- and y-coordinates of the objects, such as that returned by centers().
+        They are then written to a temporary file and given to qphot as logical
+        coordinates, ignoring 'cbox', and used verbatim as the centers of the
+        resulting QPhotResult objects: txdump outputs only three decimals.
+
+        """
+
+        napertures = len(apertures)
+        results = [[] for _ in xrange(napertures)]
+
         try:
+            coords_path = self.coords_path
+            kwargs = dict(cbox=cbox, wcsin="world")
+
+            if centers is not None:
+                coords_fd, coords_path = tempfile.mkstemp(
+                    prefix=os.path.basename(self.path), suffix=".xy", text=True
+                )
+
+                # Objects whose coordinates are NaN are sent far off the image,
+                # where qphot cannot measure them (so they are INDEF) and their
+                # centers set back to the fallback value of -1 after parsing.
+                x, y = centers
+                finite = numpy.isfinite(x) & numpy.isfinite(y)
+                for index in xrange(len(x)):
+                    if finite[index]:
+                        os.write(coords_fd, "%.10f\t%.10f\n" % (x[index], y[index]))
+                    else:
+                        os.write(coords_fd, "-1000000\t-1000000\n")
+                os.close(coords_fd)
+                kwargs = dict(cbox=0, wcsin="logical")
+
             # Temporary file to which the APPHOT text database produced by
             # qphot will be saved. Even if empty, it must be deleted before
             # calling qphot. Otherwise, an error message, stating that the
@@ -361,20 +647,21 @@ class QPhot(list):
             stderr = util.StreamToWarningFilter(*args)
 
             # Run qphot on the image and save the output to our temporary file.
-            kwargs = dict(
-                cbox=cbox,
+            kwargs.update(
                 annulus=annulus,
                 dannulus=dannulus,
-                aperture=aperture,
-                coords=self.coords_path,
+                aperture=",".join("%f" % x for x in apertures),
+                coords=coords_path,
                 output=qphot_output,
                 exposure=exptimek,
-                wcsin="world",
                 interactive="no",
                 Stderr=stderr,
             )
 
-            apphot.qphot(self.path, **kwargs)
+            start_time = time.time()
+            get_iraf_task("qphot")(self.path, **kwargs)
+            msg = "%s: qphot took %.3f seconds"
+            logging.debug(msg % (self.path, time.time() - start_time))
 
             # Make sure the output was written to where we said
             assert os.path.exists(qphot_output)
@@ -393,13 +680,16 @@ class QPhot(list):
             # work with unicode, if we happen to come across it: PyRAF requires
             # that redirection be to a file handle or string.
 
+            start_time = time.time()
             txdump_fields = ["xcenter", "ycenter", "mag", "sum", "flux", "stdev"]
-            pyraf.iraf.txdump(
+            get_iraf_task("txdump")(
                 qphot_output,
                 fields=",".join(txdump_fields),
                 Stdout=str(txdump_output),
                 expr="yes",
             )
+            msg = "%s: txdump took %.3f seconds"
+            logging.debug(msg % (self.path, time.time() - start_time))
 
             # Now open the output file again and parse the output of txdump,
             # creating a QPhotResult object for each record.
@@ -440,38 +730,49 @@ class QPhot(list):
                         logging.debug(msg % self.path)
                         ycenter = -1
 
-                    try:
-                        mag_str = fields[2]
-                        mag = float(mag_str)
-                        msg = "%s: mag = %.5f" % (self.path, mag)
-                        logging.debug(msg)
-                    except ValueError:  # float("INDEF")
-                        assert mag_str == "INDEF"
-                        msg = "%s: mag = None ('INDEF')" % self.path
-                        logging.debug(msg)
-                        mag = None
-
-                    sum_ = float(fields[3])
-                    msg = "%s: sum = %.5f" % (self.path, sum_)
-                    logging.debug(msg)
-
-                    flux = float(fields[4])
-                    msg = "%s: flux = %.5f" % (self.path, flux)
-                    logging.debug(msg)
+                    if centers is not None:
+                        index = len(results[0])
+                        if finite[index]:
+                            xcenter, ycenter = float(x[index]), float(y[index])
+                        else:
+                            xcenter = ycenter = -1
 
+                    # With N apertures, the fields are: xcenter, ycenter, N
+                    # magnitudes, N sums, N fluxes and the standard deviation.
                     try:
-                        stdev_str = fields[5]
+                        stdev_str = fields[2 + 3 * napertures]
                         stdev = float(stdev_str)
                         msg = "%s: stdev = %.5f" % (self.path, stdev)
                         logging.debug(msg)
                     except ValueError:  # float("INDEF")
                         assert stdev_str == "INDEF"
-                        msg = "%s: stdev = None ('INDEF')" % self.path
+                        msg = "%s: stdev = NaN ('INDEF')" % self.path
+                        logging.debug(msg)
+                        stdev = numpy.nan
+
+                    for index in xrange(napertures):
+
+                        try:
+                            mag_str = fields[2 + index]
+                            mag = float(mag_str)
+                            msg = "%s: mag[%d] = %.5f" % (self.path, index, mag)
+                            logging.debug(msg)
+                        except ValueError:  # float("INDEF")
+                            assert mag_str == "INDEF"
+                            msg = "%s: mag[%d] = NaN ('INDEF')"
+                            logging.debug(msg % (self.path, index))
+                            mag = numpy.nan
+
+                        sum_ = float(fields[2 + napertures + index])
+                        msg = "%s: sum[%d] = %.5f" % (self.path, index, sum_)
+                        logging.debug(msg)
+
+                        flux = float(fields[2 + 2 * napertures + index])
+                        msg = "%s: flux[%d] = %.5f" % (self.path, index, flux)
                         logging.debug(msg)
-                        stdev = None
 
-                    args = xcenter, ycenter, mag, sum_, flux, stdev
-                    self.append(QPhotResult(*args))
+                        record = xcenter, ycenter, mag, sum_, flux, stdev
+                        results[index].append(record)
 
         finally:
 
@@ -489,14 +790,129 @@ class QPhot(list):
             except NameError:
                 pass
 
-        return len(self)
+            # Never delete the coordinates file given to QPhot.__init__()
+            if coords_path != self.coords_path:
+                util.clean_tmp_files(coords_path)
+
+        return [numpy.array(records, dtype=QPHOT_DTYPE) for records in results]
+
+    def _numpy_run(self, annulus, dannulus, apertures, exptimek, cbox=0):
+        """Do photometry on the FITS image using NumPy instead of IRAF.
+
+        The NumPy-based counterpart of _iraf_run(), which returns the same list
+        of QPHOT_DTYPE arrays, one for each aperture, and must not be called
+        directly either. The celestial coordinates listed in the text file are
+        transformed to pixel coordinates with a single call to
+        astropy.wcs.WCS.all_world2pix(), the pixels of the image are read once
+        (memory-mapped, so only those around the objects actually have to be
+        loaded) and all the objects are measured at once by the functions of
+        the aperphot module. The resulting records follow the conventions of
+        IRAF's qphot: INDEF magnitudes and standard deviations are NaN, objects
+        with non-finite pixel coordinates have their x- and y-coordinates set
+        to -1, and magnitudes use a zero point of 25 and are normalized to an
+        exposure time of one time unit. If 'exptimek' cannot be read from the
+        FITS header the MissingFITSKeyword warning is issued, just as run()
+        does, and magnitudes are not normalized.
+
+        """
+
+        try:
+            exptime = float(self.image.read_keyword(exptimek))
+        except KeyError:
+            # Same message that IRAF's qphot writes to standard error
+            msg = "%s  Keyword: %s not found" % (self.path, exptimek)
+            warnings.warn(msg, MissingFITSKeyword)
+            exptime = 1.0
+
+        x, y = self._pixel_coordinates()
+        if not len(x):
+            return [numpy.empty(0, dtype=QPHOT_DTYPE) for _ in apertures]
+
+        logging.info("%s: doing photometry with NumPy..." % self.path)
+        with pyfits.open(self.path, mode="readonly", memmap=True) as hdulist:
+            data = hdulist[0].data
+            if cbox:
+                x, y = aperphot.centroid(data, x, y, cbox)
+            args = data, x, y, list(apertures), annulus, dannulus
+            mags, sums, fluxes, stdevs = aperphot.measure(*args, exptime=exptime)
+
+        finite = numpy.isfinite(x) & numpy.isfinite(y)
+        results = []
+        for index in xrange(len(apertures)):
+            data = numpy.empty(len(x), dtype=QPHOT_DTYPE)
+            data["x"] = numpy.where(finite, x, -1)
+            data["y"] = numpy.where(finite, y, -1)
+            data["mag"] = mags[index]
+            data["sum"] = sums[index]
+            data["flux"] = fluxes[index]
+            data["stdev"] = stdevs
+            results.append(data)
+
+        msg = "%s: NumPy photometry done on %d objects, %d apertures"
+        logging.debug(msg % (self.path, len(x), len(apertures)))
+        return results
+
+
+def _coordinates_arrays(coordinates):
+    """Return the celestial coordinates and proper motions as NumPy arrays.
+
+    Return a four-element tuple with the arrays of right ascensions,
+    declinations and proper motions in right ascension and declination of
+    'coordinates', an iterable of astromatic.Coordinates objects. Unknown
+    proper motions (None) are set to zero, as in that case no correction can
+    be applied: the object is assumed not to move. Either both or none of the
+    proper motions of an object must be None -- we cannot know one but not
+    the other!
+
+    """
+
+    rows = []
+    for coord in coordinates:
+        if None in (coord.pm_ra, coord.pm_dec):
+            assert coord.pm_ra is None
+            assert coord.pm_dec is None
+        rows.append((coord.ra, coord.dec, coord.pm_ra or 0, coord.pm_dec or 0))
+
+    return tuple(numpy.array(rows, dtype=numpy.float64).reshape(-1, 4).T)
+
+
+def _apply_proper_motions(ra, dec, pm_ra, pm_dec, year, epoch):
+    """ Return the arrays of coordinates corrected for proper motions. """
+
+    elapsed = year - epoch
+    return ra + (pm_ra * elapsed) / 3600, dec + (pm_dec * elapsed) / 3600
+
+
+def exact_coordinates(coordinates, year, epoch):
+    """Apply proper-motion correction to all the objects at once.
+
+    The vectorized counterpart of Coordinates.get_exact_coordinates(): return
+    a two-element tuple with the arrays of right ascensions and declinations
+    of the astronomical objects in 'coordinates', an iterable of Coordinates
+    objects, for a given date, 'year'. The coordinates of those objects whose
+    proper motions are unknown (None) or zero are returned unmodified.
+
+    """
+
+    args = _coordinates_arrays(coordinates) + (year, epoch)
+    return _apply_proper_motions(*args)
+
+
+def _write_coords_file(ra, dec, **kwargs):
+    """ Write the coordinates to a temporary file, return its path. """
+
+    fd, path = tempfile.mkstemp(text=True, **kwargs)
+    with os.fdopen(fd, "wt") as output:
+        rows = numpy.column_stack((ra, dec))
+        numpy.savetxt(output, rows, fmt="%.10f", delimiter="\t")
+    return path
 
 
 def get_coords_file(coordinates, year, epoch):
     """Return a coordinates file with the exact positions of the objects.
 
-    Loop over 'coordinates', an iterable of astromatic.Coordinates objects, and
-    apply proper motion correction, obtaining their exact positions for a given
+    Apply proper motion correction to 'coordinates', an iterable of
+    astromatic.Coordinates objects, obtaining their exact positions for a given
     date. These proper-motion corrected coordinates are written to a temporary
     text file, listed one astronomical object per line and in two columns:
     right ascension and declination. Returns the path to the temporary file.
@@ -510,30 +926,49 @@ def get_coords_file(coordinates, year, epoch):
 
     """
 
-    kwargs = dict(prefix="%f_" % year, suffix="_J%d.coords" % epoch, text=True)
+    ra, dec = exact_coordinates(coordinates, year, epoch)
+    kwargs = dict(prefix="%f_" % year, suffix="_J%d.coords" % epoch)
+    return _write_coords_file(ra, dec, **kwargs)
 
-    fd, path = tempfile.mkstemp(**kwargs)
-    fmt = "\t".join(["%.10f", "%.10f\n"])
 
-    for coord in coordinates:
+# Coordinates files of the sets of objects without proper motions, whose
+# positions are therefore the same in every image. Each one is written only
+# the first time that it is needed, and deleted when the process exits. The
+# keys are the tuples of astromatic.Coordinates objects, so that sets with
+# the same coordinates (even if they are different Python objects, as is the
+# case when they are sent to worker processes) map to the same file.
+_static_coords_files = {}
+MAX_STATIC_COORDS_FILES = 16
 
-        # Do not apply any correction if pm_ra and pm_dec are None (which means
-        # that the proper motion of the object is unknown) or zero (because in
-        # this case the coordinates are always the same). Make sure also that
-        # either none or both proper motions are None: we cannot know one but
-        # not the other!
 
-        if None in (coord.pm_ra, coord.pm_dec):
-            assert coord.pm_ra is None
-            assert coord.pm_dec is None
+def _get_static_coords_file(coordinates):
+    """Return a coordinates file for objects without proper motions.
 
-        if coord.pm_ra or coord.pm_dec:
-            coord = coord.get_exact_coordinates(year, epoch=epoch)
+    Equivalent to get_coords_file() for a tuple of Coordinates objects whose
+    proper motions are all unknown or zero, but the file is cached: the same
+    path is returned, without writing the coordinates again, every time this
+    function is called for the same objects. The file must not be deleted by
+    the caller, as it is automatically removed when the process exits.
 
-        os.write(fd, fmt % coord[:2])
+    """
 
-    os.close(fd)
-    return path
+    try:
+        return _static_coords_files[coordinates]
+    except KeyError:
+        if len(_static_coords_files) >= MAX_STATIC_COORDS_FILES:
+            for path in _static_coords_files.itervalues():
+                util.clean_tmp_files(path)
+            _static_coords_files.clear()
+
+        ra, dec = _coordinates_arrays(coordinates)[:2]
+        path = _write_coords_file(ra, dec, suffix=".coords")
+        _static_coords_files[coordinates] = path
+
+        # Finalizers registered by the parent process are discarded in forked
+        # worker processes, so each file is deleted only by its creator.
+        args = (path,)
+        multiprocessing.util.Finalize(None, util.clean_tmp_files, args, exitpriority=1)
+        return path
 
 
 def run(
@@ -549,6 +984,8 @@ def run(
     exptimek,
     uncimgk,
     cbox=0,
+    backend="iraf",
+    numpy_centering=False,
 ):
     """Do photometry on a FITS image.
 
@@ -568,7 +1005,10 @@ def run(
     epoch - the epoch of the coordinates of the astronomical objects, used to
             compute the proper-motion correction. Must be an integer, such as
             2000 for J2000.
-    aperture - the aperture radius, in pixels.
+    aperture - the aperture radius, in pixels. May also be a sequence of radii,
+               in which case photometry is done with all of them at once (see
+               QPhot.run_apertures()) and, instead of a QPhot object, a list
+               with one for each aperture, in the same order, is returned.
     annulus - the inner radius of the sky annulus, in pixels.
     dannulus - the width of the sky annulus, in pixels.
     maximum - number of ADUs at which saturation arises. If one or more pixels
@@ -606,6 +1046,13 @@ def run(
            coordinates, but instead where IRAF has determined that the actual,
            accurate center of each object is. This is usually a good thing, and
            helps improve the photometry.
+    backend - the implementation of aperture photometry to use: 'iraf' (the
+              default value), for IRAF's qphot, or 'numpy', for the in-process
+              alternative. Refer to QPhot.run() for further information.
+    numpy_centering - with the 'iraf' backend, recenter all the objects at once
+                      with NumPy, instead of letting qphot do it one by one. See
+                      QPhot.run(). Either way, saturation is then checked for
+                      on the very centers where photometry was done.
 
     """
 
@@ -619,46 +1066,63 @@ def run(
     # created with IPAC's Montage): when that happens we cannot apply proper
     # motion corrections, that's right, but that's not an issue if none of our
     # objects have a known proper motion.
+    #
+    # If that is the case, the coordinates of the objects are the same in all
+    # the images, so the coordinates file is written only once (and cached)
+    # instead of every time that we do photometry on an image.
 
-    for coord in coordinates:
+    coordinates = tuple(coordinates)
+    static_coords = coordinates in _static_coords_files
 
-        if coord.pm_ra or coord.pm_dec:
-            try:
-                year = img.year(**kwargs)
-                break
+    if not static_coords:
+        ra, dec, pm_ra, pm_dec = _coordinates_arrays(coordinates)
+        static_coords = not (pm_ra.any() or pm_dec.any())
 
-            except KeyError as e:
-                # Include the missing FITS keyword in the exception message
-                regexp = "keyword '(?P<keyword>.*?)' not found"
-                match = re.search(regexp, str(e))
-                assert match is not None
-                msg = (
-                    "{0}: keyword '{1}' not found. It is needed in order "
-                    "to be able to apply proper-motion correction, as one "
-                    "or more astronomical objects have known proper motions".format(
-                        img.path, match.group("keyword")
-                    )
-                )
-                raise KeyError(msg)
+    if static_coords:
+        coords_path = _get_static_coords_file(coordinates)
 
-        else:
-            # No object has a known proper motion, so don't call
-            # FITSImage.year().  Use the same value as the epoch, so that when
-            # get_coords_file() below applies the proper motion correction the
-            # input and output coordinates are the same.
-            year = epoch
+    else:
+        try:
+            year = img.year(**kwargs)
+
+        except KeyError as e:
+            # Include the missing FITS keyword in the exception message
+            regexp = "keyword '(?P<keyword>.*?)' not found"
+            match = re.search(regexp, str(e))
+            assert match is not None
+            msg = (
+                "{0}: keyword '{1}' not found. It is needed in order "
+                "to be able to apply proper-motion correction, as one "
+                "or more astronomical objects have known proper motions".format(
+                    img.path, match.group("keyword")
+                )
+            )
+            raise KeyError(msg)
 
-    # The proper-motion corrected objects coordinates
-    coords_path = get_coords_file(coordinates, year, epoch)
+        # The proper-motion corrected objects coordinates
+        ra, dec = _apply_proper_motions(ra, dec, pm_ra, pm_dec, year, epoch)
+        kwargs = dict(prefix="%f_" % year, suffix="_J%d.coords" % epoch)
+        coords_path = _write_coords_file(ra, dec, **kwargs)
 
-    img_qphot = QPhot(img.path, coords_path)
-    img_qphot.run(annulus, dannulus, aperture, exptimek, cbox=cbox)
+    apertures = list(numpy.atleast_1d(aperture))
+    try:
+        img_qphot = QPhot(img.path, coords_path)
+        args = annulus, dannulus, apertures, exptimek
+        kwargs = dict(cbox=cbox, backend=backend, numpy_centering=numpy_centering)
+        qphots = img_qphot.run_apertures(*args, **kwargs)
+    finally:
+        if not static_coords:
+            os.unlink(coords_path)
 
     # How do we know whether one or more pixels in the aperture are above a
-    # saturation threshold? As suggested by Frank Valdes at the IRAF.net
-    # forums, we can make a mask of the saturated values, on which we can do
-    # photometry using the same aperture. If we get a non-zero flux, we know it
-    # has saturation: http://iraf.net/forum/viewtopic.php?showtopic=1466068
+    # saturation threshold? IRAF's qphot, per se, provides no way of knowing
+    # it, so we read the pixels in the aperture of each object from the FITS
+    # image and compare the brightest one to the saturation level. This used
+    # to be done by making a mask of the saturated values with IRAF's imexpr
+    # and running qphot a second time, on the mask, using the same aperture,
+    # as suggested by Frank Valdes at the IRAF.net forums. That, however,
+    # doubled the cost of photometry and wrote a full-size FITS image to disk:
+    # http://iraf.net/forum/viewtopic.php?showtopic=1466068
 
     if not uncimgk:
         orig_img_path = img.path
@@ -670,99 +1134,44 @@ def run(
             args = orig_img_path, uncimgk, img.path
             raise IOError(msg % args)
 
-    try:
-        # Temporary file to which the saturation mask is saved
-        basename = os.path.basename(orig_img_path)
-        mkstemp_prefix = "%s_satur_mask_%d_ADUS_" % (basename, maximum)
-        kwargs = dict(prefix=mkstemp_prefix, suffix=".fits", text=True)
-        mask_fd, satur_mask_path = tempfile.mkstemp(**kwargs)
-        os.close(mask_fd)
-
-        # IRAF's imexpr won't overwrite the file. Instead, it will raise an
-        # IrafError exception stating that "IRAF task terminated abnormally
-        # ERROR (1121, "FXF: EOF encountered while reading FITS file".
-        os.unlink(satur_mask_path)
-
-        # The expression that will be given to 'imexpr'. The space after the
-        # colon is needed to avoid sexigesimal interpretation. 'a' is the first
-        # and only operand, linked to our image at the invokation of the task.
-        expr = "a>%d ? 1 : 0" % maximum
-        logging.debug("%s: imexpr = '%s'" % (img.path, expr))
-        logging.debug("%s: a = %s" % (img.path, orig_img_path))
-        logging.info("%s: Running IRAF's imexpr..." % img.path)
-        pyraf.iraf.images.imexpr(
-            expr,
-            a=orig_img_path,
-            output=satur_mask_path,
-            verbose="yes",
-            Stdout=util.LoggerWriter("debug"),
-        )
-
-        assert os.path.exists(satur_mask_path)
-
-        msg = "%s: IRAF's imexpr OK" % img.path
-        logging.info(msg)
-        msg = "%s: IRAF's imexpr output = %s"
-        logging.debug(msg % (img.path, satur_mask_path))
-
-        # Now we just do photometry again, on the same pixels, but this time on
-        # the saturation mask. Those objects for which we get a non-zero flux
-        # will be known to be saturated and their magnitude set to infinity.
-
-        # If 'cbox' is other than zero, the center of each object may have been
-        # recentered by qphot using the centroid centering algorithm. When that
-        # is the case, we need to feed run() with these more accurate centers.
-        # Since the QPhotResult objects contain x- and y-coordinates (qphot
-        # does not support 'world' coordinates as the output system), we need
-        # to convert them back to right ascension and declination.
-
-        if cbox:
-
-            root, _ = os.path.splitext(os.path.basename(img.path))
-            kwargs = dict(prefix=root + "_", suffix="_satur.coords", text=True)
-
-            os.unlink(coords_path)
-            fd, coords_path = tempfile.mkstemp(**kwargs)
-            for object_phot in img_qphot:
-                centered_x, centered_y = object_phot.x, object_phot.y
-                ra, dec = img.pix2world(centered_x, centered_y)
-                os.write(fd, "{0} {1}\n".format(ra, dec))
-            os.close(fd)
-
-        mask_qphot = QPhot(satur_mask_path, coords_path)
-        # No centering this time: if cbox != 0 the accurate centers for each
-        # astronomical object have been computed using the centroid centering
-        # algorithm, so we're already feeding run() with the accurate values.
-        mask_qphot.run(annulus, dannulus, aperture, exptimek, cbox=0)
-        os.unlink(coords_path)
-
-        assert len(img_qphot) == len(mask_qphot)
-        for object_phot, object_mask in itertools.izip(img_qphot, mask_qphot):
-
-            if __debug__:
-
-                # In cbox != 0 we cannot expect the coordinates to be the exact
-                # same: the previous call to run() returned x and y coordinates
-                # that we converted to celestial coordinates, and now qphot is
-                # giving as output image coordinates again. It is unavoidable
-                # to lose some precision. Anyway, this does not affect the
-                # result: photometry was still done on almost the absolute
-                # exact coordinates that we wanted it to.
-
-                if not cbox:
-                    assert object_phot.x == object_mask.x
-                    assert object_phot.y == object_mask.y
-
-            if object_mask.flux > 0:
-                object_phot = object_phot._replace(mag=float("infinity"))
-    finally:
-
-        # Remove saturation mask. The try-except is necessary because an
-        # exception may be raised before 'satur_mask_path' is defined.
-
-        try:
-            util.clean_tmp_files(satur_mask_path)
-        except NameError:
-            pass
-
+    # The original image is expected to be the very same image on which we do
+    # photometry, only before calibration, so it shares the same pixel grid.
+    # We can, therefore, directly use the x- and y-coordinates (recentered if
+    # 'cbox' is other than zero) where photometry has been done, instead of
+    # going back to celestial coordinates, with the loss of precision that
+    # would entail. The pixels are memory-mapped, so only those around each
+    # astronomical object are actually read from disk.
+
+    msg = "%s: checking saturation on %s (%d ADUs)"
+    logging.debug(msg % (img.path, orig_img_path, maximum))
+
+    # The centers of the objects are the same for all the apertures
+    x = img_qphot.data["x"]
+    y = img_qphot.data["y"]
+
+    with pyfits.open(orig_img_path, mode="readonly", memmap=True) as hdulist:
+        data = hdulist[0].data
+        if data.shape[::-1] != tuple(img.size):
+            msg = "%s: size of image %s (keyword '%s') does not match (%s vs %s)"
+            args = img.path, orig_img_path, uncimgk, data.shape[::-1], tuple(img.size)
+            raise ValueError(msg % args)
+        peaks = [aperphot.max_pixels(data, x, y, radius) for radius in apertures]
+
+    for radius, aperture_qphot, aperture_peaks in zip(apertures, qphots, peaks):
+        # Objects with an INDEF magnitude stay INDEF: infinity is reserved for
+        # those that can be measured but are saturated. This is also what keeps
+        # the objects off the image, which are INDEF, from being marked as
+        # saturated: max_pixels() may not return NaN for their fallback -1 x-
+        # and y-coordinates, as pixel (1, 1) is within aperture + 0.5 pixels of
+        # (-1, -1) if the aperture radius is larger than about 2.3 pixels.
+        mags = aperture_qphot.data["mag"]
+        with numpy.errstate(invalid="ignore"):
+            saturated = (aperture_peaks > maximum) & ~numpy.isnan(mags)
+        mags[saturated] = numpy.inf
+
+        msg = "%s: %d objects saturated (> %d ADUs) with aperture %.3f"
+        logging.debug(msg % (img.path, saturated.sum(), maximum, radius))
+
+    if numpy.ndim(aperture):
+        return qphots
     return img_qphot
@@ -33,6 +33,8 @@ number of sources is at a given percentile and which has the best FWHM.
 """
 
 import atexit
+import contextlib
+import hashlib
 import logging
 import multiprocessing
 import numpy
@@ -42,6 +44,7 @@ import os.path
 import scipy.stats
 import scipy.signal
 import shutil
+import sqlite3
 import sys
 import tempfile
 import time
@@ -434,6 +437,129 @@ class FITSeeingImage(fitsimage.FITSImage):
             return numpy.mean(elongations)
 
 
+class FWHMCache(object):
+    """An on-disk cache of the FWHM of FITS images.
+
+    Computing the FWHM of an image that has not been through the 'seeing'
+    command, and therefore does not have it in its header, requires running
+    SExtractor on it, which takes seconds. This class stores these FWHMs in a
+    SQLite database, so that they are computed only once, even across runs of
+    different commands (such as 'photometry' and 'annuli') on the same images.
+
+    Each FWHM is stored under the two-element tuple returned by key(): the
+    SHA-1 checksum of the pixel data of the image and the MD5 hash of the
+    parameters with which the FWHM was computed, the SExtractor configuration
+    included. In this manner, the cache cannot return an outdated value if the
+    image or the configuration change, and may be safely shared among all the
+    observing campaigns. Several processes may use the same cache at once.
+
+    Computing the checksum of the pixels requires reading them all, so it is
+    also cached, under the path, modification time and size of the image. A
+    second run on the same images, if none of them has been modified, finds
+    their FWHMs without reading a single pixel.
+
+    """
+
+    # Seconds to wait for another process to release the database lock
+    TIMEOUT = 60
+
+    def __init__(self, path):
+        self.path = path
+        with contextlib.closing(self._connect()) as connection:
+            with connection:  # commit automatically
+                connection.execute(
+                    """
+                CREATE TABLE IF NOT EXISTS fwhms (
+                    data_sha1sum TEXT NOT NULL,
+                    parameters   TEXT NOT NULL,
+                    fwhm         REAL NOT NULL,
+                    PRIMARY KEY (data_sha1sum, parameters))
+                """
+                )
+
+                connection.execute(
+                    """
+                CREATE TABLE IF NOT EXISTS checksums (
+                    path         TEXT PRIMARY KEY,
+                    mtime        REAL NOT NULL,
+                    size         INTEGER NOT NULL,
+                    data_sha1sum TEXT NOT NULL)
+                """
+                )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=self.TIMEOUT)
+
+    def data_sha1sum(self, img):
+        """Return the SHA-1 checksum of the pixel data of a FITS image.
+
+        Equivalent to img.data_sha1sum, but the checksum is read from the
+        cache if the file has not been modified since it was computed, and
+        stored in it otherwise. 'img' must be a fitsimage.FITSImage object.
+
+        """
+
+        stat = os.stat(img.path)
+        t = os.path.abspath(img.path), stat.st_mtime, stat.st_size
+        with contextlib.closing(self._connect()) as connection:
+            cursor = connection.execute(
+                "SELECT data_sha1sum FROM checksums "
+                "WHERE path = ? AND mtime = ? AND size = ?",
+                t,
+            )
+            row = cursor.fetchone()
+            if row is not None:
+                return str(row[0])
+
+            checksum = img.data_sha1sum
+            with connection:  # commit automatically
+                t += (checksum,)
+                stmt = "INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?)"
+                connection.execute(stmt, t)
+            return checksum
+
+    def key(self, img, maximum, margin, coaddk, per, mode):
+        """Return the key under which the FWHM of a FITS image is cached.
+
+        'img' must be a fitsimage.FITSImage object, while the other arguments
+        are those that FITSeeingImage.__init__() and FITSeeingImage.fwhm()
+        would receive in order to compute the FWHM. The checksum of the pixel
+        data of the image is that returned by FWHMCache.data_sha1sum(), so the
+        pixels are only read if the file is new or has been modified.
+
+        """
+
+        # The same SATUR_LEVEL with which FITSeeingImage runs SExtractor
+        satur_level = img.saturation(maximum, coaddk=coaddk)
+        options = dict(SATUR_LEVEL=str(satur_level))
+        sex_md5sum = astromatic.sextractor_md5sum(options=options)
+
+        md5 = hashlib.md5()
+        for value in (sex_md5sum, margin, per, mode):
+            md5.update(str(value))
+        return self.data_sha1sum(img), md5.hexdigest()
+
+    def __getitem__(self, key):
+        """ Return the cached FWHM; raises KeyError if it is not cached """
+
+        with contextlib.closing(self._connect()) as connection:
+            cursor = connection.execute(
+                "SELECT fwhm FROM fwhms WHERE data_sha1sum = ? AND parameters = ?", key
+            )
+            row = cursor.fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def __setitem__(self, key, fwhm):
+        """ Store the FWHM in the cache, overwriting the previous value """
+
+        with contextlib.closing(self._connect()) as connection:
+            with connection:  # commit automatically
+                t = key + (float(fwhm),)
+                connection.execute("INSERT OR REPLACE INTO fwhms VALUES (?, ?, ?)", t)
+
+
 # This Queue is global -- this works, but note that we could have
 # passed its reference to the function managed by pool.map_async.
 # See http://stackoverflow.com/a/3217427/184363
@@ -205,5 +205,57 @@ def mean_snr(snrs, weights=None):
     return error_to_snr(error)
 
 
+def _positive_errors(snrs):
+    """Return the positive errors in magnitudes of an array of SNRs.
+
+    Equivalent to calling snr_to_error() for each signal-to-noise ratio and
+    taking the second of the two values, but on whole NumPy arrays. Raises
+    ValueError if any of the signal-to-noise ratios is not above one.
+
+    """
+
+    snrs = numpy.asarray(snrs)
+    if numpy.any(snrs <= 1):
+        raise ValueError("SNR cannot be less than or equal to one")
+    return -2.5 * numpy.log10(1 - 1 / snrs)
+
+
+def _errors_to_snrs(errors):
+    """ Vectorized version of error_to_snr(), for arrays of errors """
+    errors = numpy.asarray(errors)
+    return numpy.where(errors < 0, 1, -1) / (10 ** (errors / -2.5) - 1)
+
+
+def mean_snrs(snrs, weights):
+    """Return the SNR of the weighted mean of each column of SNRs.
+
+    Vectorized version of mean_snr(): 'snrs' is a two-dimensional array, with
+    as many rows as values are averaged, and an array with the SNR of the
+    weighted mean of each column is returned. The i-th weight corresponds to
+    the i-th row, and the weights are normalized to sum up to one.
+
+    """
+
+    weights = numpy.asarray(weights)
+    weights = weights / weights.sum()
+    errors = _positive_errors(snrs)
+    error = numpy.sqrt(numpy.dot(weights ** 2, errors ** 2))
+    return _errors_to_snrs(error)
+
+
+def difference_snrs(*snrs):
+    """Return the SNR of the difference of a series of arrays of SNRs.
+
+    Vectorized version of difference_snr(): each argument is an array of
+    signal-to-noise ratios, all of them of the same shape, and an array with
+    the SNR of the difference of the values at each position is returned.
+
+    """
+
+    errors = [_positive_errors(s) for s in snrs]
+    error = numpy.sqrt(sum(e ** 2 for e in errors))
+    return _errors_to_snrs(error)
+
+
 if __name__ == "__main__":
     pass
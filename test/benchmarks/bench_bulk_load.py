@@ -0,0 +1,88 @@
+#! /usr/bin/env python2
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare how fast photometry is stored in a LEMONdB in the default, safe mode
+and within LEMONdB.bulk_load(). For each mode, a LEMONdB is created in a
+temporary file, to which the photometry of --stars stars in --images images is
+added with add_photometry_batch(), committing after each image, as photometry
+does. Rebuilding the indexes and running ANALYZE on exit from bulk_load() is
+included in the time. Run it from the root directory of LEMON:
+
+    $ python -m test.benchmarks.bench_bulk_load --images 500 --stars 5000
+
+"""
+
+from __future__ import division
+
+import contextlib
+import random
+import sys
+
+# LEMON modules
+import database
+from test.benchmarks import common
+
+
+@contextlib.contextmanager
+def safe_mode(db):
+    yield db
+
+
+def benchmark(mode, nimages, nstars):
+    """ Return the number of rows per second inserted in this mode """
+
+    with common.temporary_file("_bench_bulk_load.LEMONdB") as path:
+        with database.LEMONdB(path) as db:
+            common.add_stars(db, nstars)
+            db.commit()
+
+            with common.Timer() as timer:
+                with mode(db):
+                    for index in xrange(nimages):
+                        img = common.image(1e9 + index * 60)
+                        db.add_image(img)
+                        rows = (
+                            (star_id, random.uniform(10, 20), random.uniform(1, 1000))
+                            for star_id in xrange(nstars)
+                        )
+                        db.add_photometry_batch(img, rows)
+                        db.commit()
+            return timer.rate(nimages * nstars)
+
+
+def main(arguments=None):
+
+    counts = (
+        ("images", 200, "number of images to store"),
+        ("stars", 5000, "number of stars measured in each image"),
+    )
+    options = common.parse_args(__doc__, counts, arguments=arguments)
+
+    for name, mode in (
+        ("safe mode", safe_mode),
+        ("bulk load", database.LEMONdB.bulk_load),
+    ):
+        speed = benchmark(mode, options.images, options.stars)
+        print "%-10s: %10.1f rows/s" % (name, speed)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+#! /usr/bin/env python2
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure how long LEMONdBMiner.sort_by_curve_stdev() takes on a large LEMONdB.
+A database with the light curves of --stars stars, each one of them with
+--points points, is created in a temporary file, and then the stars sorted by
+the standard deviation of their curves --repeat times. LEMONdBMiner memoizes
+the light curves, so only the first call reads them from the database: the
+others show how fast the cached LightCurve statistics are. Run it from the
+root directory of LEMON:
+
+    $ python -m test.benchmarks.bench_curve_stdev --stars 20000 --points 500
+
+"""
+
+from __future__ import division
+
+import random
+import sys
+
+# LEMON modules
+import database
+import mining
+from test.benchmarks import common
+
+
+def populate(db, nstars, npoints):
+    """ Add 'nstars' stars with a light curve of 'npoints' points each """
+
+    common.add_stars(db, nstars)
+    unix_times = [1e9 + index * 60 for index in xrange(npoints)]
+    for unix_time in unix_times:
+        db.add_image(common.image(unix_time))
+
+    curves = []
+    for star_id in xrange(nstars):
+        cstars = [(star_id + 1) % nstars]
+        curve = database.LightCurve(common.PFILTER, cstars, [1.0], [0.01])
+        for unix_time in unix_times:
+            curve.add(unix_time, random.gauss(0, 0.1), random.uniform(50, 500))
+        curves.append((star_id, curve))
+    db.add_light_curves(curves)
+    db.commit()
+
+
+def main(arguments=None):
+
+    counts = (
+        ("stars", 5000, "number of stars in the LEMONdB"),
+        ("points", 500, "number of points in each light curve"),
+        ("repeat", 3, "how many times the stars are sorted"),
+    )
+    options = common.parse_args(__doc__, counts, arguments=arguments)
+
+    with common.temporary_file("_bench_curve_stdev.LEMONdB") as path:
+        with database.LEMONdB(path) as db:
+            print "Populating the LEMONdB...",
+            sys.stdout.flush()
+            populate(db, options.stars, options.points)
+            print "done."
+
+        with mining.LEMONdBMiner(path) as miner:
+            for index in xrange(options.repeat):
+                with common.Timer() as timer:
+                    miner.sort_by_curve_stdev(common.PFILTER)
+                args = index + 1, timer.elapsed, timer.rate(options.stars)
+                print "Call %d: %.3f s (%.1f stars/s)" % args
+
+
+if __name__ == "__main__":
+    sys.exit(main())
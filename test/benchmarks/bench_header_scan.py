@@ -0,0 +1,125 @@
+#! /usr/bin/env python2
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure how many FITS images per second can be loaded as FITSImage objects.
+
+Creating a FITSImage reads only the header of the file, taking the size of
+the image from the NAXISn keywords, while until recently the pixels were also
+read from disk (and, for scaled data, decoded) just to learn the shape of the
+array. This benchmark writes a set of temporary FITS images and scans their
+headers both ways, reporting the throughput of each one in files per second.
+The pages of the files may be cached by the operating system after the first
+scan, so use --drop to measure them with the cache dropped, which requires
+root privileges. Run it from the root directory of LEMON:
+
+    $ python -m test.benchmarks.bench_header_scan --files 250 --size 2048
+
+"""
+
+from __future__ import division
+
+import os
+import pyfits
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy
+
+# LEMON modules
+import fitsimage
+from test.benchmarks import common
+
+
+def mkfits(path, size):
+    """ Write a square FITS image of 16-bit pixels with BZERO = 32768 """
+
+    pixels = numpy.random.randint(0, 2 ** 16, size=(size, size))
+    hdu = pyfits.PrimaryHDU(pixels.astype(numpy.float32))
+    hdu.scale("int16", bzero=32768)
+    hdu.writeto(path)
+
+
+def read_with_data(path):
+    """ Learn the size of the image as FITSImage.__init__() used to do """
+
+    handler = pyfits.open(path, mode="readonly")
+    try:
+        return handler[0].data.shape[::-1]
+    finally:
+        handler.close(output_verify="ignore")
+
+
+def read_header_only(path):
+    return fitsimage.FITSImage(path).size
+
+
+def drop_caches():
+    subprocess.check_call(["sync"])
+    with open("/proc/sys/vm/drop_caches", "w") as fd:
+        fd.write("3\n")
+
+
+def benchmark(function, paths, drop=False):
+    """ Return the number of files per second that 'function' processes """
+
+    if drop:
+        drop_caches()
+    with common.Timer() as timer:
+        for path in paths:
+            function(path)
+    return timer.rate(len(paths))
+
+
+def main(arguments=None):
+
+    counts = (
+        ("files", 100, "number of FITS images to scan"),
+        ("size", 2048, "side of the square images, in pixels"),
+    )
+    flags = (("drop", "drop the page cache of the operating system before each scan"),)
+    options = common.parse_args(__doc__, counts, flags, arguments=arguments)
+
+    tmp_dir = tempfile.mkdtemp(suffix="_bench_header_scan")
+    try:
+        paths = []
+        for index in xrange(options.files):
+            path = os.path.join(tmp_dir, "img_%05d.fits" % index)
+            mkfits(path, options.size)
+            paths.append(path)
+
+        mib = os.path.getsize(paths[0]) * len(paths) / 2 ** 20
+        msg = "%d images of %dx%d pixels (%.1f MiB)"
+        print msg % (len(paths), options.size, options.size, mib)
+
+        for name, function in (
+            ("pixel data", read_with_data),
+            ("header only", read_header_only),
+        ):
+            speed = benchmark(function, paths, drop=options.drop)
+            print "%-12s: %10.1f files/s" % (name, speed)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
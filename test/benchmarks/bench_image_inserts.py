@@ -0,0 +1,87 @@
+#! /usr/bin/env python2
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure how the time it takes to store an image in a LEMONdB grows with the
+number of images already in the database. There can be only one sources image,
+a constraint that is enforced by a partial unique index, so each insertion
+should take constant time and the throughput should not decrease as images
+are added. Use --triggers in order to enforce it with the triggers that we
+used to have instead, which scanned the entire table after every insertion:
+the throughput then drops as the database grows. Run it from the root
+directory of LEMON:
+
+    $ python -m test.benchmarks.bench_image_inserts --images 50000
+
+"""
+
+from __future__ import division
+
+import sys
+
+# LEMON modules
+import database
+from test.benchmarks import common
+
+# The triggers that LEMONdB used to enforce a single sources image
+OLD_TRIGGERS = """
+CREATE TRIGGER single_sources_%d
+AFTER %s ON images
+BEGIN
+    SELECT RAISE(ABORT, 'only one SOURCES column may be = 1')
+    WHERE (SELECT COUNT(*)
+           FROM images
+           WHERE sources = 1) > 1;
+END;
+"""
+
+
+def use_old_triggers(db):
+    db._execute("DROP INDEX single_sources")
+    for index, when in enumerate(("INSERT", "UPDATE OF sources")):
+        db._execute(OLD_TRIGGERS % (index, when))
+
+
+def main(arguments=None):
+
+    counts = (
+        ("images", 50000, "number of images to insert"),
+        ("step", 5000, "report the throughput every this many images"),
+    )
+    flags = (("triggers", "enforce a single sources image with the old triggers"),)
+    options = common.parse_args(__doc__, counts, flags, arguments=arguments)
+
+    with common.temporary_file("_bench_image_inserts.LEMONdB") as path:
+        with database.LEMONdB(path) as db:
+            if options.triggers:
+                use_old_triggers(db)
+
+            for first in xrange(0, options.images, options.step):
+                last = min(first + options.step, options.images)
+                with common.Timer() as timer:
+                    for index in xrange(first, last):
+                        db.add_image(common.image(1e9 + index * 60))
+                args = last, timer.rate(last - first)
+                print "%7d images: %10.1f inserts/s" % args
+            db.commit()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
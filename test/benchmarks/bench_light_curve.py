@@ -0,0 +1,116 @@
+#! /usr/bin/env python2
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare StarSet.light_curve() with the per-image loop that it replaces. A
+StarSet with --cstars comparison stars observed in --images images is built in
+memory, and the light curve of --stars other stars computed with both the
+current implementation, which processes all the images at once, and a copy of
+the old one, which computed the differential magnitude and SNR of each image
+separately. This is done with and without the signal-to-noise ratios, as
+StarSet.broeg_weights() does not need them. Run it from the root directory of
+LEMON:
+
+    $ python -m test.benchmarks.bench_light_curve --images 3000 --stars 10
+
+"""
+
+from __future__ import division
+
+import numpy
+import random
+import sys
+
+# LEMON modules
+import database
+import diffphot
+import snr
+from test.benchmarks import common
+
+
+def random_star(star_id, unix_times):
+    """ Return a DBStar with random photometry at the given Unix times """
+
+    phot_info = numpy.empty((3, len(unix_times)), dtype=numpy.longdouble)
+    phot_info[0] = unix_times
+    phot_info[1] = [random.uniform(10, 20) for _ in unix_times]
+    phot_info[2] = [random.uniform(50, 500) for _ in unix_times]
+    times_indexes = dict((x, index) for index, x in enumerate(unix_times))
+    return database.DBStar(star_id, common.PFILTER, phot_info, times_indexes)
+
+
+def per_image_light_curve(cstars, weights, star, no_snr=False):
+    """ The old StarSet.light_curve(), which loops over the images """
+
+    cstdevs = weights.values
+    args = cstars.pfilter, cstars.star_ids, weights, cstdevs
+    curve = database.LightCurve(*args, dtype=cstars.dtype)
+
+    for index, unix_time in enumerate(cstars._unix_times):
+        cmags = cstars._phot_info[:, 0, index]
+        csnrs = cstars._phot_info[:, 1, index]
+        cmag = numpy.average(cmags, weights=weights)
+        csnr = None if no_snr else snr.mean_snr(csnrs, weights=weights)
+
+        dmag = star.mag(index) - cmag
+        dsnr = None if no_snr else snr.difference_snr(star.snr(index), csnr)
+        curve.add(unix_time, dmag, dsnr)
+
+    return curve
+
+
+def main(arguments=None):
+
+    counts = (
+        ("images", 3000, "number of images in which the stars were observed"),
+        ("cstars", 20, "number of comparison stars in the StarSet"),
+        ("stars", 10, "number of light curves computed"),
+    )
+    options = common.parse_args(__doc__, counts, arguments=arguments)
+
+    unix_times = [1e9 + index * 60 for index in xrange(options.images)]
+    cstars = [random_star(id_, unix_times) for id_ in xrange(options.cstars)]
+    cstars = diffphot.StarSet(cstars)
+    stdevs = [random.uniform(0.01, 0.1) for _ in xrange(options.cstars)]
+    weights = diffphot.Weights.inversely_proportional(stdevs)
+
+    first_id = options.cstars
+    stars = [
+        random_star(first_id + index, unix_times) for index in xrange(options.stars)
+    ]
+
+    for no_snr in (False, True):
+        timings = []
+        for function in (per_image_light_curve, diffphot.StarSet.light_curve):
+            with common.Timer() as timer:
+                for star in stars:
+                    function(cstars, weights, star, no_snr=no_snr)
+            timings.append(timer.elapsed)
+
+        label = "without SNRs" if no_snr else "with SNRs"
+        print "Light curves %s:" % label
+        for name, elapsed in zip(("per image", "vectorized"), timings):
+            args = name, elapsed, options.stars / elapsed
+            print "  %-10s: %8.3f s (%.1f curves/s)" % args
+        print "  speedup   : %8.1fx" % (timings[0] / timings[1])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+#! /usr/bin/env python2
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure how fast the photometry of individual stars is read from a LEMONdB,
+and stored, with the IDs of the stars and images cached in memory and without
+them. A LEMONdB with --stars stars and their photometry in --images images is
+created in a temporary file, and then get_photometry() is called for --reads
+random stars. The cache is cleared before each read to emulate the old, one
+query per lookup behavior. Run it from the root directory of LEMON:
+
+    $ python -m test.benchmarks.bench_star_lookups --stars 50000 --reads 2000
+
+"""
+
+from __future__ import division
+
+import random
+import sys
+
+# LEMON modules
+import database
+from test.benchmarks import common
+
+
+def populate(db, nstars, nimages):
+    """ Add 'nstars' stars, measured in 'nimages' images, to the LEMONdB """
+
+    common.add_stars(db, nstars)
+    images = []
+    for index in xrange(nimages):
+        img = common.image(1e9 + index * 60, path="ferM_%04d.fits" % index)
+        db.add_image(img)
+        rows = ((star_id, 15, 100) for star_id in xrange(nstars))
+        db.add_photometry_batch(img, rows)
+        images.append(img)
+    db.commit()
+    return images
+
+
+def reads(db, star_ids, pfilter, cached):
+    """ Return the number of get_photometry() calls per second """
+
+    with common.Timer() as timer:
+        for star_id in star_ids:
+            if not cached:
+                db._clear_caches()
+            db.get_photometry(star_id, pfilter)
+    return timer.rate(len(star_ids))
+
+
+def writes(db, images, star_ids, cached):
+    """ Return the number of add_photometry() calls per second """
+
+    with common.Timer() as timer:
+        for img in images:
+            for star_id in star_ids:
+                if not cached:
+                    db._clear_caches()
+                db.add_photometry(star_id, img.unix_time, img.pfilter, 15, 100)
+    return timer.rate(len(images) * len(star_ids))
+
+
+def main(arguments=None):
+
+    counts = (
+        ("stars", 50000, "number of stars in the LEMONdB"),
+        ("images", 5, "number of images in which stars were measured"),
+        ("reads", 1000, "number of stars whose photometry is read"),
+    )
+    options = common.parse_args(__doc__, counts, arguments=arguments)
+
+    with common.temporary_file("_bench_star_lookups.LEMONdB") as path:
+        with database.LEMONdB(path) as db:
+            print "Populating the LEMONdB...",
+            sys.stdout.flush()
+            images = populate(db, options.stars, options.images)
+            print "done."
+
+            star_ids = random.sample(xrange(options.stars), options.reads)
+            for cached in (False, True):
+                label = "cached" if cached else "uncached"
+                speed = reads(db, star_ids, common.PFILTER, cached)
+                print "%-8s: %10.1f reads/s" % (label, speed)
+
+            # Add the photometry of the same stars to new images
+            for cached in (False, True):
+                label = "cached" if cached else "uncached"
+                new_images = []
+                for img in images:
+                    unix_time = img.unix_time + (1 + cached) * 1e6
+                    new_images.append(img._replace(unix_time=unix_time))
+                    db.add_image(new_images[-1])
+                speed = writes(db, new_images, star_ids, cached)
+                print "%-8s: %10.1f writes/s" % (label, speed)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
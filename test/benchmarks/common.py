@@ -0,0 +1,107 @@
+#! /usr/bin/env python2
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Helpers shared by the benchmarks: the parsing of their command-line options,
+the temporary files in which they store data, the timing of their code and
+the stars and images with which they populate the LEMONdBs.
+"""
+
+from __future__ import division
+
+import contextlib
+import optparse
+import os
+import tempfile
+import time
+
+# LEMON modules
+import customparser
+import database
+import passband
+
+PFILTER = passband.Passband("V")
+
+
+def parse_args(description, counts, flags=(), arguments=None):
+    """Parse the command-line options of a benchmark.
+
+    'counts' is a sequence of three-element tuples with the name, default
+    value and help text of each integer option (such as --stars or --images)
+    of the benchmark, while 'flags' has two-element tuples with the name and
+    help text of each boolean option. Returns the optparse.Values object.
+
+    """
+
+    formatter = customparser.NewlinesFormatter()
+    parser = optparse.OptionParser(description=description, formatter=formatter)
+    for name, default, help_ in counts:
+        help_ += " [default: %default]"
+        parser.add_option("--" + name, type="int", default=default, help=help_)
+    for name, help_ in flags:
+        parser.add_option("--" + name, action="store_true", help=help_)
+    options, args = parser.parse_args(args=arguments)
+    return options
+
+
+@contextlib.contextmanager
+def temporary_file(suffix):
+    """ Yield the path to a temporary file, deleted on exit """
+
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        yield path
+    finally:
+        os.unlink(path)
+
+
+class Timer(object):
+    """Measure the wall-clock time spent within a with statement.
+
+    The number of seconds is stored in the 'elapsed' attribute on exit, and
+    rate() returns how many items per second were processed in that time.
+
+    """
+
+    def __enter__(self):
+        self.elapsed = None
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.time() - self._start
+
+    def rate(self, count):
+        return count / self.elapsed
+
+
+def add_stars(db, nstars):
+    """ Add 'nstars' stars, with IDs from zero, to the LEMONdB """
+
+    for star_id in xrange(nstars):
+        db.add_star(star_id, 100, 100, 100.25, 9.8, 2000, None, None, 15)
+
+
+def image(unix_time, path="ferM_0001.fits", pfilter=PFILTER):
+    """ Return a database.Image of NGC 2264 taken at 'unix_time' """
+
+    args = path, pfilter, unix_time, "NGC 2264", 1.2, 2.5, 100.25, 9.8
+    return database.Image(*args)
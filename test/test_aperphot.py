@@ -0,0 +1,194 @@
+#! /usr/bin/env python2
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+
+import math
+import numpy
+import random
+
+# LEMON modules
+from test import unittest
+import aperphot
+
+NITERS = 25  # How many times random-data tests cases are run
+
+
+def gaussian_image(size, stars, sky=100.0, sigma=2.0):
+    """Return a square image with Gaussian stars on top of a flat sky.
+
+    'stars' must be an iterable of three-element tuples with the x- and
+    y-coordinates (one-indexed, as IRAF's) and the total flux of each star.
+
+    """
+
+    yy, xx = numpy.mgrid[1 : size + 1, 1 : size + 1]
+    data = numpy.empty((size, size))
+    data.fill(sky)
+    for x, y, flux in stars:
+        r2 = (xx - x) ** 2 + (yy - y) ** 2
+        data += flux / (2 * math.pi * sigma ** 2) * numpy.exp(-r2 / (2 * sigma ** 2))
+    return data
+
+
+class AperPhotTest(unittest.TestCase):
+
+    SIZE = 128
+
+    def test_measure_flat(self):
+
+        # On a flat image the sky must be equal to the value of the pixels,
+        # with a standard deviation of zero, and the total number of counts
+        # in the aperture the value of the pixels times its area.
+
+        value = 250.0
+        data = numpy.empty((self.SIZE, self.SIZE))
+        data.fill(value)
+
+        x = numpy.array([64.0, 40.3, 80.7])
+        y = numpy.array([64.0, 51.5, 90.2])
+        aperture = 6.0
+        mags, sums, fluxes, stdevs = aperphot.measure(data, x, y, aperture, 8, 4)
+
+        for index in xrange(len(x)):
+            expected_sum = value * math.pi * aperture ** 2
+            self.assertAlmostEqual(sums[index], expected_sum, delta=expected_sum * 0.01)
+            self.assertAlmostEqual(fluxes[index], 0, places=6)
+            self.assertAlmostEqual(stdevs[index], 0)
+
+    def test_measure_stars(self):
+
+        sky = 100.0
+        exptime = 10
+        for _ in xrange(NITERS):
+
+            stars = []
+            for index in xrange(3):
+                x = 24 + index * 40 + random.uniform(-3, 3)
+                y = random.uniform(30, self.SIZE - 30)
+                stars.append((x, y, random.uniform(1e4, 1e6)))
+
+            data = gaussian_image(self.SIZE, stars, sky=sky)
+            x, y, flux = numpy.array(stars).T
+            args = data, x, y, 12, 14, 4
+            mags, sums, fluxes, stdevs = aperphot.measure(*args, exptime=exptime)
+
+            for index in xrange(len(stars)):
+                expected_flux = flux[index]
+                self.assertAlmostEqual(
+                    fluxes[index], expected_flux, delta=expected_flux * 0.01
+                )
+                expected_mag = aperphot.ZMAG - 2.5 * math.log10(expected_flux / exptime)
+                self.assertAlmostEqual(mags[index], expected_mag, delta=0.01)
+                self.assertTrue(sums[index] > fluxes[index])
+                self.assertAlmostEqual(stdevs[index], 0, delta=1)
+
+    def test_measure_indef(self):
+
+        # Objects whose aperture falls (even partially) off the image, or with
+        # non-finite coordinates, are INDEF: their magnitude must be NaN.
+
+        data = gaussian_image(self.SIZE, [(64, 64, 1e5)])
+        x = numpy.array([64, 3, -500, 1e30, numpy.nan])
+        y = numpy.array([64, 64, -500, 1e30, 20])
+        mags, sums, fluxes, stdevs = aperphot.measure(data, x, y, 6, 8, 3)
+
+        self.assertTrue(numpy.isfinite(mags[0]))
+        for index in xrange(1, len(x)):
+            self.assertTrue(numpy.isnan(mags[index]))
+
+        for index in xrange(2, len(x)):
+            self.assertEqual(sums[index], 0)
+            self.assertTrue(numpy.isnan(stdevs[index]))
+
+    def test_measure_chunks(self):
+
+        # The result must not depend on how many objects are stacked at once
+        stars = [(random.uniform(20, 108), random.uniform(20, 108), 1e5)]
+        data = gaussian_image(self.SIZE, stars)
+        x = numpy.random.uniform(1, self.SIZE, size=50)
+        y = numpy.random.uniform(1, self.SIZE, size=50)
+        expected = aperphot.measure(data, x, y, 5, 7, 3)
+
+        chunk_size = aperphot.CHUNK_SIZE
+        try:
+            aperphot.CHUNK_SIZE = 7
+            result = aperphot.measure(data, x, y, 5, 7, 3)
+        finally:
+            aperphot.CHUNK_SIZE = chunk_size
+
+        for values, expected_values in zip(result, expected):
+            numpy.testing.assert_array_equal(values, expected_values)
+
+    def test_centroid(self):
+
+        for _ in xrange(NITERS):
+            x0 = random.uniform(30, self.SIZE - 30)
+            y0 = random.uniform(30, self.SIZE - 30)
+            data = gaussian_image(self.SIZE, [(x0, y0, 1e5)])
+
+            x = numpy.array([x0 + random.uniform(-2, 2)])
+            y = numpy.array([y0 + random.uniform(-2, 2)])
+            cx, cy = aperphot.centroid(data, x, y, 5)
+            self.assertAlmostEqual(cx[0], x0, delta=0.25)
+            self.assertAlmostEqual(cy[0], y0, delta=0.25)
+
+        # A centering box narrower than two pixels does nothing
+        cx, cy = aperphot.centroid(data, x, y, 1)
+        self.assertEqual(cx[0], x[0])
+        self.assertEqual(cy[0], y[0])
+
+    def test_max_pixels(self):
+
+        data = numpy.zeros((self.SIZE, self.SIZE))
+        data[63, 63] = 1000  # pixel (64, 64), as IRAF's logical coordinates
+        data[63, 70] = 2000  # pixel (71, 64)
+
+        x = numpy.array([64, 64, 64, 71, -500])
+        y = numpy.array([64, 64, 64, 64, -500])
+        aperture = numpy.array([3, 7.4, 6.4, 1, 3])
+
+        # Apertures of 7.4 pixels reach the center of a pixel seven pixels
+        # away (fraction = 7.4 - 7 + 0.5 > 0), those of 6.4 pixels do not.
+        expected = [1000, 2000, 1000, 2000, numpy.nan]
+        for index in xrange(len(x)):
+            args = data, x[index : index + 1], y[index : index + 1], aperture[index]
+            peak = aperphot.max_pixels(*args)[0]
+            numpy.testing.assert_equal(peak, expected[index])
+
+    def test_measure_multiple_apertures(self):
+
+        # Doing photometry for several apertures at once must give the same
+        # result as doing it separately for each one of them.
+        stars = [(40.2, 50.7, 1e5), (90.6, 70.1, 5e5)]
+        data = gaussian_image(self.SIZE, stars)
+        x, y, _ = numpy.array(stars).T
+        apertures = [2.5, 4, 6.3, 9]
+
+        mags, sums, fluxes, stdevs = aperphot.measure(data, x, y, apertures, 10, 3)
+        self.assertEqual(mags.shape, (len(apertures), len(x)))
+        self.assertEqual(stdevs.shape, (len(x),))
+
+        for index, aperture in enumerate(apertures):
+            expected = aperphot.measure(data, x, y, aperture, 10, 3)
+            numpy.testing.assert_array_equal(mags[index], expected[0])
+            numpy.testing.assert_array_equal(sums[index], expected[1])
+            numpy.testing.assert_array_equal(fluxes[index], expected[2])
+            numpy.testing.assert_array_equal(stdevs, expected[3])
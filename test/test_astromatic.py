@@ -117,6 +117,19 @@ class CoordinatesTest(unittest.TestCase):
         distance = coords3.distance(coords4)
         self.assertAlmostEqual(distance, 5.374111607543190)
 
+    def test_angular_distance(self):
+
+        # Must be equal to Coordinates.distance(), also on arrays
+        coords = [self.random() for _ in xrange(NITERS)]
+        ras, decs = zip(*[(c.ra, c.dec) for c in coords])
+        distances = astromatic.angular_distance(ras[0], decs[0], ras, decs)
+        self.assertEqual(distances.shape, (NITERS,))
+        for index, another in enumerate(coords):
+            expected = coords[0].distance(another)
+            self.assertAlmostEqual(distances[index], expected)
+            args = another.ra, another.dec, coords[0].ra, coords[0].dec
+            self.assertAlmostEqual(astromatic.angular_distance(*args), expected)
+
     def test_get_exact_coordinates(self):
 
         # Barnard's Star (J2000): -798.58 10328.12 (mas/yr)
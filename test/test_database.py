@@ -23,12 +23,14 @@ from __future__ import division
 import collections
 import copy
 import itertools
+import mock
 import numpy
 import operator
 import os
 import random
 import re
 import sqlite3
+import stat
 import string
 import tempfile
 import time
@@ -45,10 +47,12 @@ from database import (
     LEMONdB,
     LightCurve,
     PhotometricParameters,
+    PhotometryMatrix,
     UnknownImageError,
     UnknownStarError,
 )
 
+from astromatic import Coordinates
 from diffphot import Weights
 from json_parse import CandidateAnnuli
 import test.test_fitsimage
@@ -389,6 +393,38 @@ class DBStarTest(unittest.TestCase):
             for cstar in complete:
                 self.assertTrue(original.issubset(cstar))
 
+    def test_complete_for_matrix(self):
+
+        # Must return the same stars, in the same order and with the same
+        # photometry, as complete_for() does with the DBStars of the matrix.
+        for _ in xrange(NITERS):
+            nstars = random.randint(MIN_NSTARS, MAX_NSTARS)
+            unix_times = numpy.array(sorted(runix_times(random.randint(1, 20))))
+            shape = nstars, len(unix_times)
+            mask = numpy.random.random(shape) < 0.9
+            magnitudes = numpy.random.uniform(10, 20, shape)
+            magnitudes[~mask] = numpy.nan
+            snrs = numpy.random.uniform(50, 500, shape)
+            snrs[~mask] = numpy.nan
+            star_ids = numpy.arange(nstars)
+            presence = numpy.packbits(mask, axis=1)
+            args = magnitudes, snrs, mask, star_ids, unix_times, presence
+            matrix = PhotometryMatrix(*args)
+
+            pfilter = passband.Passband.random()
+            stars = [DBStar.from_matrix(matrix, x, pfilter) for x in star_ids]
+            for star in stars:
+                expected = star.complete_for(stars)
+                complete = star.complete_for_matrix(matrix)
+                self.assertEqual([x.id for x in complete], [x.id for x in expected])
+                for cstar, estar in zip(complete, expected):
+                    numpy.testing.assert_array_equal(cstar._phot_info, estar._phot_info)
+                    self.assertEqual(cstar._time_indexes, estar._time_indexes)
+
+        # No star is complete for one observed at a Unix time not in the matrix
+        star = DBStarTest.make_star([(unix_times[-1] + 1, 15.6, 100)])
+        self.assertEqual(star.complete_for_matrix(matrix), [])
+
     def test_make_star(self):
 
         id_ = 1
@@ -723,6 +759,12 @@ class LightCurveTest(unittest.TestCase):
                 curve.add(*point)
                 self.assertEqual(len(curve), index + 1)
                 self.assertEqual(curve[index], point)
+                self.assertEqual(curve[-index - 1], curve[0])
+
+            # IndexError, as with lists, if the index is out of range
+            for index in (len(curve), len(curve) + 1, -len(curve) - 1):
+                with self.assertRaises(IndexError):
+                    curve[index]
 
     def test_iter(self):
 
@@ -889,6 +931,76 @@ class LightCurveTest(unittest.TestCase):
                 self.assertEqual(nmags, tuple(p[1] for p in non_noisy_curve))
                 self.assertEqual(nsnrs, tuple(p[2] for p in non_noisy_curve))
 
+    def test_cached_values(self):
+
+        # The standard deviation and amplitude are computed once, but must be
+        # updated as soon as new points are added to the light curve.
+        curve = self.random()
+        curve.add(15000, 14.5, 100)
+        curve.add(16000, 15.6, 125)
+        self.assertAlmostEqual(curve.stdev, 0.55)
+        self.assertAlmostEqual(curve.amplitude(), 1.1)
+        curve.add(14000, 13.1, 200)
+        self.assertAlmostEqual(curve.stdev, 1.0230672835481871)
+        self.assertAlmostEqual(curve.amplitude(), 2.5)
+        self.assertEqual(curve[-1], (14000, 13.1, 200))
+        self.assertEqual(list(curve)[0], (14000, 13.1, 200))
+
+        # If no point is noisy, the array of points is not copied
+        same_curve = curve.ignore_noisy(50)
+        self.assertIs(same_curve._data, curve._data)
+        same_curve.add(17000, 14.1, 25)
+        self.assertEqual(len(same_curve), 4)
+        self.assertEqual(len(curve), 3)
+
+        # SNRs that are None are not cast to NaN
+        curve = self.random()
+        curve.add(15000, 14.5, None)
+        curve.add(14000, 15.6, None)
+        self.assertEqual(list(curve), [(14000, 15.6, None), (15000, 14.5, None)])
+        self.assertAlmostEqual(curve.stdev, 0.55)
+
+    def test_add_many(self):
+
+        curve = self.random()
+        curve.add(15000, 14.5, 100)
+        self.assertAlmostEqual(curve.stdev, 0)
+        curve.add_many([17000, 16000], numpy.array([13.4, 15.6]), [150, 125])
+        self.assertEqual(len(curve), 3)
+        self.assertEqual(curve[1], (17000, 13.4, 150))
+        self.assertEqual(list(curve)[1], (16000, 15.6, 125))
+        self.assertAlmostEqual(curve.amplitude(), 2.2)
+
+        # Without SNRs, the signal-to-noise ratio of each point is None
+        curve = self.random()
+        curve.add_many([15000, 14000], [14.5, 15.6], None)
+        self.assertEqual(list(curve), [(14000, 15.6, None), (15000, 14.5, None)])
+
+    def test_from_sorted_points(self):
+
+        args = self.random_data()
+        points = sorted(self.random_points(10))
+        curve = LightCurve.from_sorted_points(*(args + (points,)))
+        self.assertEqual(len(curve), 10)
+        self.assertEqual(curve[:], points)
+        self.assertEqual(list(curve), points)
+        self.assertEqual(list(curve.weights()), zip(*args[1:]))
+
+        # The curve can be extended as any other
+        point = (points[0][0] - 1, 14.5, 100)
+        curve.add(*point)
+        self.assertEqual(list(curve), [point] + points)
+
+        # SNRs that are None are turned into NaN, and back into None
+        points = [(14000, 15.6, None), (15000, 14.5, 125)]
+        curve = LightCurve.from_sorted_points(*(args + (points,)))
+        self.assertEqual(list(curve), points)
+        self.assertEqual(len(curve.ignore_noisy(100)), 1)
+
+        curve = LightCurve.from_sorted_points(*(args + ([],)))
+        self.assertEqual(len(curve), 0)
+        self.assertEqual(list(curve), [])
+
     @staticmethod
     def assertThatAreEqual(cls, first, second):
         """Assert that two LightCurves are equal.
@@ -968,6 +1080,180 @@ class LEMONdBTest(unittest.TestCase):
             finally:
                 os.unlink(path)
 
+    def test_schema_migration(self):
+
+        # Turn a LEMONdB into one created before version 1 of the schema, when
+        # PHOTOMETRY had a rowid and an index on the same columns as UNIQUE.
+        path = self.random_path()
+        try:
+            img = ImageTest.random()
+            with LEMONdB(path) as db:
+                db.add_star(*LEMONdBTest.random_star_info(id_=1))
+                db.add_image(img)
+                db.add_photometry(1, img.unix_time, img.pfilter, 14.5, 100)
+                db.commit()
+
+            connection = sqlite3.connect(path)
+            with connection:
+                connection.executescript(
+                    """
+                DROP INDEX phot_by_image;
+                ALTER TABLE photometry RENAME TO new_photometry;
+                CREATE TABLE photometry (
+                    id         INTEGER PRIMARY KEY,
+                    star_id    INTEGER NOT NULL,
+                    image_id   INTEGER NOT NULL,
+                    magnitude  REAL NOT NULL,
+                    snr        REAL NOT NULL,
+                    UNIQUE (star_id, image_id));
+                CREATE INDEX phot_by_star_image ON photometry(star_id, image_id);
+                CREATE INDEX phot_by_image ON photometry(image_id);
+                INSERT INTO photometry SELECT NULL, * FROM new_photometry;
+                DROP TABLE new_photometry;
+                PRAGMA user_version = 0;
+                """
+                )
+            connection.close()
+
+            with LEMONdB(path) as db:
+                self.assertEqual(db._schema_version, LEMONdB.SCHEMA_VERSION)
+                star = db.get_photometry(1, img.pfilter)
+                self.assertEqual(star.mag(0), 14.5)
+                self.assertEqual(star.snr(0), 100)
+
+                db._execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+                indexes = set(row[0] for row in db._rows)
+                self.assertIn("phot_by_image", indexes)
+                self.assertNotIn("phot_by_star_image", indexes)
+        finally:
+            os.unlink(path)
+
+    def test_schema_migration_pparams(self):
+
+        # Turn a LEMONdB into one created with version 1 of the schema, when
+        # PPARAMS_PHOTOMETRY had a rowid, and migrate it to the current one.
+        path = self.random_path()
+        try:
+            img = ImageTest.random()
+            pparams = PhotometricParametersTest.random()
+            with LEMONdB(path) as db:
+                db.add_star(*LEMONdBTest.random_star_info(id_=1))
+                db.add_image(img)
+                args = 1, img.unix_time, img.pfilter, pparams, 14.5, 100
+                db.add_pparams_photometry(*args)
+                db.commit()
+
+            connection = sqlite3.connect(path)
+            with connection:
+                connection.executescript(
+                    """
+                ALTER TABLE pparams_photometry RENAME TO new_pparams_photometry;
+                CREATE TABLE pparams_photometry (
+                    id         INTEGER PRIMARY KEY,
+                    star_id    INTEGER NOT NULL,
+                    image_id   INTEGER NOT NULL,
+                    pparams_id INTEGER NOT NULL,
+                    magnitude  REAL NOT NULL,
+                    snr        REAL NOT NULL,
+                    UNIQUE (pparams_id, star_id, image_id));
+                INSERT INTO pparams_photometry
+                    SELECT NULL, * FROM new_pparams_photometry;
+                DROP TABLE new_pparams_photometry;
+                PRAGMA user_version = 1;
+                """
+                )
+            connection.close()
+
+            with LEMONdB(path) as db:
+                self.assertEqual(db._schema_version, LEMONdB.SCHEMA_VERSION)
+                self.assertEqual(db.pparams, [pparams])
+                db.use_pparams(pparams)
+                star = db.get_photometry(1, img.pfilter)
+                self.assertEqual(star.mag(0), 14.5)
+                self.assertEqual(star.snr(0), 100)
+
+                # WITHOUT ROWID tables have no 'rowid' column
+                with self.assertRaises(sqlite3.OperationalError):
+                    db._execute("SELECT rowid FROM pparams_photometry")
+        finally:
+            os.unlink(path)
+
+    def test_open_read_only(self):
+
+        # Opening a LEMONdB must not write to it: not even to migrate it, as
+        # that cannot be done if the file is read-only. The file is made so,
+        # but os.access() is also mocked, as root may write to it anyway.
+        path = self.random_path()
+        try:
+            img = ImageTest.random()
+            with LEMONdB(path) as db:
+                db.add_star(*LEMONdBTest.random_star_info(id_=1))
+                db.add_image(img)
+                db.add_photometry(1, img.unix_time, img.pfilter, 14.5, 100)
+                db.commit()
+
+            with open(path, "rb") as fd:
+                contents = fd.read()
+
+            with LEMONdB(path) as db:
+                self.assertEqual(db._schema_version, LEMONdB.SCHEMA_VERSION)
+            with open(path, "rb") as fd:
+                self.assertEqual(fd.read(), contents)
+
+            # An outdated schema, so the database would have to be migrated
+            connection = sqlite3.connect(path)
+            connection.execute("PRAGMA user_version = 0")
+            connection.close()
+            with open(path, "rb") as fd:
+                contents = fd.read()
+
+            os.chmod(path, stat.S_IRUSR)
+            with mock.patch.object(os, "access", return_value=False):
+                with LEMONdB(path) as db:
+                    self.assertEqual(db._schema_version, 0)
+                    star = db.get_photometry(1, img.pfilter)
+                    self.assertEqual(star.mag(0), 14.5)
+                    self.assertEqual(star.snr(0), 100)
+            with open(path, "rb") as fd:
+                self.assertEqual(fd.read(), contents)
+        finally:
+            os.unlink(path)
+
+    def test_single_sources_migration(self):
+
+        # Databases created by previous versions used triggers, instead of a
+        # partial unique index, to enforce a maximum of one sources image.
+        path = self.random_path()
+        try:
+            with LEMONdB(path):
+                pass
+
+            connection = sqlite3.connect(path)
+            with connection:
+                connection.execute("DROP INDEX single_sources")
+                for index, when in enumerate(("INSERT", "UPDATE OF sources")):
+                    connection.execute(
+                        """CREATE TRIGGER single_sources_%d
+                        AFTER %s ON images
+                        BEGIN
+                            SELECT RAISE(ABORT, 'only one SOURCES column may be = 1')
+                            WHERE (SELECT COUNT(*)
+                                   FROM images
+                                   WHERE sources = 1) > 1;
+                        END; """
+                        % (index, when)
+                    )
+            connection.close()
+
+            with LEMONdB(path) as db:
+                db._execute("SELECT type, name FROM sqlite_master")
+                objects = set(db._rows)
+                self.assertIn(("index", "single_sources"), objects)
+                self.assertNotIn(("trigger", "single_sources_0"), objects)
+                self.assertNotIn(("trigger", "single_sources_1"), objects)
+        finally:
+            os.unlink(path)
+
     def test_add_and_get_candidate_pparams(self):
 
         for _ in xrange(NITERS):
@@ -1052,6 +1338,10 @@ class LEMONdBTest(unittest.TestCase):
             after_tables = self.images_filters_tables_status(db)
             self.assertEqual(before_tables, after_tables)
 
+            # There cannot be two sources images, even if we bypass LEMONdB
+            with self.assertRaises(sqlite3.IntegrityError):
+                db._execute("UPDATE images SET sources = 1")
+
     def test_add_and_get_image(self):
         with LEMONdB(":memory:") as db:
             size = random.randint(self.MIN_NIMAGES, self.MAX_NIMAGES)
@@ -1634,6 +1924,316 @@ class LEMONdBTest(unittest.TestCase):
             empty_star = db.get_photometry(star_id, johnson_V)
             self.assertEqual(len(empty_star), 0)
 
+    def test_id_caches(self):
+
+        # The IDs of the stars and images are kept in memory once they have
+        # been read, so they must be updated as new stars and images are added
+        # and forgotten if the insertions are rolled back.
+
+        with LEMONdB(":memory:") as db:
+            johnson_V = passband.Passband("V")
+            db.add_star(*self.random_star_info(id_=5))
+            self.assertEqual(db.star_ids, [5])
+            db.star_ids.append(8)  # a copy, not the cached list
+            self.assertEqual(db.star_ids, [5])
+
+            db.add_star(*self.random_star_info(id_=2))
+            self.assertEqual(db.star_ids, [2, 5])
+
+            img1 = ImageTest.random(johnson_V)
+            db.add_image(img1)
+            self.assertEqual(db.get_image(img1.unix_time, johnson_V), img1)
+            img2 = ImageTest.random(johnson_V)
+            img2 = img2._replace(unix_time=different_runix_time([img1.unix_time]))
+            db.add_image(img2)
+            self.assertEqual(db.get_image(img2.unix_time, johnson_V), img2)
+            db.add_photometry(2, img2.unix_time, johnson_V, 12.5, 100)
+            self.assertEqual(db.get_photometry(2, johnson_V).mag(0), 12.5)
+
+            mark = db._savepoint()
+            db.add_star(*self.random_star_info(id_=9))
+            unix_time = different_runix_time([img1.unix_time, img2.unix_time])
+            img3 = ImageTest.random(johnson_V)._replace(unix_time=unix_time)
+            db.add_image(img3)
+            self.assertEqual(db.star_ids, [2, 5, 9])
+            db._rollback_to(mark)
+
+            self.assertEqual(db.star_ids, [2, 5])
+            with self.assertRaises(KeyError):
+                db.get_photometry(9, johnson_V)
+            with self.assertRaises(KeyError):
+                db.get_image(img3.unix_time, johnson_V)
+            with self.assertRaises(UnknownImageError):
+                db.add_photometry(2, img3.unix_time, johnson_V, 12.5, 100)
+
+    def test_get_photometry_matrix(self):
+
+        # The photometry loaded all at once must be the same that we get star
+        # by star with LEMONdB.get_photometry(), including the stars that were
+        # not measured in some (or all) of the images of the filter.
+
+        with LEMONdB(":memory:") as db:
+            johnson_B = passband.Passband("B")
+            johnson_V = passband.Passband("V")
+            star_ids = [3, 0, 5, 7]
+            for id_ in star_ids:
+                db.add_star(*self.random_star_info(id_=id_))
+
+            unix_times = runix_times(6)
+            for index, unix_time in enumerate(unix_times):
+                pfilter = johnson_V if index % 3 else johnson_B
+                img = ImageTest.random(pfilter)._replace(unix_time=unix_time)
+                db.add_image(img)
+                for star_id in star_ids[:-1]:
+                    if random.random() < 0.75:
+                        mag = random.uniform(self.MIN_MAG, self.MAX_MAG)
+                        snr = random.uniform(self.MIN_SNR, self.MAX_SNR)
+                        db.add_photometry(star_id, unix_time, pfilter, mag, snr)
+
+            # Read the photometry in several chunks
+            db.FETCH_SIZE = 2
+            for pfilter in (johnson_B, johnson_V):
+                matrix = db.get_photometry_matrix(pfilter)
+                self.assertEqual(matrix.magnitudes.dtype, numpy.float64)
+                self.assertEqual(matrix.snrs.dtype, numpy.float64)
+                self.assertEqual(list(matrix.star_ids), sorted(star_ids))
+                self.assertEqual(list(matrix.unix_times), sorted(matrix.unix_times))
+                shape = len(star_ids), len(matrix.unix_times)
+                self.assertEqual(matrix.magnitudes.shape, shape)
+                self.assertEqual(matrix.snrs.shape, shape)
+                self.assertEqual(matrix.mask.shape, shape)
+                self.assertFalse(matrix.mask[-1].any())  # star 7: no photometry
+                self.assertTrue(numpy.isnan(matrix.magnitudes[~matrix.mask]).all())
+
+                for index, star_id in enumerate(matrix.star_ids):
+                    expected = db.get_photometry(star_id, pfilter)
+                    star = DBStar.from_matrix(matrix, index, pfilter, db.dtype)
+                    self.assertEqual(star.id, star_id)
+                    self.assertEqual(len(star), len(expected))
+                    self.assertEqual(star.pfilter, pfilter)
+                    for record in xrange(len(expected)):
+                        self.assertEqual(star.time(record), expected.time(record))
+                        self.assertEqual(star.mag(record), expected.mag(record))
+                        self.assertEqual(star.snr(record), expected.snr(record))
+                    self.assertEqual(star._time_indexes, expected._time_indexes)
+                    self.assertEqual(star._phot_info.dtype, db.dtype)
+
+            # A filter without images, and therefore no photometry at all
+            matrix = db.get_photometry_matrix(passband.Passband("R"))
+            self.assertEqual(matrix.magnitudes.shape, (len(star_ids), 0))
+            self.assertEqual(len(matrix.unix_times), 0)
+
+    def test_add_pparams_photometry_and_use_pparams(self):
+
+        with LEMONdB(":memory:") as db:
+            johnson_V = passband.Passband("V")
+            star_ids = range(3)
+            for id_ in star_ids:
+                db.add_star(*self.random_star_info(id_=id_))
+
+            images = [ImageTest.random(johnson_V) for _ in xrange(4)]
+            for index, img in enumerate(images):
+                images[index] = img = img._replace(unix_time=1000 * (index + 1))
+                db.add_image(img)
+
+            # No photometry done with multiple sets of parameters, yet
+            self.assertEqual(db.pparams, [])
+
+            pparams = [PhotometricParametersTest.random() for _ in xrange(3)]
+            expected = {}  # map each PhotometricParameters to the magnitudes
+            for params in pparams:
+                expected[params] = {}
+                for star_id in star_ids:
+                    for img in images:
+                        mag = random.uniform(self.MIN_MAG, self.MAX_MAG)
+                        snr = random.uniform(self.MIN_SNR, self.MAX_SNR)
+                        args = star_id, img.unix_time, johnson_V, params, mag, snr
+                        db.add_pparams_photometry(*args)
+                        expected[params][(star_id, img.unix_time)] = mag, snr
+
+            self.assertEqual(db.pparams, sorted(pparams))
+
+            for params in pparams:
+                db.use_pparams(params)
+                for star_id in star_ids:
+                    star = db.get_photometry(star_id, johnson_V)
+                    self.assertEqual(len(star), len(images))
+                    for index in xrange(len(star)):
+                        mag, snr = expected[params][(star_id, star.time(index))]
+                        self.assertAlmostEqual(star.mag(index), mag)
+                        self.assertAlmostEqual(star.snr(index), snr)
+
+            # The usual exceptions, as with LEMONdB.add_photometry()
+            args = [0, images[0].unix_time, johnson_V, pparams[0], 12.5, 100]
+            with self.assertRaises(DuplicatePhotometryError):
+                db.add_pparams_photometry(*args)
+
+            args[0] = max(star_ids) + 1
+            with self.assertRaises(UnknownStarError):
+                db.add_pparams_photometry(*args)
+
+            args[0] = 0
+            args[1] = different_runix_time([img.unix_time for img in images])
+            with self.assertRaises(UnknownImageError):
+                db.add_pparams_photometry(*args)
+
+            # KeyError if there is no photometry for these parameters
+            with self.assertRaises(KeyError):
+                db.use_pparams(PhotometricParametersTest.random())
+
+            # The savepoint is released even if the photometry is not replaced
+            marks = []
+
+            def savepoint(name=None, _savepoint=db._savepoint):
+                marks.append(_savepoint(name))
+                return marks[-1]
+
+            with mock.patch.object(db, "_savepoint", savepoint):
+                with mock.patch.object(db, "_add_pparams") as mock_add_pparams:
+                    mock_add_pparams.side_effect = sqlite3.OperationalError
+                    with self.assertRaises(sqlite3.OperationalError):
+                        db.use_pparams(pparams[0])
+            with self.assertRaises(sqlite3.OperationalError):
+                db._release(marks[0])  # no such savepoint
+            self.assertEqual(len(db.get_photometry(0, johnson_V)), len(images))
+
+    def test_add_photometry_batch(self):
+
+        # Storing the photometry of many stars at once must give exactly the
+        # same result as doing it star by star, with LEMONdB.add_photometry().
+
+        with LEMONdB(":memory:") as db:
+            johnson_V = passband.Passband("V")
+            star_ids = range(5)
+            for id_ in star_ids:
+                star_info = self.random_star_info(id_=id_)
+                if id_ == 2:
+                    star_info[6:8] = [0.57095399531758917, -9.0025061305781175]
+                elif id_ == 4:
+                    star_info[6:8] = [None, None]
+                db.add_star(*star_info)
+
+            images = [ImageTest.random(johnson_V) for _ in xrange(3)]
+            for index, img in enumerate(images):
+                images[index] = img = img._replace(unix_time=1000 * (index + 1))
+                db.add_image(img)
+
+            expected = {}  # map each (star ID, Unix time) to the photometry
+            for img in images:
+                rows = []
+                for star_id in star_ids:
+                    mag = random.uniform(self.MIN_MAG, self.MAX_MAG)
+                    snr = random.uniform(self.MIN_SNR, self.MAX_SNR)
+                    rows.append((numpy.int64(star_id), numpy.float64(mag), snr))
+                    expected[(star_id, img.unix_time)] = mag, snr
+                db.add_photometry_batch(img, rows)
+
+                x, y = random.uniform(1, 2048), random.uniform(1, 2048)
+                db.add_pm_correction_batch(img, [(2, x, y)])
+                pm_correction = db.get_pm_correction(2, img.unix_time, johnson_V)
+                self.assertEqual(pm_correction, (x, y))
+
+            for star_id in star_ids:
+                star = db.get_photometry(star_id, johnson_V)
+                self.assertEqual(len(star), len(images))
+                for index in xrange(len(star)):
+                    mag, snr = expected[(star_id, star.time(index))]
+                    self.assertAlmostEqual(star.mag(index), mag)
+                    self.assertAlmostEqual(star.snr(index), snr)
+
+            # Photometry done with a set of photometric parameters
+            pparams = PhotometricParametersTest.random()
+            rows = [(star_id, 12.5, 100) for star_id in star_ids]
+            db.add_pparams_photometry_batch(images[0], pparams, rows)
+            self.assertEqual(db.pparams, [pparams])
+
+            # The usual exceptions, as with LEMONdB.add_photometry(). None of
+            # the records are stored if any of them cannot be, not even those
+            # that come before the one that fails.
+
+            new_image = ImageTest.random(johnson_V)._replace(unix_time=5000)
+            with self.assertRaises(UnknownImageError):
+                db.add_photometry_batch(new_image, [(0, 12.5, 100)])
+
+            db.add_image(new_image)
+            with self.assertRaises(DuplicatePhotometryError):
+                db.add_photometry_batch(new_image, [(0, 12.5, 100), (0, 13, 90)])
+
+            with self.assertRaises(UnknownStarError):
+                rows = [(0, 12.5, 100), (max(star_ids) + 1, 13, 90)]
+                db.add_photometry_batch(new_image, rows)
+
+            with self.assertRaises(ValueError):
+                db.add_pm_correction_batch(new_image, [(0, 1, 1), (4, 2, 2)])
+
+            # Also for the stars added after those without proper motions
+            # were looked up, which are kept in memory for the next batches.
+            star_id = max(star_ids) + 1
+            star_info = self.random_star_info(id_=star_id)
+            star_info[6:8] = [None, -9.0025061305781175]
+            db.add_star(*star_info)
+            with self.assertRaises(ValueError):
+                db.add_pm_correction_batch(new_image, [(star_id, 1, 1)])
+
+            self.assertEqual(len(db.get_photometry(0, johnson_V)), len(images))
+            self.assertEqual(db.get_pm_correction(0, 5000, johnson_V), (None, None))
+
+    def test_bulk_load(self):
+        def get_indexes(db):
+            db._execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+            return set(row[0] for row in db._rows)
+
+        def get_pragma(db, name):
+            db._execute("PRAGMA %s" % name)
+            return db._rows.fetchone()[0]
+
+        path = self.random_path()
+        try:
+            with LEMONdB(path) as db:
+                journal_mode = get_pragma(db, "journal_mode")
+                synchronous = get_pragma(db, "synchronous")
+                indexes = get_indexes(db)
+
+                johnson_V = passband.Passband("V")
+                db.add_star(*self.random_star_info(id_=1))
+                images = [ImageTest.random(johnson_V) for _ in xrange(2)]
+                images[1] = images[1]._replace(unix_time=images[0].unix_time + 1)
+
+                with db.bulk_load():
+                    self.assertEqual(get_pragma(db, "journal_mode"), "wal")
+                    self.assertEqual(get_pragma(db, "synchronous"), 0)
+                    self.assertNotIn("phot_by_image", get_indexes(db))
+                    db.add_image(images[0])
+                    db.add_photometry_batch(images[0], [(1, 12.5, 100)])
+
+                # Pragmas and indexes are restored, and the changes committed
+                self.assertEqual(get_pragma(db, "journal_mode"), journal_mode)
+                self.assertEqual(get_pragma(db, "synchronous"), synchronous)
+                self.assertEqual(get_indexes(db), indexes)
+                self.assertEqual(db.pfilters, [johnson_V])
+
+                # If an exception is raised, the changes are rolled back
+                with self.assertRaises(DuplicatePhotometryError):
+                    with db.bulk_load():
+                        db.add_image(images[1])
+                        db.add_photometry_batch(images[1], [(1, 12.5, 100)])
+                        db.add_photometry_batch(images[1], [(1, 12.5, 100)])
+
+                self.assertEqual(get_indexes(db), indexes)
+                self.assertEqual(len(db.get_photometry(1, johnson_V)), 1)
+
+                # The exception is not hidden if the transaction was aborted
+                with self.assertRaises(ValueError):
+                    with db.bulk_load():
+                        db.add_image(images[1])
+                        db._execute("ROLLBACK")
+                        raise ValueError
+
+                self.assertEqual(get_indexes(db), indexes)
+                self.assertEqual(len(db.get_photometry(1, johnson_V)), 1)
+        finally:
+            os.unlink(path)
+
     def test_pfilters_and_star_pfilters(self):
         with LEMONdB(":memory:") as db:
 
@@ -1751,7 +2351,7 @@ class LEMONdBTest(unittest.TestCase):
             the LIGHT_CURVES, CMP_STARS and PHOTOMETRIC_FILTERS tables of the
             'db' LEMONdB"""
 
-            query_curves = "SELECT * FROM light_curves ORDER BY id"
+            query_curves = "SELECT * FROM light_curves ORDER BY star_id, image_id"
             query_cmp_stars = "SELECT * FROM cmp_stars ORDER BY id"
             query_filters = "SELECT * FROM photometric_filters ORDER BY id"
 
@@ -1887,6 +2487,44 @@ class LEMONdBTest(unittest.TestCase):
             with self.assertRaises(sqlite3.IntegrityError):
                 db.get_light_curve(nstar_id, pfilter)
 
+    def test_add_light_curves(self):
+
+        # Storing many light curves at once must give the same result as doing
+        # it one by one, and none of them are stored if any of them fails.
+
+        with LEMONdB(":memory:") as db:
+            pfilter = passband.Passband.random()
+            star_ids = range(5)
+            for star_id in star_ids:
+                db.add_star(*LEMONdBTest.random_star_info(id_=star_id))
+            images = list(ImageTest.nrandom(4, pfilter=pfilter))
+            for img in images:
+                db.add_image(img)
+
+            curves = []
+            for star_id in star_ids:
+                cstars = [id_ for id_ in star_ids if id_ != star_id]
+                curve = LightCurveTest.random(pfilter=pfilter, cstars=cstars)
+                curves.append((star_id, LightCurveTest.populate(curve, images)))
+
+            # The last curve refers to an image not in the database
+            extra_img = ImageTest.random(pfilter=pfilter)
+            bad_curve = copy.deepcopy(curves[-1][1])
+            bad_curve.add(extra_img.unix_time, 12.5, 100)
+            with self.assertRaises(UnknownImageError):
+                db.add_light_curves(curves[:-1] + [(curves[-1][0], bad_curve)])
+            for star_id in star_ids:
+                self.assertEqual(db.get_light_curve(star_id, pfilter), None)
+
+            db.add_light_curves(iter(curves))
+            for star_id, curve in curves:
+                ocurve = db.get_light_curve(star_id, pfilter)
+                LightCurveTest.assertThatAreEqual(self, curve, ocurve)
+
+            # Fails, as the first curve is already in the database
+            with self.assertRaises(DuplicateLightCurvePointError):
+                db.add_light_curves(curves[:1])
+
     def test_get_instrumental_magnitudes(self):
 
         with LEMONdB(":memory:") as db:
@@ -2537,3 +3175,54 @@ class LEMONdBTest(unittest.TestCase):
             star_id, distance = db.star_closest_to_world_coords(*point_3)
             self.assertAlmostEqual(star_id, 1)
             self.assertAlmostEqual(distance, 47.939281840122732)
+
+    def test_stars_within_radius_and_closest_to_world_coords(self):
+
+        # The results must be the same as those of computing the distance to
+        # all the stars, also near the poles and when the RA wraps around.
+        for center in (Coordinates(359.95, 89.1), Coordinates(0.3, -20)):
+            with LEMONdB(":memory:") as db:
+                self.assertEqual(db.stars_within_radius(0, 0, 180), [])
+                self.assertEqual(db.stars_closest_to_world_coords(0, 0, 3), [])
+
+                stars = {}
+                for star_id in xrange(300):
+                    star_info = self.random_star_info(id_=star_id)
+                    ra = (center.ra + random.uniform(-1, 1)) % 360
+                    dec = min(center.dec + random.uniform(-1, 1), 90)
+                    star_info[3:5] = ra, dec
+                    db.add_star(*star_info)
+                    stars[star_id] = center.distance(Coordinates(ra, dec))
+
+                expected = sorted(stars.iteritems(), key=operator.itemgetter(1))
+                for radius in (0.0005, 0.25, 0.5, 1):
+                    found = db.stars_within_radius(center.ra, center.dec, radius)
+                    inside = [x for x in expected if x[1] <= radius]
+                    self.assertEqual([x[0] for x in found], [x[0] for x in inside])
+                    for (_, distance), (_, exp_distance) in zip(found, inside):
+                        self.assertAlmostEqual(distance, exp_distance)
+
+                for how_many in (1, 7, 50, 300, 301):
+                    args = center.ra, center.dec, how_many
+                    found = db.stars_closest_to_world_coords(*args)
+                    closest = [x[0] for x in expected[:how_many]]
+                    self.assertEqual([x[0] for x in found], closest)
+
+    def test_stars_within_radius_read_only(self):
+
+        # LEMONdBs created before STARS was indexed by declination cannot be
+        # given the index if they are read-only, but can still be searched.
+        path = self.random_path()
+        try:
+            with LEMONdB(path) as db:
+                db.add_star(1, 10, 20, 100.15, 9.79, 2000, None, None, 15.5)
+                db.add_star(2, 30, 40, 100.45, 9.79, 2000, None, None, 15.5)
+                db._execute("DROP INDEX stars_by_dec")
+                db.commit()
+
+            with mock.patch.object(os, "access", return_value=False):
+                with LEMONdB(path) as db:
+                    found = db.stars_within_radius(100.15, 9.79, 0.1)
+                    self.assertEqual([x[0] for x in found], [1])
+        finally:
+            os.unlink(path)
@@ -30,7 +30,7 @@ from test import unittest
 import passband
 import test_database
 from database import DBStar
-from diffphot import Weights, StarSet
+from diffphot import ComparisonCache, Weights, StarSet
 
 NITERS = 50  # How many times some test cases are run with random data
 
@@ -900,6 +900,20 @@ class StarSetTest(unittest.TestCase):
         for index in xrange(nstars):
             set_.light_curve(weights, star, _exclude_index=index)
 
+    def test_leave_one_out_stdevs(self):
+
+        # Must be equal to the standard deviations of the light curves that
+        # StarSet.light_curve returns when each star is excluded in turn.
+        for _ in xrange(NITERS):
+            set_ = self.random_set()[0]
+            weights = Weights.random(len(set_))
+            stdevs = set_._leave_one_out_stdevs(weights)
+            self.assertEqual(len(stdevs), len(set_))
+            for index in xrange(len(set_)):
+                args = weights, set_[index]
+                curve = set_.light_curve(*args, _exclude_index=index, no_snr=True)
+                self.assertAlmostEqual(stdevs[index], curve.stdev)
+
     def _assert_broeg_weights(self, star_mags, eweights, pct, max_iters):
         """Assert that the StarSet class returns the expected Broeg weights.
 
@@ -1425,3 +1439,27 @@ class StarSetTest(unittest.TestCase):
         self.assertRaises(ValueError, set_.best, 0)
         self.assertRaises(ValueError, set_.best, len(set_) + 1)
         self.assertRaises(ValueError, set_.best, len(set_) + 5)
+
+
+class ComparisonCacheTest(unittest.TestCase):
+    def test_key(self):
+
+        unix_times = test_database.runix_times(25)
+        star_ids = random.sample(xrange(1, 9999), 10)
+        key = ComparisonCache.key(unix_times, star_ids)
+        self.assertEqual(key, ComparisonCache.key(list(unix_times), star_ids))
+        self.assertNotEqual(key, ComparisonCache.key(unix_times[1:], star_ids))
+        self.assertNotEqual(key, ComparisonCache.key(unix_times, star_ids[1:]))
+        self.assertNotEqual(key, ComparisonCache.key(unix_times, star_ids[::-1]))
+
+    def test_get_and_hit_rate(self):
+
+        cache = ComparisonCache()
+        self.assertEqual(cache.hit_rate, 0)
+        self.assertIsNone(cache.get("a"))
+        cache["a"] = [3, 1, 2]
+        self.assertEqual(cache.get("a"), [3, 1, 2])
+        self.assertEqual(cache.get("a"), [3, 1, 2])
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        self.assertEqual(cache.hit_rate, 0.5)
@@ -31,6 +31,7 @@ import warnings
 # LEMON modules
 from test import unittest
 import fitsimage
+import passband
 
 NITERS = 10  # How many times random-data tests case are run
 
@@ -186,6 +187,13 @@ class FITSImageTest(unittest.TestCase):
             with self.assertRaises(fitsimage.NonStandardFITS):
                 FITSImage(text_path)
 
+    def test_data(self):
+        for _ in xrange(NITERS):
+            path, x_size, y_size = self.random_data()
+            with FITSImage(path) as img:
+                self.assertEqual(img.data.shape, (y_size, x_size))
+                numpy.testing.assert_array_equal(img.data, pyfits.getdata(path))
+
     def test_repr(self):
         with self.random() as img1:
             self.assertEqual(img1.path, eval(repr(img1)).path)
@@ -643,3 +651,91 @@ class FITSImageTest(unittest.TestCase):
         with self.assertRaises(KeyError):
             with self.random() as img:
                 img.dec(dec_kwd)
+
+    def test_data_sha1sum(self):
+
+        # Updating the header changes the checksum of the file, but not that
+        # of the pixels: that is what allows us to cache, for example, FWHMs.
+        with self.random() as img:
+            sha1sum = img.sha1sum
+            data_sha1sum = img.data_sha1sum
+            img.update_keyword("OBSERVER", "Edwin Hubble")
+            self.assertNotEqual(img.sha1sum, sha1sum)
+            self.assertEqual(img.data_sha1sum, data_sha1sum)
+
+            with self.random() as img2:
+                self.assertNotEqual(img2.data_sha1sum, data_sha1sum)
+
+    def test_header_index(self):
+
+        fd, index_path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+
+        keywords = {"FILTER": "Johnson V", "OBJECT": "NGC 2264"}
+        try:
+            with self.random(**keywords) as img:
+                index = fitsimage.use_header_index(index_path, [img.path])
+                self.assertEqual(index.outdated([img.path]), [])
+                header = index.header(img.path)
+                self.assertEqual(header.items(), img._header.items())
+
+                # Indexed images are read from the index, not from disk
+                indexed_img = FITSImage(img.path)
+                self.assertEqual(indexed_img.size, img.size)
+                self.assertEqual(indexed_img.read_keyword("OBJECT"), "NGC 2264")
+
+                pfilter = indexed_img.pfilter("FILTER")
+                name = "pfilter(('FILTER',), [])"
+                self.assertEqual(index.get(img.path, name), pfilter)
+                self.assertEqual(FITSImage(img.path).pfilter("FILTER"), pfilter)
+
+                # Modifying the image removes it from the index
+                indexed_img.update_keyword("OBJECT", "NGC 2244")
+                self.assertEqual(index.outdated([img.path]), [img.path])
+                with self.assertRaises(KeyError):
+                    index.header(img.path)
+                self.assertEqual(FITSImage(img.path).read_keyword("OBJECT"), "NGC 2244")
+                self.assertEqual(index.outdated([img.path]), [])
+
+        finally:
+            fitsimage.use_header_index(None)
+            os.unlink(index_path)
+
+    def test_header_index_bulk_lookups(self):
+
+        fd, index_path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+
+        keywords = dict(
+            FILTER="Johnson V", DATE_OBS="2012-03-12T21:04:13.1", EXPTIME=30
+        )
+        kwargs = dict(date_keyword="DATE_OBS", exp_keyword="EXPTIME")
+        imgs = [self.random(**keywords) for _ in xrange(3)]
+        paths = [img.path for img in imgs]
+        try:
+            # The same values are returned with and without the index
+            pfilters = fitsimage.pfilters(paths, "FILTER")
+            dates = fitsimage.dates(paths, **kwargs)
+            self.assertEqual(
+                pfilters, dict.fromkeys(paths, passband.Passband("Johnson V"))
+            )
+            self.assertEqual(
+                dates, dict((p, FITSImage(p).date(**kwargs)) for p in paths)
+            )
+
+            index = fitsimage.use_header_index(index_path, paths[:2])
+            for _ in xrange(2):  # parsed and stored, and then read
+                self.assertEqual(index.pfilters(paths, "FILTER"), pfilters)
+                self.assertEqual(fitsimage.dates(paths, **kwargs), dates)
+
+            name = "pfilter(('FILTER',), [])"
+            for path in paths:
+                self.assertEqual(index.get(path, name), pfilters[path])
+            # The values are stored under the same names as by FITSImage
+            self.assertEqual(FITSImage(paths[2]).pfilter("FILTER"), pfilters[paths[2]])
+
+        finally:
+            fitsimage.use_header_index(None)
+            os.unlink(index_path)
+            for img in imgs:
+                os.unlink(img.path)
@@ -19,17 +19,23 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import astropy.wcs
+import multiprocessing
+import numpy
 import operator
 import os.path
+import pickle
 import pyfits
 import random
+import sys
 import tempfile
 
 # LEMON modules
 from test import unittest
 import astromatic
+import fitsimage
 import platform
 import qphot
+import test.test_aperphot
 import test.test_fitsimage
 from util import load_coordinates
 
@@ -86,6 +92,14 @@ def get_nbits():
         return 32  # safe guess
 
 
+def run_qphot(args):
+    """ Function argument of Pool.map() to do photometry in a worker. """
+
+    path, coordinates, kwargs = args
+    img = fitsimage.FITSImage(path)
+    return list(qphot.run(img, coordinates, **kwargs))
+
+
 class QPhotTest(unittest.TestCase):
 
     QPHOT_KWARGS = dict(
@@ -147,6 +161,64 @@ class QPhotTest(unittest.TestCase):
             finally:
                 os.unlink(output_path)
 
+    def test_exact_coordinates(self):
+
+        # The vectorized proper-motion correction must give the same result
+        # as Coordinates.get_exact_coordinates() for each astronomical object.
+
+        def c(*args):
+            """ Return an astromatic.Coordinates object """
+            return astromatic.Coordinates(*args)
+
+        coordinates = (
+            c(316.724802, 38.74944, 4.16831, 3.2692),  # 61 Cygni A
+            c(165.834142, 35.96988, -0.58027, -4.76585),  # Lalande 21185
+            c(348.992913, 31.462856, None, None),  # WASP-10 b
+            c(97.19046, 38.962963),  # HD 45350 b
+            c(152.11717, 12.3065, 0, 0),
+        )
+
+        for _ in xrange(NITERS):
+            year = random.uniform(1900, 2050)
+            epoch = random.choice([1950, 2000])
+            ra, dec = qphot.exact_coordinates(coordinates, year, epoch)
+            self.assertEqual(len(ra), len(coordinates))
+
+            for index, coord in enumerate(coordinates):
+                if coord.pm_ra is not None:
+                    coord = coord.get_exact_coordinates(year, epoch)
+                self.assertAlmostEqual(ra[index], coord.ra)
+                self.assertAlmostEqual(dec[index], coord.dec)
+
+        # No objects, no coordinates
+        ra, dec = qphot.exact_coordinates([], 2015, 2000)
+        self.assertEqual(len(ra), 0)
+        self.assertEqual(len(dec), 0)
+
+    def test_get_static_coords_file(self):
+
+        # The coordinates file of objects without proper motions is written
+        # once and then reused, as long as the coordinates are the same.
+
+        coordinates = tuple(
+            astromatic.Coordinates(random.uniform(0, 360), random.uniform(-90, 90))
+            for _ in xrange(100)
+        )
+
+        path = qphot._get_static_coords_file(coordinates)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(path, qphot._get_static_coords_file(tuple(coordinates)))
+
+        expected = qphot.get_coords_file(coordinates, 2015, 2000)
+        try:
+            for c1, c2 in zip(load_coordinates(path), load_coordinates(expected)):
+                self.assertEqual(c1, c2)
+        finally:
+            os.unlink(expected)
+
+        other = coordinates[:-1]
+        self.assertNotEqual(path, qphot._get_static_coords_file(other))
+
     def test_qphot_run(self):
 
         # A simple test: do photometry on the DSS image of NGC 2264, measuring
@@ -327,3 +399,277 @@ class QPhotTest(unittest.TestCase):
             f = self.assertAlmostEqual
             f(ra, expected_coordinates.ra, delta=1e-3)  # delta = 0.24 arcsec
             f(dec, expected_coordinates.dec, delta=1e-3)  # delta = 3.6 arcsec
+
+    def test_qphot_run_numpy_backend(self):
+
+        # The NumPy backend does not reproduce IRAF's qphot bit by bit (e.g.,
+        # the sky is not computed exactly in the same manner), but for well
+        # measured, isolated stars both implementations must agree closely.
+
+        ngc2264_path = "./test/test_data/fits/NGC_2264.fits"
+        ngc2264_input_coords = (
+            astromatic.Coordinates(100.1543316, 9.7909363),
+            astromatic.Coordinates(100.1597762, 9.7878795),
+            astromatic.Coordinates(100.2147546, 9.8636567),
+            astromatic.Coordinates(100.2502955, 9.8714701),
+            astromatic.Coordinates(100.2933265, 9.8838196),
+        )
+
+        for cbox in (0, 5):
+
+            kwargs = self.QPHOT_KWARGS.copy()
+            kwargs["cbox"] = cbox
+
+            path = fix_DSS_image(ngc2264_path)
+            with test.test_fitsimage.FITSImage(path) as img:
+                iraf = qphot.run(img, ngc2264_input_coords, **kwargs)
+                kwargs["backend"] = "numpy"
+                numpy_ = qphot.run(img, ngc2264_input_coords, **kwargs)
+
+            self.assertEqual(len(iraf), len(numpy_))
+            for phot, expected_phot in zip(numpy_, iraf):
+                self.assertAlmostEqual(phot.x, expected_phot.x, delta=0.5)
+                self.assertAlmostEqual(phot.y, expected_phot.y, delta=0.5)
+                self.assertAlmostEqual(phot.mag, expected_phot.mag, delta=0.05)
+                self.assertAlmostEqual(phot.stdev, expected_phot.stdev, delta=50)
+
+        # Only the implementations listed in BACKENDS are allowed
+        path = fix_DSS_image(ngc2264_path)
+        with test.test_fitsimage.FITSImage(path) as img:
+            kwargs = self.QPHOT_KWARGS.copy()
+            kwargs["backend"] = "photutils"
+            with self.assertRaises(ValueError):
+                qphot.run(img, ngc2264_input_coords, **kwargs)
+
+    def test_qphot_run_saturation(self):
+
+        # If one or more pixels in the aperture are above the saturation level
+        # the magnitude of the object must be positive infinity. Use the same
+        # astronomical objects as in test_qphot_run(), which are all measured
+        # and whose brightest pixels are within the range of the DSS images.
+
+        ngc2264_path = "./test/test_data/fits/NGC_2264.fits"
+        ngc2264_input_coords = (
+            astromatic.Coordinates(100.1543316, 9.7909363),
+            astromatic.Coordinates(100.1597762, 9.7878795),
+            astromatic.Coordinates(100.2147546, 9.8636567),
+        )
+
+        for backend in qphot.BACKENDS:
+            kwargs = self.QPHOT_KWARGS.copy()
+            kwargs["backend"] = backend
+
+            path = fix_DSS_image(ngc2264_path)
+            with test.test_fitsimage.FITSImage(path) as img:
+
+                kwargs["maximum"] = 1
+                for phot in qphot.run(img, ngc2264_input_coords, **kwargs):
+                    self.assertEqual(phot.mag, float("infinity"))
+
+                kwargs["maximum"] = sys.maxint
+                for phot in qphot.run(img, ngc2264_input_coords, **kwargs):
+                    self.assertNotEqual(phot.mag, float("infinity"))
+                    self.assertNotEqual(phot.mag, None)
+
+    def test_qphot_run_multiple_apertures(self):
+
+        # Photometry with several apertures at once must give the same result
+        # as running qphot.run() separately for each one of the apertures.
+
+        ngc2264_path = "./test/test_data/fits/NGC_2264.fits"
+        ngc2264_input_coords = (
+            astromatic.Coordinates(100.1543316, 9.7909363),
+            astromatic.Coordinates(100.1597762, 9.7878795),
+            astromatic.Coordinates(100.2147546, 9.8636567),
+        )
+
+        apertures = [5, 8.5, 11]
+        for backend in qphot.BACKENDS:
+            kwargs = self.QPHOT_KWARGS.copy()
+            kwargs["backend"] = backend
+
+            path = fix_DSS_image(ngc2264_path)
+            with test.test_fitsimage.FITSImage(path) as img:
+                kwargs["aperture"] = apertures
+                qphots = qphot.run(img, ngc2264_input_coords, **kwargs)
+                self.assertEqual(len(qphots), len(apertures))
+
+                for aperture, img_qphot in zip(apertures, qphots):
+                    kwargs["aperture"] = aperture
+                    expected = qphot.run(img, ngc2264_input_coords, **kwargs)
+                    self.assertEqual(len(img_qphot), len(expected))
+                    self.assertEqual(img_qphot.path, expected.path)
+                    for phot, expected_phot in zip(img_qphot, expected):
+                        self.assertAlmostEqual(phot.x, expected_phot.x, places=3)
+                        self.assertAlmostEqual(phot.y, expected_phot.y, places=3)
+                        self.assertAlmostEqual(phot.mag, expected_phot.mag, places=3)
+                        self.assertAlmostEqual(phot.sum, expected_phot.sum, places=3)
+
+    def test_qphot_run_multiple_apertures_numpy(self):
+
+        # The same, on a synthetic image with the NumPy backend, so that the
+        # test needs neither IRAF nor the DSS images: a list of apertures must
+        # return a list of QPhot objects, one for each aperture.
+
+        size = 128
+        stars = [(40.2, 50.7, 1e5), (90.6, 70.1, 5e5), (64.3, 100.8, 2e5)]
+        data = test.test_aperphot.gaussian_image(size, stars)
+        wcs = astropy.wcs.WCS(naxis=2)
+        wcs.wcs.crpix = [size / 2, size / 2]
+        wcs.wcs.cdelt = [-0.0003, 0.0003]
+        wcs.wcs.crval = [100.15, 9.79]
+        wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+
+        hdu = pyfits.PrimaryHDU(data)
+        for keyword, value in wcs.to_header().items():
+            hdu.header[keyword] = value
+        hdu.header["EXPOSURE"] = 10
+        fd, path = tempfile.mkstemp(suffix=".fits")
+        os.close(fd)
+        os.unlink(path)
+        hdu.writeto(path)
+
+        pixels = numpy.array([(x, y) for x, y, _ in stars])
+        coordinates = [
+            astromatic.Coordinates(ra, dec) for ra, dec in wcs.all_pix2world(pixels, 1)
+        ]
+
+        apertures = [4.0, 6.0, 8.0]
+        kwargs = self.QPHOT_KWARGS.copy()
+        kwargs["backend"] = "numpy"
+        kwargs["maximum"] = sys.maxint
+        with test.test_fitsimage.FITSImage(path) as img:
+            kwargs["aperture"] = apertures
+            qphots = qphot.run(img, coordinates, **kwargs)
+            self.assertIsInstance(qphots, list)
+            self.assertEqual(len(qphots), len(apertures))
+
+            for aperture, img_qphot in zip(apertures, qphots):
+                self.assertIsInstance(img_qphot, qphot.QPhot)
+                kwargs["aperture"] = aperture
+                expected = qphot.run(img, coordinates, **kwargs)
+                self.assertIsInstance(expected, qphot.QPhot)
+                self.assertEqual(list(img_qphot), list(expected))
+
+            # Larger apertures collect more of the flux of the stars
+            sums = [img_qphot.data["sum"] for img_qphot in qphots]
+            self.assertTrue((numpy.diff(sums, axis=0) > 0).all())
+
+    def test_init_worker(self):
+
+        # Workers with a persistent PyRAF session must return exactly the same
+        # photometry, image after image, as a brand-new IRAF process does.
+
+        ngc2264_path = "./test/test_data/fits/NGC_2264.fits"
+        ngc2264_input_coords = (
+            astromatic.Coordinates(100.1543316, 9.7909363),
+            astromatic.Coordinates(100.1597762, 9.7878795),
+            astromatic.Coordinates(100.2147546, 9.8636567),
+        )
+
+        path = fix_DSS_image(ngc2264_path)
+        with test.test_fitsimage.FITSImage(path) as img:
+            expected = list(qphot.run(img, ngc2264_input_coords, **self.QPHOT_KWARGS))
+
+            args = [(img.path, ngc2264_input_coords, self.QPHOT_KWARGS)] * 4
+            pool = multiprocessing.Pool(2, initializer=qphot.init_worker)
+            try:
+                for result in pool.map(run_qphot, args):
+                    self.assertEqual(result, expected)
+            finally:
+                pool.close()
+                pool.join()
+
+        # Tasks are looked up only once
+        for name in qphot.IRAF_TASKS:
+            self.assertIs(qphot.get_iraf_task(name), qphot.get_iraf_task(name))
+
+    def test_qphot_run_numpy_centering(self):
+
+        # Centering the objects with NumPy and giving IRAF's qphot their pixel
+        # coordinates must give the same centers as the NumPy backend, and a
+        # photometry very close to that of letting qphot do the centering.
+
+        ngc2264_path = "./test/test_data/fits/NGC_2264.fits"
+        ngc2264_input_coords = (
+            astromatic.Coordinates(100.1543316, 9.7909363),
+            astromatic.Coordinates(100.1597762, 9.7878795),
+            astromatic.Coordinates(100.1598790, 9.9627296),
+            astromatic.Coordinates(100.1191901, 9.8177770),
+        )
+
+        kwargs = self.QPHOT_KWARGS.copy()
+        kwargs["cbox"] = 5
+
+        path = fix_DSS_image(ngc2264_path)
+        with test.test_fitsimage.FITSImage(path) as img:
+            iraf = qphot.run(img, ngc2264_input_coords, **kwargs)
+            kwargs["numpy_centering"] = True
+            centered = qphot.run(img, ngc2264_input_coords, **kwargs)
+            kwargs["backend"] = "numpy"
+            numpy_ = qphot.run(img, ngc2264_input_coords, **kwargs)
+
+        self.assertEqual(len(centered), len(iraf))
+        for phot, iraf_phot, numpy_phot in zip(centered, iraf, numpy_):
+            self.assertEqual(phot.x, numpy_phot.x)
+            self.assertEqual(phot.y, numpy_phot.y)
+            self.assertAlmostEqual(phot.x, iraf_phot.x, delta=0.5)
+            self.assertAlmostEqual(phot.y, iraf_phot.y, delta=0.5)
+            self.assertAlmostEqual(phot.mag, iraf_phot.mag, delta=0.05)
+
+    def test_qphot_data(self):
+
+        # The photometry is stored in a structured NumPy array, but the QPhot
+        # object must still behave as a sequence of QPhotResult objects, with
+        # None for INDEF values, and survive pickling (as it is sent from the
+        # worker processes to the parent one). QPhot.snr() must return exactly
+        # the same signal-to-noise ratios as QPhotResult.snr(), one by one.
+
+        ngc2264_path = "./test/test_data/fits/NGC_2264.fits"
+        ngc2264_input_coords = (
+            astromatic.Coordinates(100.1543316, 9.7909363),
+            astromatic.Coordinates(100.1597762, 9.7878795),
+            astromatic.Coordinates(100.2147546, 9.8636567),
+            astromatic.Coordinates(100.2502955, 9.8714701),
+            astromatic.Coordinates(100.2933265, 9.8838196),
+        )
+
+        kwargs = self.QPHOT_KWARGS.copy()
+        kwargs["backend"] = "numpy"
+
+        path = fix_DSS_image(ngc2264_path)
+        with test.test_fitsimage.FITSImage(path) as img:
+            result = qphot.run(img, ngc2264_input_coords, **kwargs)
+
+        self.assertEqual(len(result), len(ngc2264_input_coords))
+        self.assertEqual(result.data.dtype, qphot.QPHOT_DTYPE)
+
+        # INDEF measurement, zero and negative sums
+        result[1] = result[1]._replace(mag=None, stdev=None)
+        result[2] = result[2]._replace(sum=0.0, flux=0.0)
+        result[3] = result[3]._replace(sum=-1250.5, flux=-40.25)
+        self.assertEqual(result[1].mag, None)
+        self.assertEqual(result[1].stdev, None)
+        self.assertTrue(numpy.isnan(result.data["mag"][1]))
+
+        self.assertEqual(result[1:3], list(result)[1:3])
+        for index, object_phot in enumerate(result):
+            self.assertEqual(object_phot, result[index])
+            self.assertIsInstance(object_phot, qphot.QPhotResult)
+
+        for gain in (1, 2.5, random.uniform(0.1, 10)):
+            snrs = result.snr(gain)
+            self.assertEqual(snrs.shape, (len(result),))
+            for object_phot, snr in zip(result, snrs):
+                self.assertEqual(snr, object_phot.snr(gain))
+
+        self.assertEqual(result.snr(1)[2], 0)
+        self.assertTrue(result.snr(1)[3] < 0)
+        for gain in (0, -1.5):
+            with self.assertRaises(ValueError):
+                result.snr(gain)
+
+        unpickled = pickle.loads(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(unpickled, result)
+        self.assertEqual(unpickled.path, result.path)
+        numpy.testing.assert_array_equal(unpickled.snr(1), result.snr(1))
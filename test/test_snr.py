@@ -376,3 +376,37 @@ class SNRTest(unittest.TestCase):
             csnr = mean_snr(snrs, weights=weights)
             back_to_error = snr_to_error(csnr)[1]
             self.assertAlmostEqual(back_to_error, cerror)
+
+    def test_mean_snrs(self):
+
+        # Must be equal to calling mean_snr() on each column
+        for _ in xrange(NMEANS):
+            nrows = random.randint(MIN_NERR, MAX_NERR)
+            ncolumns = random.randint(1, 50)
+            snrs = numpy.random.uniform(MIN_SNR, MAX_SNR, size=(nrows, ncolumns))
+            weights = [self._random_weight() for i in xrange(nrows)]
+            csnrs = mean_snrs(snrs, weights)
+            self.assertEqual(csnrs.shape, (ncolumns,))
+            for index in xrange(ncolumns):
+                expected = mean_snr(snrs[:, index], weights=weights)
+                self.assertAlmostEqual(csnrs[index] / expected, 1)
+
+        with self.assertRaises(ValueError):
+            mean_snrs(numpy.array([[100, 200], [0.5, 150]]), [0.5, 0.5])
+
+    def test_difference_snrs(self):
+
+        # Must be equal to calling difference_snr() on each position
+        for _ in xrange(NMEANS):
+            how_many = random.randint(MIN_NERR, MAX_NERR)
+            size = random.randint(1, 50)
+            args = MIN_SNR, MAX_SNR, size
+            snrs = [numpy.random.uniform(*args) for _ in xrange(how_many)]
+            dsnrs = difference_snrs(*snrs)
+            self.assertEqual(dsnrs.shape, (size,))
+            for index in xrange(size):
+                expected = difference_snr(*[s[index] for s in snrs])
+                self.assertAlmostEqual(dsnrs[index] / expected, 1)
+
+        with self.assertRaises(ValueError):
+            difference_snrs(numpy.array([100, 1]), numpy.array([50, 50]))